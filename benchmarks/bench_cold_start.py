@@ -0,0 +1,116 @@
+"""Measures the import time of the Lambda handler in fresh interpreters, with a -X importtime profile of the slowest imports
+
+Usage: python benchmarks/bench_cold_start.py [--repeat 5] [--top 15] [--max-import-seconds 0.3]
+Prints one JSON line per scenario with the median import time, and the modules with the largest cumulative import
+time. With --max-import-seconds, exits with an error when importing the handler takes longer, to catch regressions
+like a heavy library imported at the top of main.py again.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# What the Lambda runtime imports during its init phase, then what the first invocation ends up importing on top of it
+SCENARIOS = {
+    "handler_import": "import main",
+    "first_invocation_imports": (
+        "import main, streaming_pipeline, google_places_api, aiohttp, gspread, slack_sdk, "
+        "google.oauth2.service_account, utils.google_sheet_utils, slack_bot.bot; "
+        "import utils.dynamodb_utils as d; d.get_table()"
+    ),
+}
+
+_TIMED_SNIPPET = (
+    "import time; start_time = time.perf_counter(); {statement}; "
+    "print(time.perf_counter() - start_time)"
+)
+
+
+def _run_in_fresh_interpreter(statement: str):
+    env = {
+        **os.environ,
+        "AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+    }
+    completed = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            _TIMED_SNIPPET.format(statement=statement),
+        ],
+        cwd=SRC_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+
+def _parse_importtime(stderr: str):
+    """Returns (module, self µs, cumulative µs) for every line of the -X importtime output"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        modules.append((module.rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def run_benchmark(repeat: int, top: int):
+    results = []
+    for scenario, statement in SCENARIOS.items():
+        import_times = []
+        for _ in range(repeat):
+            import_time, stderr = _run_in_fresh_interpreter(statement)
+            import_times.append(import_time)
+
+        # the profile of the last run, the top level imports (no indentation) are the ones to look at first
+        modules = _parse_importtime(stderr)
+        slowest = sorted(modules, key=lambda module: module[2], reverse=True)[:top]
+
+        result = {
+            "benchmark": "cold_start",
+            "scenario": scenario,
+            "median_import_seconds": round(statistics.median(import_times), 4),
+            "min_import_seconds": round(min(import_times), 4),
+            "modules_imported": len(modules),
+            "slowest_imports": [
+                {
+                    "module": module.strip(),
+                    "depth": (len(module) - len(module.lstrip())) // 2,
+                    "cumulative_ms": round(cumulative_us / 1000, 1),
+                    "self_ms": round(self_us / 1000, 1),
+                }
+                for module, self_us, cumulative_us in slowest
+            ],
+        }
+        print(json.dumps(result), flush=True)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-import-seconds", type=float)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.repeat, args.top)
+
+    handler_import_seconds = results[0]["median_import_seconds"]
+    if (
+        args.max_import_seconds is not None
+        and handler_import_seconds > args.max_import_seconds
+    ):
+        sys.exit(
+            f"Importing the handler took {handler_import_seconds}s, more than the max of {args.max_import_seconds}s"
+        )
@@ -0,0 +1,283 @@
+"""Runs several worker processes on the same backlog of stores and checks that no store is looked up or exported twice
+
+Usage: python benchmarks/bench_concurrent_workers.py [--stores 5000] [--workers 4] [--batch-size 500] [--crashed-workers 1]
+
+The stores table is a single in-memory stand-in (local_dynamodb.py) served to the worker processes over local
+connections, so that the claims of the workers race on it like they would on the real table. Every worker
+runs lambda_handler in a loop, with a fake Places lookup, Google Sheet and Slack, until there are no stores left.
+The crashed workers claim a batch of stores and exit without processing them, their leases expire after
+--crash-lease-seconds and the stores are released for the other workers.
+
+Prints the throughput, the number of lookups and the DynamoDB requests (the claims are update_item requests) as JSON,
+and exits with an error if a store was looked up or exported more than once, or if a store isn't processed at the end.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from multiprocessing.connection import Client, Listener
+from types import SimpleNamespace
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+# Get the src directory of the project and add it to sys.path, same as in src/slack_bot/bot.py
+sys.path.append(SRC_DIR)
+
+from local_dynamodb import _LocalClient, make_local_stores_table
+
+
+class _TableServer:
+    """Serves the methods of the shared table to the worker processes, one thread per connection"""
+
+    def __init__(self, table):
+        self.table = table
+        self.authkey = os.urandom(16)
+        self.listener = Listener(("127.0.0.1", 0), authkey=self.authkey, backlog=128)
+        self.address = self.listener.address
+        threading.Thread(target=self._accept_connections, daemon=True).start()
+
+    def _accept_connections(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(
+                target=self._serve_connection, args=(connection,), daemon=True
+            ).start()
+
+    def _serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    connection.send((True, getattr(self.table, method)(**kwargs)))
+                except Exception as e:
+                    connection.send((False, e))
+
+    def close(self):
+        self.listener.close()
+
+
+class _RemoteTable:
+    """Stand-in for the boto3 Table resource in the workers, forwarding the calls to the shared table"""
+
+    def __init__(
+        self, address, authkey: bytes, name: str = "UberEats_scraped_stores_data"
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.name = name
+        self.meta = SimpleNamespace(client=_LocalClient(self))
+        # the connections are reused by the threads of the pipeline, a new one is opened only when they're all busy
+        self._connections = queue.SimpleQueue()
+
+    def _call(self, method: str, **kwargs):
+        try:
+            connection = self._connections.get_nowait()
+        except queue.Empty:
+            connection = Client(self.address, authkey=self.authkey)
+        connection.send((method, kwargs))
+        succeeded, result = connection.recv()
+        self._connections.put(connection)
+        if not succeeded:
+            raise result
+        return result
+
+    def __getattr__(self, method: str):
+        return lambda **kwargs: self._call(method, **kwargs)
+
+
+def _wire_worker(table: _RemoteTable, lookup_latency: float, looked_up: Counter):
+    """Points the modules of the pipeline to the shared table and to fakes of the other services"""
+    import google_places_api
+    import slack_bot.bot as bot
+    import utils.dynamodb_utils as dynamodb_utils
+    import utils.google_sheet_utils as google_sheet_utils
+    from local_google_sheets import LocalGoogleSheetsAPI
+    from local_slack import LocalSlackWebClient
+
+    dynamodb_utils.table = table
+    google_sheet_utils._get_gspread_client = LocalGoogleSheetsAPI(
+        base_latency=0, latency_per_cell=0
+    ).authorize
+    LocalSlackWebClient.latency = 0
+    bot._get_slack_client = lambda token: LocalSlackWebClient(token=token)
+
+    # lookup_stores is built on this one, so both pipeline modes go through the fake
+    async def _fake_lookup_stores_as_completed(self, stores):
+        looked_up.update(store.store_id for store in stores)
+        await asyncio.sleep(lookup_latency)
+        for i, store in enumerate(stores):
+            yield [store], f"+44 20 7946 {i % 10000:04d}"
+
+    google_places_api.PlacesLookupSession.lookup_stores_as_completed = (
+        _fake_lookup_stores_as_completed
+    )
+
+
+def _run_worker(address, authkey: bytes, args, results):
+    import main
+
+    looked_up = Counter()
+    exported = Counter()
+    _wire_worker(_RemoteTable(address, authkey), args.lookup_latency, looked_up)
+
+    run_pipeline = main.run_pipeline
+
+    def _recording_run_pipeline(*run_args, **run_kwargs):
+        stores = run_pipeline(*run_args, **run_kwargs)
+        exported.update(store.store_id for store in stores)
+        return stores
+
+    main.run_pipeline = _recording_run_pipeline
+    main.ITEMS_PER_BATCH = args.batch_size
+
+    import utils.dynamodb_utils as dynamodb_utils
+
+    runs = 0
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        exported_before = sum(exported.values())
+        main.lambda_handler({"pipeline_mode": args.pipeline_mode}, None)
+        runs += 1
+        if sum(exported.values()) > exported_before:
+            continue
+
+        # nothing left to claim: done, unless other workers still hold leases on stores
+        counts = dynamodb_utils.get_table().count_by_status()
+        if not counts.get("pending") and not counts.get("in_progress"):
+            if not counts.get("fetched"):
+                break
+        time.sleep(0.2)
+
+    results.put(
+        {"runs": runs, "looked_up": dict(looked_up), "exported": dict(exported)}
+    )
+
+
+def _run_crashed_worker(address, authkey: bytes, args):
+    """Claims a batch of stores the way a run does, then dies before processing them"""
+    import utils.dynamodb_utils as dynamodb_utils
+
+    dynamodb_utils.table = _RemoteTable(address, authkey)
+    for page in dynamodb_utils.iter_pages_of_unprocessed_stores(limit=args.batch_size):
+        dynamodb_utils.claim_stores(
+            page, "crashed-worker", lease_seconds=args.crash_lease_seconds
+        )
+    os._exit(1)
+
+
+def run_benchmark(args) -> dict:
+    table = make_local_stores_table(args.stores, base_latency=args.dynamodb_latency)
+    server = _TableServer(table)
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["PLACES_CACHE_BACKEND"] = "none"
+    os.environ["PLACES_BUDGET_BACKEND"] = "none"
+    os.environ["METRICS_ENABLED"] = "false"
+    os.environ["LEASE_SECONDS"] = str(args.lease_seconds)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    # spawn rather than fork, so the workers import the pipeline like separate invocations would
+    context = multiprocessing.get_context("spawn")
+    try:
+        for _ in range(args.crashed_workers):
+            crashed_worker = context.Process(
+                target=_run_crashed_worker, args=(server.address, server.authkey, args)
+            )
+            crashed_worker.start()
+            crashed_worker.join()
+
+        results = context.Queue()
+        start_time = time.perf_counter()
+        workers = [
+            context.Process(
+                target=_run_worker, args=(server.address, server.authkey, args, results)
+            )
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        worker_results = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start_time
+
+        looked_up = Counter()
+        exported = Counter()
+        for worker_result in worker_results:
+            looked_up.update(worker_result["looked_up"])
+            exported.update(worker_result["exported"])
+        final_statuses = {
+            status: count for status, count in table.count_by_status().items() if count
+        }
+        request_counts = table.get_request_counts()
+    finally:
+        server.close()
+
+    return {
+        "benchmark": "concurrent_workers",
+        "pipeline_mode": args.pipeline_mode,
+        "stores": args.stores,
+        "workers": args.workers,
+        "crashed_workers": args.crashed_workers,
+        "seconds": round(elapsed, 3),
+        "stores_per_second": round(args.stores / elapsed, 1),
+        "runs_per_worker": [worker_result["runs"] for worker_result in worker_results],
+        "stores_per_worker": [
+            sum(worker_result["exported"].values()) for worker_result in worker_results
+        ],
+        "lookups": sum(looked_up.values()),
+        "stores_looked_up_more_than_once": sum(
+            1 for count in looked_up.values() if count > 1
+        ),
+        "stores_exported_more_than_once": sum(
+            1 for count in exported.values() if count > 1
+        ),
+        "final_statuses": final_statuses,
+        "dynamodb_requests": request_counts,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--stores", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument(
+        "--pipeline-mode", default="streaming", choices=["streaming", "staged"]
+    )
+    parser.add_argument("--crashed-workers", type=int, default=1)
+    parser.add_argument("--lease-seconds", type=int, default=960)
+    parser.add_argument("--crash-lease-seconds", type=int, default=3)
+    parser.add_argument(
+        "--lookup-latency", type=float, default=0.05, help="per page, in seconds"
+    )
+    parser.add_argument("--dynamodb-latency", type=float, default=0.001)
+    parser.add_argument(
+        "--timeout", type=float, default=300, help="max run time of a worker"
+    )
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    print(json.dumps(result), flush=True)
+
+    if (
+        result["stores_looked_up_more_than_once"]
+        or result["stores_exported_more_than_once"]
+        or result["final_statuses"].get("processed") != args.stores
+    ):
+        sys.exit("Some stores were processed more than once or not processed at all")
@@ -0,0 +1,98 @@
+"""Compares the readers of the pending stores against a local DynamoDB stand-in
+
+Usage: python benchmarks/bench_dynamodb_reader.py [--sizes 1000 10000 50000]
+Prints one JSON line per (reader, batch size) with the wall time, the number of requests and the throughput.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# Get the src directory of the project and add it to sys.path, same as in src/slack_bot/bot.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from local_dynamodb import make_local_stores_table
+from models.store import Store
+import utils.dynamodb_utils as dynamodb_utils
+
+
+def legacy_get_batch_of_unprocessed_stores(limit=1000):
+    """The reader before the optimizations: serial pages of 100 full items"""
+    stores = []
+    last_evaluated_key = None
+
+    while len(stores) < limit:
+        scan_params = {
+            "IndexName": "status-index",
+            "Limit": min(limit - len(stores), 100),
+            "KeyConditionExpression": "#s = :s",
+            "ExpressionAttributeNames": {"#s": "status"},
+            "ExpressionAttributeValues": {":s": "pending"},
+        }
+        if last_evaluated_key:
+            scan_params["ExclusiveStartKey"] = last_evaluated_key
+
+        response = dynamodb_utils.table.query(**scan_params)
+        stores.extend(
+            [Store.from_dynamodb_item(store) for store in response.get("Items", [])]
+        )
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            break
+
+    return stores
+
+
+def parallel_scan_reader(limit=1000):
+    stores = []
+    for page in dynamodb_utils.iter_pages_of_stores_parallel_scan(limit=limit):
+        stores.extend(page)
+    return stores
+
+
+READERS = {
+    "legacy_query_loop": legacy_get_batch_of_unprocessed_stores,
+    "prefetching_query": dynamodb_utils.get_batch_of_unprocessed_stores,
+    "parallel_scan": parallel_scan_reader,
+}
+
+
+def run_benchmark(sizes):
+    results = []
+    for size in sizes:
+        for reader_name, reader in READERS.items():
+            # the table is twice the size of the batch, so the scan also has to go through non matching items
+            dynamodb_utils.table = make_local_stores_table(2 * size)
+            for i, item in enumerate(dynamodb_utils.table.get_all_items()):
+                if i % 2:
+                    item["status"] = "processed"
+                    dynamodb_utils.table._index_item(item["store_id"], item)
+
+            start_time = time.perf_counter()
+            stores = reader(limit=size)
+            elapsed = time.perf_counter() - start_time
+
+            result = {
+                "benchmark": "dynamodb_reader",
+                "reader": reader_name,
+                "batch_size": size,
+                "stores_read": len(stores),
+                "seconds": round(elapsed, 4),
+                "stores_per_second": round(len(stores) / elapsed, 1),
+                "requests": dynamodb_utils.table.request_counts,
+            }
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes)
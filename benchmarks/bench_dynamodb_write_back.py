@@ -0,0 +1,85 @@
+"""Compares the write-back of the processed stores against a local DynamoDB stand-in
+
+Usage: python benchmarks/bench_dynamodb_write_back.py [--sizes 1000 10000] [--throttle-rate 0.05]
+Prints one JSON line per (writer, batch size) with the wall time, the number of requests and the failures.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+# Get the src directory of the project and add it to sys.path, same as in src/slack_bot/bot.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from local_dynamodb import make_local_stores_table
+from models.store import Store
+import utils.dynamodb_utils as dynamodb_utils
+
+
+def legacy_update_status_of_items_to_processed_in_DB(stores):
+    """The write-back before the optimizations: full item overwrites through a single batch_writer()"""
+    with dynamodb_utils.table.batch_writer() as batch:
+        for store in stores:
+            store.last_processed_at = str(datetime.now())
+            batch.put_item(store.to_dynamodb_item())
+    return None
+
+
+WRITERS = {
+    "legacy_batch_writer_overwrite": legacy_update_status_of_items_to_processed_in_DB,
+    "concurrent_partial_update": dynamodb_utils.update_status_of_items_to_processed_in_DB,
+}
+
+
+def run_benchmark(sizes, throttle_rate):
+    results = []
+    for size in sizes:
+        for writer_name, writer in WRITERS.items():
+            dynamodb_utils.table = make_local_stores_table(
+                size, throttle_rate=throttle_rate
+            )
+            stores = [
+                Store.from_dynamodb_item(item)
+                for item in dynamodb_utils.table.get_all_items()
+            ]
+            for store in stores:
+                store.phone_number = "+44 20 7946 0000"
+
+            start_time = time.perf_counter()
+            write_back_result = writer(stores)
+            elapsed = time.perf_counter() - start_time
+
+            result = {
+                "benchmark": "dynamodb_write_back",
+                "writer": writer_name,
+                "batch_size": size,
+                "throttle_rate": throttle_rate,
+                "seconds": round(elapsed, 4),
+                "stores_per_second": round(size / elapsed, 1),
+                "requests": dynamodb_utils.table.request_counts,
+                "failures": (
+                    len(write_back_result.failures) if write_back_result else None
+                ),
+                "statuses": dynamodb_utils.table.count_by_status(),
+            }
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the single item writes rejected with a throughput exceeded error",
+    )
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.throttle_rate)
@@ -0,0 +1,260 @@
+"""Offline end-to-end benchmark of the pipeline, with local stand-ins for every external service
+
+Usage: python benchmarks/bench_pipeline.py [--sizes 100 1000 10000 50000] [--stages read lookup handler] [--output results.json]
+
+Runs every stage of the pipeline (and lambda_handler end to end, in both pipeline modes) against:
+  - a local Places searchText server with a token bucket 429 model and a log-normal latency (local_places_api.py)
+  - an in-memory DynamoDB stores table with the 1MB pagination and a latency model (local_dynamodb.py)
+  - a fake gspread client, workbook and worksheet counting the round-trips (local_google_sheets.py)
+  - a fake Slack WebClient (local_slack.py)
+and reports the throughput, the p50/p95/p99 latency of the Places lookups, the number of requests and retries, and the
+peak memory of every scenario as JSON, so that the results of two commits can be compared to catch regressions.
+
+The rate limit defaults to 60000 requests per minute (100 times the real one) so that the large batch sizes finish in
+minutes, the rate of the client and the quota of the server can be set separately with --client-rpm and --server-rpm.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Get the src directory of the project and add it to sys.path, same as in src/slack_bot/bot.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from local_dynamodb import make_local_stores_table
+from local_google_sheets import LocalGoogleSheetsAPI
+from local_places_api import LocalPlacesAPI
+from local_slack import LocalSlackWebClient
+
+STAGES = ["read", "lookup", "sheet", "file", "slack", "write_back", "handler"]
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def _configure_environment(args, places_api: LocalPlacesAPI):
+    # These are read by the modules of the pipeline when they're imported, so they're set before importing them
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["GOOGLE_PLACES_API_KEY"] = "local-benchmark-key"
+    os.environ["PLACES_API_URL"] = places_api.url
+    os.environ["PLACES_MAX_REQUESTS_PER_MINUTE"] = str(args.client_rpm)
+    os.environ["PLACES_CACHE_BACKEND"] = args.cache
+    # the batches of the benchmark go way past the requests of the free credits
+    os.environ["PLACES_BUDGET_BACKEND"] = "none"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+class PipelineBenchmark:
+    """Wires the modules of the pipeline to the local stand-ins and runs the scenarios"""
+
+    def __init__(self, args, places_api: LocalPlacesAPI):
+        import main
+        import google_places_api
+        import utils.dynamodb_utils as dynamodb_utils
+        import utils.google_sheet_utils as google_sheet_utils
+        import utils.file_export_utils as file_export_utils
+        import slack_bot.bot as bot
+        import utils.places_cache as places_cache
+
+        self.args = args
+        self.places_api = places_api
+        self.sheets_api = LocalGoogleSheetsAPI(
+            base_latency=args.sheets_latency,
+            latency_per_cell=args.sheets_latency_per_cell,
+        )
+        self.main = main
+        self.google_places_api = google_places_api
+        self.dynamodb_utils = dynamodb_utils
+        self.google_sheet_utils = google_sheet_utils
+        self.file_export_utils = file_export_utils
+        self.bot = bot
+        self.places_cache = places_cache
+
+        # Google Sheets: no credentials to fetch, and a fake gspread client
+        google_sheet_utils._get_gspread_client = self.sheets_api.authorize
+        # the sheets are copies of a template rather than blank sheets formatted by every run
+        if args.sheet_template:
+            google_sheet_utils.GOOGLE_SHEET_TEMPLATE_ID = "local-template"
+            # the copies inherit the sharing of their folder
+            os.environ["GOOGLE_DRIVE_FOLDER_ID"] = "local-folder"
+
+        # gspread is imported lazily by the first export, which would otherwise bill its second or so of import time to
+        # whichever handler scenario runs first (the streaming one), skewing the comparison of the pipeline modes
+        import gspread.exceptions  # noqa: F401
+
+        # Slack
+        LocalSlackWebClient.latency = args.slack_latency
+        bot._get_slack_client = lambda token: LocalSlackWebClient(token=token)
+
+        # Places: measure the latency of every lookup as seen by the pipeline, including the rate limiting and retries
+        self.lookup_latencies = []
+        lookup = google_places_api.get_phone_number_from_google_maps
+
+        async def _timed_lookup(*lookup_args, **lookup_kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await lookup(*lookup_args, **lookup_kwargs)
+            finally:
+                self.lookup_latencies.append(time.perf_counter() - start_time)
+
+        google_places_api.get_phone_number_from_google_maps = _timed_lookup
+
+    def _reset(self, size: int):
+        self.dynamodb_utils.table = make_local_stores_table(
+            size,
+            base_latency=self.args.dynamodb_latency,
+            throttle_rate=self.args.dynamodb_throttle_rate,
+        )
+        self.places_api.reset_counters()
+        self.sheets_api.reset_counters()
+        self.places_cache._places_cache = None
+        LocalSlackWebClient.sent_messages = []
+        self.lookup_latencies = []
+        self.main.ITEMS_PER_BATCH = size
+
+    def _stores_with_phone_numbers(self, size: int):
+        stores = self.dynamodb_utils.get_batch_of_unprocessed_stores(limit=size)
+        for store in stores:
+            store.phone_number = "+44 20 7946 0000"
+        return stores
+
+    def run_scenario(self, stage: str, size: int, pipeline_mode: str = None) -> dict:
+        self._reset(size)
+
+        # inputs of the stages that need the output of the previous ones are prepared outside of the measurement
+        stores = None
+        if stage == "lookup":
+            stores = self.dynamodb_utils.get_batch_of_unprocessed_stores(limit=size)
+        elif stage in ("sheet", "file", "write_back"):
+            stores = self._stores_with_phone_numbers(size)
+        self.dynamodb_utils.table.request_counts = {}
+
+        tracemalloc.start()
+        start_time = time.perf_counter()
+
+        if stage == "read":
+            stores = self.dynamodb_utils.get_batch_of_stores_to_process(limit=size)
+        elif stage == "lookup":
+            self.google_places_api.get_phone_numbers_for_batch_of_stores(stores)
+        elif stage == "sheet":
+            self.google_sheet_utils.populate_google_sheet(stores)
+        elif stage == "file":
+            with tempfile.TemporaryDirectory() as export_dir:
+                self.file_export_utils.export_stores_to_file(stores, "csv", export_dir)
+        elif stage == "slack":
+            self.bot.send_fetched_phone_numbers_to_slack_channel("https://example.com")
+        elif stage == "write_back":
+            self.dynamodb_utils.update_status_of_items_to_processed_in_DB(stores)
+        elif stage == "handler":
+            self.main.lambda_handler({"pipeline_mode": pipeline_mode}, None)
+
+        elapsed = time.perf_counter() - start_time
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies = sorted(self.lookup_latencies)
+        return {
+            "benchmark": "pipeline",
+            "stage": stage,
+            "pipeline_mode": pipeline_mode,
+            "batch_size": size,
+            "seconds": round(elapsed, 4),
+            "stores_per_second": round(size / elapsed, 1),
+            "places_lookup_latency_seconds": {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "p99": _percentile(latencies, 99),
+            },
+            "places_requests": self.places_api.request_count,
+            "places_429_responses": self.places_api.rate_limited_count,
+            "places_5xx_responses": self.places_api.server_error_count,
+            "places_retries": max(0, self.places_api.request_count - len(latencies)),
+            "dynamodb_requests": self.dynamodb_utils.table.request_counts,
+            "sheets_requests": self.sheets_api.request_counts,
+            "slack_messages": len(LocalSlackWebClient.sent_messages),
+            "peak_memory_bytes": peak_memory,
+        }
+
+
+def run_benchmark(args) -> dict:
+    places_api = LocalPlacesAPI(
+        requests_per_minute=args.server_rpm,
+        burst=args.server_burst,
+        median_latency=args.places_latency,
+        latency_sigma=args.places_latency_sigma,
+        server_error_rate=args.places_error_rate,
+    ).start()
+
+    try:
+        _configure_environment(args, places_api)
+        benchmark = PipelineBenchmark(args, places_api)
+
+        results = []
+        for size in args.sizes:
+            for stage in args.stages:
+                pipeline_modes = (
+                    ["streaming", "staged"] if stage == "handler" else [None]
+                )
+                for pipeline_mode in pipeline_modes:
+                    result = benchmark.run_scenario(stage, size, pipeline_mode)
+                    print(json.dumps(result), flush=True)
+                    results.append(result)
+    finally:
+        places_api.stop()
+
+    return {
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000]
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument(
+        "--output", help="path of the JSON file to write the results to"
+    )
+    parser.add_argument("--cache", default="none", choices=["none", "memory"])
+    parser.add_argument("--client-rpm", type=int, default=60000)
+    parser.add_argument("--server-rpm", type=int, default=60000)
+    parser.add_argument("--server-burst", type=int, default=50)
+    parser.add_argument(
+        "--places-latency", type=float, default=0.15, help="median, in seconds"
+    )
+    parser.add_argument("--places-latency-sigma", type=float, default=0.5)
+    parser.add_argument("--places-error-rate", type=float, default=0.0)
+    parser.add_argument("--dynamodb-latency", type=float, default=0.01)
+    parser.add_argument("--dynamodb-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.3)
+    parser.add_argument("--sheets-latency-per-cell", type=float, default=0.00002)
+    parser.add_argument(
+        "--sheet-template",
+        action="store_true",
+        help="copy a template spreadsheet for every sheet, as with GOOGLE_SHEET_TEMPLATE_ID",
+    )
+    parser.add_argument("--slack-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    if args.output:
+        with open(args.output, mode="w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
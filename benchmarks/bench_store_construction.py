@@ -0,0 +1,89 @@
+"""Compares the cost of building Store objects from DynamoDB items and of serializing them
+
+Usage: python benchmarks/bench_store_construction.py [--sizes 1000 150000] [--repeat 3]
+Prints one JSON line per (step, batch size) with the best CPU time of the repeats for every variant of the step.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+# Get the src directory of the project and add it to sys.path, same as in src/slack_bot/bot.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from local_dynamodb import make_store_item
+from models.store import Store
+from utils.common_utils import transform_stores_list_to_sheet_row_format
+
+
+def _best_cpu_time(function, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.process_time()
+        function()
+        times.append(time.process_time() - start_time)
+    return round(min(times), 4)
+
+
+def _construction_variants(items):
+    return {
+        "model_validate_per_item": lambda: [
+            Store.from_dynamodb_item(item) for item in items
+        ],
+        "model_construct_per_item": lambda: [
+            Store.model_construct(**item) for item in items
+        ],
+        "validate_page_at_once": lambda: Store.from_dynamodb_items(items),
+    }
+
+
+def _serialization_variants(stores):
+    def _sheet_rows():
+        # populate_google_sheet reads the URL of every store for the hyperlinks, then again for the rows
+        hyperlinks = [store.google_maps_url for store in stores]
+        return hyperlinks, transform_stores_list_to_sheet_row_format(stores)
+
+    return {
+        "sheet_rows": _sheet_rows,
+        "dynamodb_items": lambda: [
+            store.to_dynamodb_item("fetched") for store in stores
+        ],
+    }
+
+
+def run_benchmark(sizes, repeat):
+    results = []
+    for size in sizes:
+        items = [make_store_item(i, "pending") for i in range(size)]
+
+        stores = Store.from_dynamodb_items(items)
+
+        for step, variants in (
+            ("construction", _construction_variants(items)),
+            ("serialization", _serialization_variants(stores)),
+        ):
+            result = {
+                "benchmark": "store_construction",
+                "step": step,
+                "batch_size": size,
+                "cpu_seconds": {
+                    name: _best_cpu_time(variant, repeat)
+                    for name, variant in variants.items()
+                },
+            }
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 150000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmark(args.sizes, args.repeat)
@@ -0,0 +1,508 @@
+import bisect
+import copy
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+# In-memory stand-in for the boto3 Table resource of the stores table, used by the benchmarks to run the DynamoDB code
+# of the pipeline without an AWS account. It models what matters for performance: the 1MB cap on the size of the
+# responses, the pagination with LastEvaluatedKey, and a latency that grows with the size of the response.
+# Only the subset of the expression syntax used by the pipeline is supported.
+
+MAX_RESPONSE_BYTES = 1024 * 1024
+
+
+class LocalDynamoDBTable:
+    """In-memory stand-in for a DynamoDB Table resource, with a status-index GSI"""
+
+    def __init__(
+        self,
+        hash_key: str = "store_id",
+        base_latency: float = 0.01,
+        latency_per_kb: float = 0.0002,
+        latency_per_item_written: float = 0.002,
+        throttle_rate: float = 0.0,
+        name: str = "UberEats_scraped_stores_data",
+    ):
+        self.name = name
+        self.hash_key = hash_key
+        self.base_latency = base_latency  # seconds per request
+        self.latency_per_kb = latency_per_kb  # seconds per KB of data returned
+        self.latency_per_item_written = (
+            latency_per_item_written  # seconds per item written by the request
+        )
+        self.throttle_rate = throttle_rate  # fraction of the writes rejected with a throughput exceeded error
+        # the low-level client of a boto3 resource, reached by the code through table.meta.client
+        self.meta = SimpleNamespace(client=_LocalClient(self))
+        self.request_counts: Dict[str, int] = {}
+
+        self._items: Dict[str, dict] = {}
+        self._item_sizes: Dict[str, int] = {}
+        # status -> sorted list of the keys of the items with that status, the partitions of the status-index GSI
+        self._status_index: Dict[str, List[str]] = {}
+        self._lock = threading.RLock()
+
+    # --------------------------------------------------------------------------------------------------------------
+    # helpers
+
+    def _maybe_throttle(self, operation: str):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            self._simulate_latency("throttled")
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ProvisionedThroughputExceededException",
+                        "Message": "The level of configured provisioned throughput for the table was exceeded",
+                    }
+                },
+                operation,
+            )
+
+    def _check_condition(
+        self,
+        condition: Optional[str],
+        item: Optional[dict],
+        attribute_names: dict,
+        values: dict,
+    ):
+        if condition and not evaluate_condition(
+            condition, item or {}, attribute_names, values
+        ):
+            raise ClientError(
+                {
+                    "Error": {
+                        "Code": "ConditionalCheckFailedException",
+                        "Message": "The conditional request failed",
+                    }
+                },
+                "ConditionCheck",
+            )
+
+    def _simulate_latency(
+        self, operation: str, response_bytes: int = 0, items_written: int = 0
+    ):
+        with self._lock:
+            self.request_counts[operation] = self.request_counts.get(operation, 0) + 1
+        # time.sleep() releases the GIL, so concurrent requests from different threads overlap like real ones
+        time.sleep(
+            self.base_latency
+            + response_bytes / 1024 * self.latency_per_kb
+            + items_written * self.latency_per_item_written
+        )
+
+    def _index_item(self, key: str, item: Optional[dict]):
+        old_item = self._items.get(key)
+        if old_item is not None and "status" in old_item:
+            keys = self._status_index[old_item["status"]]
+            keys.pop(bisect.bisect_left(keys, key))
+
+        if item is None:
+            self._items.pop(key, None)
+            self._item_sizes.pop(key, None)
+            return
+
+        self._items[key] = item
+        self._item_sizes[key] = len(json.dumps(item, default=str))
+        if "status" in item:
+            bisect.insort(self._status_index.setdefault(item["status"], []), key)
+
+    @staticmethod
+    def _resolve_name(name: str, attribute_names: dict) -> str:
+        return attribute_names.get(name, name)
+
+    def _project(self, item: dict, projection: Optional[str], attribute_names: dict):
+        if not projection:
+            return copy.deepcopy(item)
+        attributes = [
+            self._resolve_name(name.strip(), attribute_names)
+            for name in projection.split(",")
+        ]
+        return {
+            attribute: copy.deepcopy(item[attribute])
+            for attribute in attributes
+            if attribute in item
+        }
+
+    def _parse_equality(self, expression: str, attribute_names: dict, values: dict):
+        # supports the "<name> = <value>" expressions used by the pipeline
+        name, value = [part.strip() for part in expression.split("=")]
+        return self._resolve_name(name, attribute_names), values[value]
+
+    def _paginate(
+        self,
+        keys: List[str],
+        limit: Optional[int],
+        projection: Optional[str],
+        attribute_names: dict,
+        matches=None,
+    ) -> dict:
+        items = []
+        response_bytes = 0
+        evaluated = 0
+        last_key = None
+
+        for key in keys:
+            if limit is not None and evaluated >= limit:
+                break
+            if response_bytes + self._item_sizes[key] > MAX_RESPONSE_BYTES:
+                break
+            evaluated += 1
+            last_key = key
+            response_bytes += self._item_sizes[key]
+
+            item = self._items[key]
+            if matches is None or matches(item):
+                items.append(self._project(item, projection, attribute_names))
+
+        response = {"Items": items, "Count": len(items), "ScannedCount": evaluated}
+        if last_key is not None and evaluated < len(keys):
+            response["LastEvaluatedKey"] = {self.hash_key: last_key}
+        return response, response_bytes
+
+    # --------------------------------------------------------------------------------------------------------------
+    # Table API
+
+    def query(
+        self,
+        KeyConditionExpression: str,
+        ExpressionAttributeValues: dict,
+        ExpressionAttributeNames: Optional[dict] = None,
+        IndexName: Optional[str] = None,
+        Limit: Optional[int] = None,
+        ExclusiveStartKey: Optional[dict] = None,
+        ProjectionExpression: Optional[str] = None,
+        FilterExpression: Optional[str] = None,
+        Select: Optional[str] = None,
+        **kwargs,
+    ) -> dict:
+        attribute_names = ExpressionAttributeNames or {}
+        attribute, value = self._parse_equality(
+            KeyConditionExpression, attribute_names, ExpressionAttributeValues
+        )
+        if IndexName != "status-index" or attribute != "status":
+            raise NotImplementedError("Only queries on the status-index are supported")
+        matches = None
+        if FilterExpression:
+            matches = lambda item: evaluate_condition(
+                FilterExpression, item, attribute_names, ExpressionAttributeValues
+            )
+
+        with self._lock:
+            keys = self._status_index.get(value, [])
+            if ExclusiveStartKey:
+                keys = keys[
+                    bisect.bisect_right(keys, ExclusiveStartKey[self.hash_key]) :
+                ]
+            response, response_bytes = self._paginate(
+                keys, Limit, ProjectionExpression, attribute_names, matches
+            )
+        if Select == "COUNT":
+            del response["Items"]
+
+        self._simulate_latency("query", response_bytes)
+        return response
+
+    def scan(
+        self,
+        FilterExpression: Optional[str] = None,
+        ExpressionAttributeValues: Optional[dict] = None,
+        ExpressionAttributeNames: Optional[dict] = None,
+        Segment: int = 0,
+        TotalSegments: int = 1,
+        Limit: Optional[int] = None,
+        ExclusiveStartKey: Optional[dict] = None,
+        ProjectionExpression: Optional[str] = None,
+        **kwargs,
+    ) -> dict:
+        attribute_names = ExpressionAttributeNames or {}
+        matches = None
+        if FilterExpression:
+            attribute, value = self._parse_equality(
+                FilterExpression, attribute_names, ExpressionAttributeValues
+            )
+            matches = lambda item: item.get(attribute) == value
+
+        with self._lock:
+            # the items are split into the segments by the hash of their key, like the real service
+            keys = sorted(
+                key
+                for key in self._items
+                if zlib.crc32(key.encode()) % TotalSegments == Segment
+            )
+            if ExclusiveStartKey:
+                keys = keys[
+                    bisect.bisect_right(keys, ExclusiveStartKey[self.hash_key]) :
+                ]
+            response, response_bytes = self._paginate(
+                keys, Limit, ProjectionExpression, attribute_names, matches
+            )
+
+        self._simulate_latency("scan", response_bytes)
+        return response
+
+    def update_item(
+        self,
+        Key: dict,
+        UpdateExpression: str,
+        ExpressionAttributeValues: Optional[dict] = None,
+        ExpressionAttributeNames: Optional[dict] = None,
+        ConditionExpression: Optional[str] = None,
+        **kwargs,
+    ) -> dict:
+        attribute_names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        self._maybe_throttle("UpdateItem")
+
+        with self._lock:
+            key = Key[self.hash_key]
+            item = copy.deepcopy(self._items.get(key, dict(Key)))
+            self._check_condition(
+                ConditionExpression, self._items.get(key), attribute_names, values
+            )
+
+            # supports the "SET <name> = <value>, ... [ADD <name> <value>, ...] [REMOVE <name>, ...]" expressions used
+            # by the pipeline
+            clauses = re.split(r"\b(SET|ADD|REMOVE)\s", UpdateExpression.strip())
+            for action, clause in zip(clauses[1::2], clauses[2::2]):
+                for operand in filter(
+                    None, (part.strip() for part in clause.split(","))
+                ):
+                    if action == "SET":
+                        name, value = [part.strip() for part in operand.split("=")]
+                        item[self._resolve_name(name, attribute_names)] = copy.deepcopy(
+                            values[value]
+                        )
+                    elif action == "ADD":
+                        name, value = operand.split()
+                        name = self._resolve_name(name, attribute_names)
+                        item[name] = item.get(name, 0) + values[value]
+                    else:
+                        item.pop(self._resolve_name(operand, attribute_names), None)
+            self._index_item(key, item)
+
+        self._simulate_latency("update_item", items_written=1)
+        return {}
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        with self._lock:
+            item = self._items.get(Key[self.hash_key])
+            item = copy.deepcopy(item)
+        self._simulate_latency("get_item")
+        return {"Item": item} if item is not None else {}
+
+    def put_item(
+        self,
+        Item: dict,
+        ConditionExpression: Optional[str] = None,
+        ExpressionAttributeValues: Optional[dict] = None,
+        ExpressionAttributeNames: Optional[dict] = None,
+        **kwargs,
+    ) -> dict:
+        self._maybe_throttle("PutItem")
+        with self._lock:
+            self._check_condition(
+                ConditionExpression,
+                self._items.get(Item[self.hash_key]),
+                ExpressionAttributeNames or {},
+                ExpressionAttributeValues or {},
+            )
+            self._index_item(Item[self.hash_key], copy.deepcopy(Item))
+        self._simulate_latency("put_item", items_written=1)
+        return {}
+
+    def delete_item(self, Key: dict, **kwargs) -> dict:
+        with self._lock:
+            self._index_item(Key[self.hash_key], None)
+        self._simulate_latency("delete_item", items_written=1)
+        return {}
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _LocalBatchWriter(self)
+
+    # --------------------------------------------------------------------------------------------------------------
+    # benchmark helpers
+
+    def get_all_items(self) -> List[dict]:
+        with self._lock:
+            return copy.deepcopy(list(self._items.values()))
+
+    def get_request_counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.request_counts)
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            return {status: len(keys) for status, keys in self._status_index.items()}
+
+
+class _LocalClient:
+    """Routes the calls made to the low-level client (with TableName=...) to the table"""
+
+    def __init__(self, table: LocalDynamoDBTable):
+        self.table = table
+
+    def update_item(self, TableName: str, **kwargs) -> dict:
+        return self.table.update_item(**kwargs)
+
+    def put_item(self, TableName: str, **kwargs) -> dict:
+        return self.table.put_item(**kwargs)
+
+    def get_item(self, TableName: str, **kwargs) -> dict:
+        return self.table.get_item(**kwargs)
+
+
+_TOKEN_PATTERN = re.compile(r"\s*(<=|>=|<>|[=<>(),]|[#:]?[\w./-]+)")
+_COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+}
+
+
+def evaluate_condition(
+    expression: str, item: dict, attribute_names: dict, values: dict
+) -> bool:
+    """Evaluates a DynamoDB condition expression against an item
+
+    Supports comparisons, IN, AND, OR, NOT, parentheses, attribute_exists() and attribute_not_exists()
+    """
+    tokens = _TOKEN_PATTERN.findall(expression)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take(expected=None):
+        nonlocal position
+        token = tokens[position]
+        if expected is not None and token.upper() != expected:
+            raise ValueError(f"Expected {expected} in {expression!r}, got {token!r}")
+        position += 1
+        return token
+
+    def operand():
+        token = take()
+        if token.startswith(":"):
+            return values[token]
+        return item.get(attribute_names.get(token, token))
+
+    def primary():
+        token = peek()
+        if token == "(":
+            take("(")
+            result = disjunction()
+            take(")")
+            return result
+        if token.upper() == "NOT":
+            take()
+            return not primary()
+        if token in ("attribute_exists", "attribute_not_exists"):
+            take()
+            take("(")
+            name = take()
+            take(")")
+            exists = attribute_names.get(name, name) in item
+            return exists if token == "attribute_exists" else not exists
+
+        left = operand()
+        operator = take()
+        if operator.upper() == "IN":
+            take("(")
+            candidates = [operand()]
+            while peek() == ",":
+                take(",")
+                candidates.append(operand())
+            take(")")
+            return left in candidates
+        return _COMPARISONS[operator](left, operand())
+
+    def conjunction():
+        result = primary()
+        while peek() is not None and peek().upper() == "AND":
+            take()
+            result = primary() and result
+        return result
+
+    def disjunction():
+        result = conjunction()
+        while peek() is not None and peek().upper() == "OR":
+            take()
+            result = conjunction() or result
+        return result
+
+    return disjunction()
+
+
+class _LocalBatchWriter:
+    """Buffers the puts and deletes in batches of 25 items, like the batch_writer() of boto3"""
+
+    BATCH_SIZE = 25
+
+    def __init__(self, table: LocalDynamoDBTable):
+        self.table = table
+        self._buffer = []
+
+    def put_item(self, Item: dict):
+        self._buffer.append((Item[self.table.hash_key], copy.deepcopy(Item)))
+        if len(self._buffer) >= self.BATCH_SIZE:
+            self._flush()
+
+    def delete_item(self, Key: dict):
+        self._buffer.append((Key[self.table.hash_key], None))
+        if len(self._buffer) >= self.BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        with self.table._lock:
+            for key, item in self._buffer:
+                self.table._index_item(key, item)
+        self.table._simulate_latency(
+            "batch_write_item", items_written=len(self._buffer)
+        )
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._flush()
+        return False
+
+
+def make_store_item(i: int, status: str = "pending") -> dict:
+    """Returns a store item shaped like the ones uploaded by deployment/scripts/upload_dataset_to_dynamodb.py"""
+    rng = random.Random(i)
+    # ~1 in 5 stores is a chain or a duplicate listing, sharing its name and address with another store
+    name_id = rng.randrange(max(1, i // 5) + 1) if rng.random() < 0.2 else i
+    return {
+        "store_id": f"store-{i:08d}",
+        "name": f"Store {name_id}",
+        "address": f"{name_id} High Street, London, England E1 {name_id % 10}AA",
+        "rating": f"{rng.uniform(3, 5):.1f}",
+        "description": "Burgers • Fast Food • " + "x" * rng.randrange(50, 250),
+        "area/city": "London",
+        "phone_number": None,
+        "status": status,
+        "last_processed_at": None,
+    }
+
+
+def make_local_stores_table(num_of_stores: int, **kwargs) -> LocalDynamoDBTable:
+    table = LocalDynamoDBTable(**kwargs)
+    # seeding doesn't go through the latency model
+    for i in range(num_of_stores):
+        item = make_store_item(i)
+        table._index_item(item["store_id"], item)
+    return table
@@ -0,0 +1,113 @@
+import itertools
+import time
+
+# Local stand-ins for the gspread client, workbook and worksheet used by src/utils/google_sheet_utils.py. Every call
+# that would be an HTTP round-trip to the Google APIs sleeps for a base latency plus a time proportional to the number
+# of cells it sends, and is counted, so the benchmarks can compare the number of round-trips of the sheet stage.
+
+_spreadsheet_ids = itertools.count()
+
+
+class LocalGoogleSheetsAPI:
+    """Holds the latency model and the counters shared by the fake client, workbooks and worksheets"""
+
+    def __init__(self, base_latency: float = 0.3, latency_per_cell: float = 0.00002):
+        self.base_latency = base_latency
+        self.latency_per_cell = latency_per_cell
+        self.request_counts = {}
+        self.cells_written = 0
+        self.workbooks = []
+
+    def round_trip(self, method: str, cells: int = 0):
+        self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        self.cells_written += cells
+        time.sleep(self.base_latency + cells * self.latency_per_cell)
+
+    def authorize(self, credentials=None) -> "LocalGoogleSheetsClient":
+        return LocalGoogleSheetsClient(self)
+
+    def reset_counters(self):
+        self.request_counts = {}
+        self.cells_written = 0
+        self.workbooks = []
+
+
+class LocalGoogleSheetsClient:
+    def __init__(self, api: LocalGoogleSheetsAPI):
+        self.api = api
+
+    # Like gspread, create() and copy() open the new spreadsheet by its key once the Drive request returns it, which is a
+    # second round-trip to fetch its metadata
+    def create(self, title: str, folder_id=None) -> "LocalWorkbook":
+        self.api.round_trip("create")
+        self.api.round_trip("open_by_key")
+        workbook = LocalWorkbook(self.api, title)
+        self.api.workbooks.append(workbook)
+        return workbook
+
+    def copy(
+        self, file_id: str, title=None, copy_permissions=False, folder_id=None, **kwargs
+    ):
+        self.api.round_trip("copy")
+        self.api.round_trip("open_by_key")
+        workbook = LocalWorkbook(self.api, title)
+        self.api.workbooks.append(workbook)
+        return workbook
+
+    def open_by_key(self, key: str) -> "LocalWorkbook":
+        self.api.round_trip("open_by_key")
+        return LocalWorkbook(self.api, key)
+
+
+class LocalWorkbook:
+    def __init__(self, api: LocalGoogleSheetsAPI, title: str):
+        self.api = api
+        self.title = title
+        self.id = f"local-spreadsheet-{next(_spreadsheet_ids)}"
+        self.sheet = LocalWorksheet(api)
+
+    @property
+    def url(self) -> str:
+        return f"https://docs.google.com/spreadsheets/d/{self.id}"
+
+    def share(self, email_address, perm_type, role, **kwargs):
+        self.api.round_trip("share")
+
+    def worksheet(self, title: str) -> "LocalWorksheet":
+        self.api.round_trip("worksheet")
+        return self.sheet
+
+    def get_worksheet(self, index: int) -> "LocalWorksheet":
+        self.api.round_trip("worksheet")
+        return self.sheet
+
+    @property
+    def sheet1(self) -> "LocalWorksheet":
+        return self.get_worksheet(0)
+
+    def batch_update(self, body: dict) -> dict:
+        cells = 0
+        for request in body.get("requests", []):
+            for row in request.get("updateCells", {}).get("rows", []):
+                cells += len(row.get("values", []))
+            for row in request.get("appendCells", {}).get("rows", []):
+                cells += len(row.get("values", []))
+        self.api.round_trip("batch_update", cells)
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+
+class LocalWorksheet:
+    def __init__(self, api: LocalGoogleSheetsAPI):
+        self.api = api
+        self.id = 0
+        self.row_count = 1000
+        self.col_count = 26
+
+    def update(self, values, range_name=None, raw=True, **kwargs):
+        self.api.round_trip("update", sum(len(row) for row in values))
+
+    def append_rows(self, values, **kwargs):
+        self.api.round_trip("append_rows", sum(len(row) for row in values))
+
+    def batch_format(self, formats):
+        self.api.round_trip("batch_format")
@@ -0,0 +1,134 @@
+import asyncio
+import random
+import threading
+import time
+from typing import List, Optional
+
+from aiohttp import web
+
+# Local stand-in for the searchText method of the Places API (new), used by the benchmarks. The rate limiting is modelled
+# as a token bucket on the server side (a request without a token gets a 429), and the latency of the responses follows
+# a log-normal distribution, which has the long right tail of real API latencies.
+
+
+class LocalPlacesAPI:
+    """Serves a fake places:searchText endpoint on localhost from a background thread"""
+
+    def __init__(
+        self,
+        requests_per_minute: int = 600,
+        burst: int = 50,
+        median_latency: float = 0.15,
+        latency_sigma: float = 0.5,
+        no_results_rate: float = 0.1,
+        server_error_rate: float = 0.0,
+        seed: Optional[int] = 0,
+        port: int = 0,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst
+        self.median_latency = median_latency  # seconds
+        self.latency_sigma = latency_sigma  # sigma of the log of the latency
+        self.no_results_rate = no_results_rate
+        self.server_error_rate = server_error_rate
+        self.port = port
+
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.server_error_count = 0
+        self.latencies: List[float] = []
+
+        self._random = random.Random(seed)
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._loop = None
+        self._runner = None
+        self._started = threading.Event()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1/places:searchText"
+
+    def _take_token(self) -> bool:
+        now = time.monotonic()
+        rate = self.requests_per_minute / 60
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * rate)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def _search_text(self, request: web.Request) -> web.Response:
+        self.request_count += 1
+        if request.headers.get("X-Goog-Api-Key") is None:
+            return web.json_response({"error": {"code": 403}}, status=403)
+
+        if not self._take_token():
+            self.rate_limited_count += 1
+            return web.json_response(
+                {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+
+        latency = (
+            self._random.lognormvariate(0, self.latency_sigma) * self.median_latency
+        )
+        self.latencies.append(latency)
+        await asyncio.sleep(latency)
+
+        if self._random.random() < self.server_error_rate:
+            self.server_error_count += 1
+            return web.json_response({"error": {"code": 503}}, status=503)
+
+        if self._random.random() < self.no_results_rate:
+            return web.json_response({})
+
+        query = request.query.get("textQuery", "")
+        phone_number = f"+44 20 {abs(hash(query)) % 10_000:04d} {abs(hash(query[::-1])) % 10_000:04d}"
+        return web.json_response(
+            {"places": [{"internationalPhoneNumber": phone_number}]}
+        )
+
+    def start(self) -> "LocalPlacesAPI":
+        def _serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+
+            app = web.Application()
+            app.router.add_post("/v1/places:searchText", self._search_text)
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+            self._loop.run_until_complete(site.start())
+            self.port = site._server.sockets[0].getsockname()[1]
+            self._started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+
+        self._thread = threading.Thread(target=_serve, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def reset_counters(self):
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.server_error_count = 0
+        self.latencies = []
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
@@ -0,0 +1,18 @@
+import time
+
+# Local stand-in for the Slack WebClient used by src/slack_bot/bot.py, used by the benchmarks
+
+
+class LocalSlackWebClient:
+    """Stand-in for slack_sdk.WebClient, counting the messages it sends"""
+
+    latency = 0.2
+    sent_messages = []
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+
+    def chat_postMessage(self, channel=None, text=None, **kwargs):
+        time.sleep(self.latency)
+        LocalSlackWebClient.sent_messages.append({"channel": channel, "text": text})
+        return {"ok": True, "channel": channel, "ts": str(time.time())}
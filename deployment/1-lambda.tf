@@ -48,7 +48,7 @@ resource "aws_lambda_function" "lambda" {
     handler = "main.lambda_handler"
     runtime = "python3.11"
     layers = [aws_lambda_layer_version.python_site_packages_layer.arn]
-    timeout = 600 # 600 seconds = 10 minutes
+    timeout = 900 # 900 seconds = 15 minutes, the max. The batch is sized by the time left, see src/utils/time_budget.py
     memory_size  = 256 # to be fine-tuned later
     timeouts {
         create = "20m"
@@ -60,6 +60,18 @@ resource "aws_lambda_function" "lambda" {
             LOG_LEVEL = var.LOG_LEVEL
             SLACK_TOKEN = var.SLACK_TOKEN
             SLACK_CHANNEL_ID = var.SLACK_CHANNEL_ID
+            PLACES_CACHE_BACKEND = "dynamodb"
+            PLACES_CACHE_TABLE = aws_dynamodb_table.places_cache.name
+            # the monthly ledger of the Places API requests is kept in the stores table
+            PLACES_BUDGET_BACKEND = "dynamodb"
+            PLACES_MONTHLY_SPEND_CEILING_USD = var.PLACES_MONTHLY_SPEND_CEILING_USD
+            # "sheet" or "file", the files are uploaded to the exports bucket, see 5-s3_exports.tf
+            EXPORT_SINK = var.EXPORT_SINK
+            # the sheets are copies of this template when it's set, see src/utils/google_sheet_utils.py
+            GOOGLE_SHEET_TEMPLATE_ID = var.GOOGLE_SHEET_TEMPLATE_ID
+            EXPORT_FILE_DESTINATION = "s3://${aws_s3_bucket.store_leads_exports.bucket}/exports"
+            # only written by the invocations with "profile": true in their event
+            PROFILING_OUTPUT_DIR = "s3://${aws_s3_bucket.store_leads_exports.bucket}/profiles"
         }
     }
 }
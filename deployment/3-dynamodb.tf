@@ -1,7 +1,9 @@
 # For storing the store data in DynamoDB
 resource "aws_dynamodb_table" "scraped_stores_data"{
     name = "UberEats_scraped_stores_data"
-    billing_mode = "PROVISIONED"
+    # On-demand capacity: the table is idle most of the time and then written in bursts by the write-back of a batch,
+    # which the 5 provisioned WCU used to throttle (the concurrent write-back would only be throttled harder)
+    billing_mode = "PAY_PER_REQUEST"
     hash_key = "store_id"
 
     attribute {
@@ -17,12 +19,31 @@ resource "aws_dynamodb_table" "scraped_stores_data"{
         name = "status-index"
         hash_key = "status"
         projection_type = "ALL"
-        read_capacity = 5
-        write_capacity = 5
     }
 
-    read_capacity = 5
-    write_capacity = 5
+    # Only the run checkpoints have this attribute, there's one per run and they're deleted once RUN_CHECKPOINT_TTL_DAYS old
+    ttl {
+        attribute_name = "expires_at"
+        enabled = true
+    }
+}
+
+# For caching the results of the Places API lookups across runs, keyed by the normalized text query of the stores.
+# Entries expire with the native TTL of DynamoDB, which also bounds the size of the table.
+resource "aws_dynamodb_table" "places_cache" {
+    name = "UberEats_places_cache"
+    billing_mode = "PAY_PER_REQUEST"
+    hash_key = "query_key"
+
+    attribute {
+        name = "query_key"
+        type = "S"
+    }
+
+    ttl {
+        attribute_name = "expires_at"
+        enabled = true
+    }
 }
 
 # Give the Lambda function the permission to access the DynamoDB table
@@ -34,13 +55,24 @@ resource "aws_iam_policy" "lambda_dynamodb_policy" {
         Statement = [{
             Effect = "Allow"
             Action = [
+                "dynamodb:GetItem",
                 "dynamodb:PutItem",
+                "dynamodb:UpdateItem",
                 "dynamodb:Query",
                 "dynamodb:BatchWriteItem",
             ]
             # need to explicitly allow access to the table and its GSI status-index
             Resource = [aws_dynamodb_table.scraped_stores_data.arn,
                         "${aws_dynamodb_table.scraped_stores_data.arn}/index/status-index"]
+        },
+        {
+            Effect = "Allow"
+            Action = [
+                "dynamodb:BatchGetItem",
+                "dynamodb:BatchWriteItem",
+                "dynamodb:DeleteItem",
+            ]
+            Resource = [aws_dynamodb_table.places_cache.arn]
         }
         ]
     })
@@ -0,0 +1,62 @@
+# For the batches exported as files instead of Google Sheets (EXPORT_SINK = "file"), see src/utils/file_export_utils.py,
+# and for the profiles of the profiled invocations, see src/utils/profiling.py
+resource "aws_s3_bucket" "store_leads_exports" {
+    bucket = "uber-eats-project-store-leads-exports"
+}
+
+# The bucket stays private, the files are shared in Slack with presigned URLs
+resource "aws_s3_bucket_public_access_block" "store_leads_exports" {
+    bucket = aws_s3_bucket.store_leads_exports.id
+    block_public_acls = true
+    block_public_policy = true
+    ignore_public_acls = true
+    restrict_public_buckets = true
+}
+
+# The leads are sent to Slack every week, the old files aren't needed once they've been downloaded
+resource "aws_s3_bucket_lifecycle_configuration" "store_leads_exports" {
+    bucket = aws_s3_bucket.store_leads_exports.id
+    rule {
+        id = "expire-old-exports"
+        status = "Enabled"
+        filter {
+            prefix = "exports/"
+        }
+        expiration {
+            days = 30
+        }
+    }
+    rule {
+        id = "expire-old-profiles"
+        status = "Enabled"
+        filter {
+            prefix = "profiles/"
+        }
+        expiration {
+            days = 30
+        }
+    }
+}
+
+resource "aws_iam_policy" "lambda_s3_exports_policy" {
+    name = "LambdaS3ExportsPolicy"
+    description = "Allows Lambda to upload the exported files and the profiles, and to presign the URLs to download the files"
+    policy = jsonencode({
+        Version = "2012-10-17"
+        Statement = [{
+            Effect = "Allow"
+            Action = [
+                "s3:PutObject",
+                "s3:GetObject",
+            ]
+            Resource = ["${aws_s3_bucket.store_leads_exports.arn}/exports/*",
+                        "${aws_s3_bucket.store_leads_exports.arn}/profiles/*"]
+        }
+        ]
+    })
+}
+
+resource "aws_iam_role_policy_attachment" "s3_exports_access" {
+    role = aws_iam_role.iam_for_lambda.name # This role is defined in the 1-lambda.tf file
+    policy_arn = aws_iam_policy.lambda_s3_exports_policy.arn
+}
@@ -1,43 +1,262 @@
-import boto3
-from boto3.dynamodb.table import TableResource
+"""Uploads the scraped stores of data/store.csv into the DynamoDB stores table
+
+Usage: python deployment/scripts/upload_dataset_to_dynamodb.py [--csv data/store.csv] [--workers 8] [--start-row 0]
+
+The rows are read as a stream and sent in chunks by a pool of parallel writers, with a bounded number of chunks in
+flight so that the memory stays flat whatever the size of the CSV. The store_id of a store is derived from its content, so running the
+upload again (ex: after a crash, or to add the new rows of an updated CSV) doesn't create duplicates, and the stores
+that are already in the table are left untouched, keeping their status and phone number. A crashed upload can also
+be resumed from the row printed in the progress reports with --start-row.
+"""
+
+import argparse
 import csv
+import itertools
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+import boto3
+
+TABLE_NAME = "UberEats_scraped_stores_data"
+
+# The namespace of the uuid5 store ids, it must never change: the same row would get a different id and be uploaded again
+STORE_ID_NAMESPACE = uuid.UUID("5b0f3c7e-2f5d-4a8e-9a51-7d3c2b6e1f40")
+CSV_COLUMNS = [
+    "store name",
+    "store addresses",
+    "store rating",
+    "store description",
+    "store area/city",
+]
+
+# BatchGetItem accepts up to 100 keys per request, and batch_writer() sends the puts 25 at a time
+ROWS_PER_CHUNK = 100
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.05  # seconds, doubled on every retry
 
-dynamodb = boto3.resource("dynamodb")
-table: TableResource = dynamodb.Table("UberEats_scraped_stores_data")
 
-csv_file_path = "data/store.csv"
+def make_store_id(row: dict) -> str:
+    """The id of a store is a uuid5 of its content, the same row always gets the same id"""
+    # Rows that are identical in every column are duplicate listings of the CSV, they're uploaded once
+    content = "\x1f".join(row[column].strip() for column in CSV_COLUMNS)
+    return str(uuid.uuid5(STORE_ID_NAMESPACE, content))
 
 
-def upload_csv():
+def row_to_item(row: dict) -> dict:
+    return {
+        "store_id": make_store_id(row),
+        "name": str(row["store name"]),
+        "address": str(row["store addresses"]),
+        "rating": str(row["store rating"]),
+        "description": str(row["store description"]),
+        "area/city": str(row["store area/city"]),
+        "phone_number": None,  # Will be updated later
+        "status": "pending",  # Mark as unprocessed
+        "last_processed_at": None,
+    }
+
+
+def iter_chunks_of_rows(
+    csv_file_path: str, start_row: int, shard_index: int, shard_count: int
+):
+    """Yields (row number of the first row, rows) chunks of the CSV, starting at `start_row` (0 is the first row after the header)"""
     with open(csv_file_path, mode="r", encoding="utf-8") as file:
         reader = csv.DictReader(
             (line.replace("\x00", "") for line in file)
         )  # Removes NUL characters
-        count = 0
-        # batch_writer() by default handles buffering and uploading the items in batches, and it
-        # also handles unprocessed items and resends them as needed.
-        with table.batch_writer() as batch:
-            for row in reader:
-                item = {
-                    "store_id": str(
-                        uuid.uuid4()
-                    ),  # Generate unique ID from a space of 2^112 possible UUID. The chance of collision is extremely low
-                    "name": str(row["store name"]),
-                    "address": str(row["store addresses"]),
-                    "rating": str(row["store rating"]),
-                    "description": str(row["store description"]),
-                    "area/city": str(row["store area/city"]),
-                    "phone_number": None,  # Will be updated later
-                    "status": "pending",  # Mark as unprocessed
-                    "last_processed_at": None,
-                }
-                batch.put_item(Item=item)
-                count += 1
-                if count % 1000 == 0:
-                    print(f"Processed {count} items so far")
+        rows = enumerate(itertools.islice(reader, start_row, None), start=start_row)
+        # The chunks are aligned on the row numbers, so that a resumed upload splits the rows the same way. With
+        # several shards (ex: one per machine), every shard uploads its own share of the chunks.
+        for chunk_index, chunk in itertools.groupby(
+            rows, key=lambda numbered_row: numbered_row[0] // ROWS_PER_CHUNK
+        ):
+            if chunk_index % shard_count == shard_index:
+                chunk = list(chunk)
+                yield chunk[0][0], [row for _, row in chunk]
+
+
+# boto3 sessions aren't thread-safe, every writer builds its own resource
+_thread_local = threading.local()
+
+
+def _get_dynamodb_resource():
+    if not hasattr(_thread_local, "dynamodb"):
+        _thread_local.dynamodb = boto3.session.Session().resource("dynamodb")
+    return _thread_local.dynamodb
+
+
+def _get_existing_store_ids(store_ids) -> set:
+    dynamodb = _get_dynamodb_resource()
+    existing_store_ids = set()
+    request_items = {
+        TABLE_NAME: {
+            "Keys": [{"store_id": store_id} for store_id in store_ids],
+            "ProjectionExpression": "store_id",
+        }
+    }
+    for retry_count in range(MAX_RETRIES + 1):
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        existing_store_ids.update(
+            item["store_id"] for item in response["Responses"].get(TABLE_NAME, [])
+        )
+        # the keys that weren't read because of throttling are sent again
+        request_items = response.get("UnprocessedKeys")
+        if not request_items:
+            return existing_store_ids
+        time.sleep(BACKOFF_BASE * 2**retry_count)
+    raise RuntimeError(
+        f"Couldn't read {len(request_items[TABLE_NAME]['Keys'])} keys after {MAX_RETRIES} retries"
+    )
+
+
+def upload_chunk(rows, overwrite: bool) -> int:
+    """Uploads the stores of the rows that aren't in the table yet, returns how many were written"""
+    # the duplicate rows of a chunk are dropped, batch_writer() fails on two puts with the same key in a batch
+    items = {item["store_id"]: item for item in map(row_to_item, rows)}
+    if not overwrite:
+        # Re-uploading a store would reset its status to pending and erase its phone number
+        for store_id in _get_existing_store_ids(list(items)):
+            del items[store_id]
+
+    # batch_writer() by default handles buffering and uploading the items in batches, and it
+    # also handles unprocessed items and resends them as needed.
+    table = _get_dynamodb_resource().Table(TABLE_NAME)
+    with table.batch_writer() as batch:
+        for item in items.values():
+            batch.put_item(Item=item)
+    return len(items)
+
+
+class UploadProgress:
+    """Counts the uploaded rows and the row an interrupted upload can be resumed from"""
+
+    def __init__(self, start_row: int, report_every_seconds: float):
+        self.start_time = time.perf_counter()
+        self.last_report_time = self.start_time
+        self.report_every_seconds = report_every_seconds
+        self.rows_read = 0
+        self.items_written = 0
+        # the chunks finish out of order, every row before the smallest chunk still in flight is uploaded
+        self.chunks_in_flight = set()
+        self.resume_row = start_row
+        self._lock = threading.Lock()
+
+    def start_chunk(self, first_row: int):
+        with self._lock:
+            self.chunks_in_flight.add(first_row)
+
+    def finish_chunk(self, first_row: int, num_of_rows: int, items_written: int):
+        with self._lock:
+            self.chunks_in_flight.discard(first_row)
+            self.resume_row = max(self.resume_row, first_row + num_of_rows)
+            if self.chunks_in_flight:
+                self.resume_row = min(self.chunks_in_flight)
+            self.rows_read += num_of_rows
+            self.items_written += items_written
+
+            now = time.perf_counter()
+            if now - self.last_report_time >= self.report_every_seconds:
+                self.last_report_time = now
+                self.report()
+
+    def report(self, final: bool = False):
+        elapsed = time.perf_counter() - self.start_time
+        rows_per_second = self.rows_read / elapsed if elapsed > 0 else 0
+        message = (
+            f"Uploaded {self.rows_read} rows ({self.items_written} new stores) in {elapsed:.1f} seconds, "
+            f"{rows_per_second:.0f} rows per second"
+        )
+        if not final:
+            message += f". To resume from here: --start-row {self.resume_row}"
+        print(message, flush=True)
+
+
+def upload_csv(
+    csv_file_path: str,
+    workers: int = 8,
+    start_row: int = 0,
+    overwrite: bool = False,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    report_every_seconds: float = 5,
+) -> UploadProgress:
+    progress = UploadProgress(start_row, report_every_seconds)
+    # bounded, so that reading the CSV waits for the writers instead of loading it all in memory
+    in_flight = threading.BoundedSemaphore(2 * workers)
+    errors = Queue()
+
+    def _upload(first_row: int, rows):
+        try:
+            items_written = upload_chunk(rows, overwrite)
+            progress.finish_chunk(first_row, len(rows), items_written)
+        except Exception as e:
+            errors.put((first_row, e))
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for first_row, rows in iter_chunks_of_rows(
+            csv_file_path, start_row, shard_index, shard_count
+        ):
+            if not errors.empty():
+                break
+            in_flight.acquire()
+            progress.start_chunk(first_row)
+            executor.submit(_upload, first_row, rows)
+
+    if not errors.empty():
+        first_row, error = errors.get()
+        progress.report()
+        raise RuntimeError(
+            f"Uploading the chunk starting at row {first_row} failed: {error}"
+        ) from error
+
+    progress.report(final=True)
     print("CSV upload complete!")
+    return progress
 
 
 if __name__ == "__main__":
-    upload_csv()
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--csv", default="data/store.csv", help="path of the CSV file of the stores"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="number of parallel writers"
+    )
+    parser.add_argument(
+        "--start-row",
+        type=int,
+        default=0,
+        help="row to resume from, as printed by the progress reports",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="skip the check for the stores already in the table, only for an empty table",
+    )
+    parser.add_argument("--shard-index", type=int, default=0)
+    parser.add_argument(
+        "--shard-count",
+        type=int,
+        default=1,
+        help="to split the upload between several machines",
+    )
+    parser.add_argument("--report-every-seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    upload_csv(
+        args.csv,
+        workers=args.workers,
+        start_row=args.start_row,
+        overwrite=args.overwrite,
+        shard_index=args.shard_index,
+        shard_count=args.shard_count,
+        report_every_seconds=args.report_every_seconds,
+    )
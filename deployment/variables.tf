@@ -23,4 +23,21 @@ variable "SLACK_CHANNEL_ID" {
   description = "Slack Channel ID"
   type        = string
   sensitive = true
-}
\ No newline at end of file
+}
+variable "PLACES_MONTHLY_SPEND_CEILING_USD" {
+  description = "The most the Places API can be billed in a month on top of the $200 free credits"
+  type        = number
+  default     = 0
+}
+
+variable "EXPORT_SINK" {
+  description = "Where the batches are exported to before being sent to Slack: sheet (Google Sheet) or file (compressed CSV on S3)"
+  type        = string
+  default     = "sheet"
+}
+
+variable "GOOGLE_SHEET_TEMPLATE_ID" {
+  description = "ID of a pre-formatted spreadsheet copied for every batch instead of creating a blank one, empty for blank sheets"
+  type        = string
+  default     = ""
+}
@@ -0,0 +1,222 @@
+"""Works through the whole backlog of pending stores from a local machine or a long-running container
+
+Usage: python src/backfill.py [--rollover 10000] [--export-sink file] [--max-stores N] [--requests-per-minute 600]
+
+The stores go through the same streaming pipeline as the scheduled Lambda runs, in batches of --rollover stores that
+are each exported to their own file (or Google Sheet) and sent to Slack, at the Places API rate limit for as long as
+stores are left. It can be stopped and started again at any time:
+  - Ctrl+C (or SIGTERM) stops claiming stores, finishes the lookups in flight and exports the batch in progress
+  - a second Ctrl+C stops right away: the stores already looked up are kept as "fetched", and all the stores claimed
+    by the batch are picked up by the next runs once their lease expires (LEASE_SECONDS), the fetched ones without
+    being looked up again
+"""
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Optional
+
+# A terminal reads the logs of the backfill rather than CloudWatch, they're set before the logger is configured
+os.environ.setdefault("LOG_FORMAT", "text")
+
+from utils.logger import flush_logs, logger
+
+# The number of stores of every batch, and so of every exported file or sheet
+BACKFILL_ROLLOVER_STORES = int(os.getenv("BACKFILL_ROLLOVER_STORES", 10000))
+BACKFILL_PROGRESS_INTERVAL_SECONDS = float(
+    os.getenv("BACKFILL_PROGRESS_INTERVAL_SECONDS", 5)
+)
+
+
+class BackfillProgress:
+    """Counts the stores the backfill went through, and estimates the time left at the current rate"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.processed = 0  # the stores of the exported batches
+        self.batches = 0
+        # the time budget of the batch in progress, it counts the stores going through its lookups
+        self.batch_time_budget = None
+        self.started_at = time.monotonic()
+
+    @property
+    def current(self) -> int:
+        in_progress = 0
+        if self.batch_time_budget is not None:
+            in_progress = self.batch_time_budget.resolved_count
+        return self.processed + in_progress
+
+    def report(self) -> str:
+        current = self.current
+        elapsed = time.monotonic() - self.started_at
+        rate = current / elapsed if elapsed > 0 else 0
+        left = max(0, self.total - current)
+        eta = _format_seconds(left / rate) if rate else "unknown"
+        percent = 100 * current / self.total if self.total else 100
+        return (
+            f"Backfill: {current}/{self.total} stores ({percent:.1f}%), {self.batches} batches done, "
+            f"{rate:.1f} stores/s, {_format_seconds(elapsed)} elapsed, ETA {eta}"
+        )
+
+
+def _format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def _display_progress(progress: BackfillProgress, stopped: threading.Event):
+    # On a terminal the line is rewritten in place, otherwise (ex: the logs of a container) a line is added every time
+    live = sys.stderr.isatty()
+    while not stopped.wait(BACKFILL_PROGRESS_INTERVAL_SECONDS):
+        if live:
+            sys.stderr.write(f"\r\x1b[K{progress.report()}")
+        else:
+            sys.stderr.write(f"{progress.report()}\n")
+        sys.stderr.flush()
+    sys.stderr.write(f"{progress.report()}\n")
+
+
+class GracefulShutdown:
+    """The first Ctrl+C (or SIGTERM) closes the batch in progress, the second Ctrl+C stops the backfill right away"""
+
+    def __init__(self):
+        self.requested = False
+        self._previous_handlers = {}
+
+    def __enter__(self):
+        # asyncio.run() only installs its own Ctrl+C handler when the default one is set, so this one is kept
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            self._previous_handlers[signal_number] = signal.signal(
+                signal_number, self._handle_signal
+            )
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for signal_number, handler in self._previous_handlers.items():
+            signal.signal(signal_number, handler)
+
+    def _handle_signal(self, signal_number, frame):
+        if self.requested and signal_number == signal.SIGINT:
+            raise KeyboardInterrupt
+        self.requested = True
+        logger.warning(
+            "Stopping the backfill: finishing the lookups in flight and exporting the batch, press Ctrl+C again to "
+            "stop right away (the stores already looked up are kept)"
+        )
+
+    def is_requested(self) -> bool:
+        return self.requested
+
+
+def run_backfill(
+    rollover_size: int = BACKFILL_ROLLOVER_STORES,
+    export_sink: str = "file",
+    max_stores: Optional[int] = None,
+) -> BackfillProgress:
+    """Runs batches of `rollover_size` stores through the pipeline until no store is left or the backfill is stopped"""
+    from main import run_pipeline
+    from utils.dynamodb_utils import count_stores_with_status
+    from utils.metrics import reset_metrics
+    from utils.time_budget import TimeBudget
+
+    # the stores fetched by a backfill or a run that stopped are exported first, without being looked up again
+    fetched_count = count_stores_with_status("fetched")
+    pending_count = count_stores_with_status("pending")
+    total = fetched_count + pending_count
+    if max_stores is not None:
+        total = min(total, max_stores)
+    logger.info(
+        "Backfilling %s stores (%s pending, %s fetched by an earlier run) in batches of %s, exported to a %s",
+        total,
+        pending_count,
+        fetched_count,
+        rollover_size,
+        export_sink,
+    )
+
+    progress = BackfillProgress(total)
+    display_stopped = threading.Event()
+    display = threading.Thread(
+        target=_display_progress, args=(progress, display_stopped), daemon=True
+    )
+    display.start()
+
+    try:
+        with GracefulShutdown() as shutdown:
+            while progress.processed < total and not shutdown.is_requested():
+                batch_size = min(rollover_size, total - progress.processed)
+                # no deadline, the batch ends at its size or when the backfill is stopped
+                time_budget = TimeBudget(
+                    initial_batch_size=batch_size,
+                    max_batch_size=batch_size,
+                    should_stop=shutdown.is_requested,
+                )
+                metrics = reset_metrics()
+                progress.batch_time_budget = time_budget
+                stores = run_pipeline(
+                    "streaming", export_sink, metrics, time_budget=time_budget
+                )
+                progress.batch_time_budget = None
+                progress.processed += len(stores)
+                progress.batches += 1
+
+                if metrics.counters.get("StoppedByPlacesBudget"):
+                    logger.warning(
+                        "The Places API spend ceiling of the month is reached, stopping the backfill"
+                    )
+                    break
+                if not stores:
+                    # the rest is claimed by other runs (or by a backfill stopped right away, until its leases
+                    # expire), or its lookups keep failing
+                    logger.warning("No store could be processed, stopping the backfill")
+                    break
+    finally:
+        display_stopped.set()
+        display.join()
+        flush_logs()
+
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--rollover",
+        type=int,
+        default=BACKFILL_ROLLOVER_STORES,
+        help="number of stores of every batch, and of every exported file or sheet",
+    )
+    parser.add_argument("--export-sink", default="file", choices=["file", "sheet"])
+    parser.add_argument(
+        "--max-stores", type=int, help="stop after this many stores, all by default"
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        help="rate of the Places API requests, PLACES_MAX_REQUESTS_PER_MINUTE by default",
+    )
+    args = parser.parse_args()
+
+    # read by google_places_api when it's imported, on the first batch
+    if args.requests_per_minute:
+        os.environ["PLACES_MAX_REQUESTS_PER_MINUTE"] = str(args.requests_per_minute)
+
+    try:
+        progress = run_backfill(args.rollover, args.export_sink, args.max_stores)
+    except KeyboardInterrupt:
+        logger.warning(
+            "Stopped the backfill right away, run it again to resume from where it stopped"
+        )
+        flush_logs()
+        sys.exit(130)
+    logger.info(
+        "Backfilled %s stores in %s batches", progress.processed, progress.batches
+    )
+    flush_logs()
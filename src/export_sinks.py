@@ -0,0 +1,189 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, List, Optional
+
+from utils.logger import logger
+from utils.metrics import get_metrics
+from models.store import Store
+
+# Every sink has its own timeout, a sink that hangs is reported as failed instead of holding up the others
+SHEET_SINK_TIMEOUT_SECONDS = float(os.getenv("SHEET_SINK_TIMEOUT_SECONDS", 300))
+SLACK_SINK_TIMEOUT_SECONDS = float(os.getenv("SLACK_SINK_TIMEOUT_SECONDS", 30))
+WRITE_BACK_SINK_TIMEOUT_SECONDS = float(
+    os.getenv("WRITE_BACK_SINK_TIMEOUT_SECONDS", 300)
+)
+
+# Where the batch is exported to: "sheet" for a Google Sheet, "file" for a compressed CSV or Parquet file in a local
+# directory or on S3 (see utils/file_export_utils.py), for the batches too large for a sheet. Either way, its link is
+# sent to Slack. Can be overridden per invocation with the "export_sink" field of the event.
+EXPORT_SINK = os.getenv("EXPORT_SINK", "sheet")
+EXPORT_SINKS = ("sheet", "file")
+
+
+class SinkResult:
+    """The outcome of a sink: its return value, or the error it raised (or its timeout)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.value = None
+        self.error: Optional[BaseException] = None
+        self.seconds = 0.0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return f"SinkResult(name={self.name!r}, succeeded={self.succeeded}, seconds={self.seconds:.2f}, error={self.error!r})"
+
+
+class SinkDispatcher:
+    """Runs the output sinks of a batch concurrently, each one in its own thread with its own timeout and error capture"""
+
+    def __init__(self, max_workers: int = 3):
+        # the sinks are blocking clients (gspread, slack_sdk, boto3), so they run in threads
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sink"
+        )
+        self._sinks = {}  # name -> (future, deadline, result)
+
+    def submit(self, name: str, timeout: float, function: Callable, *args: Any):
+        result = SinkResult(name)
+
+        def _run_sink():
+            start_time = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                result.seconds = time.perf_counter() - start_time
+
+        future = self._executor.submit(_run_sink)
+        self._sinks[name] = (future, time.monotonic() + timeout, result)
+
+    def result(self, name: str) -> SinkResult:
+        """Waits for the sink until its timeout, its failure is captured in the result rather than raised"""
+        future, deadline, result = self._sinks[name]
+        try:
+            result.value = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            result.error = TimeoutError(f"The {name} sink timed out")
+            get_metrics().increment("SinkTimeouts")
+        except Exception as e:
+            result.error = e
+
+        if not result.succeeded:
+            get_metrics().increment("SinkFailures")
+            logger.error("The %s sink failed: %r", name, result.error)
+        return result
+
+    def shutdown(self):
+        # a sink that timed out can't be interrupted, its thread is left to finish in the background
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExportResult:
+    def __init__(self, url: Optional[str], sinks: List[SinkResult]):
+        # the URL of the Google Sheet, or the path or URL of the exported file
+        self.url = url
+        self.sinks = sinks
+
+
+def export_stores(
+    stores: List[Store], lease_owner: Optional[str], export_sink: str = EXPORT_SINK
+) -> ExportResult:
+    """Exports the batch to the Google Sheet (or a file) and Slack while the stores are marked processed in DynamoDB
+
+    The write-back doesn't depend on the sheet, so they run side by side and the export takes as long as the slowest
+    of them rather than their sum, and Slack gets the URL of the sheet as soon as it exists. If the sheet or Slack
+    fails, the stores that were marked processed are moved back to fetched so that the next run exports them, and
+    the error is raised.
+    """
+    if export_sink not in EXPORT_SINKS:
+        raise ValueError(f"Unknown export sink: {export_sink}")
+
+    from utils.dynamodb_utils import (
+        release_leases,
+        return_processed_stores_to_fetched,
+        update_status_of_items_to_processed_in_DB,
+    )
+    from slack_bot.bot import send_fetched_phone_numbers_to_slack_channel
+
+    metrics = get_metrics()
+    dispatcher = SinkDispatcher()
+    try:
+        dispatcher.submit(
+            "WriteBack",
+            WRITE_BACK_SINK_TIMEOUT_SECONDS,
+            update_status_of_items_to_processed_in_DB,
+            stores,
+            lease_owner,
+        )
+        # The sheet gets copies of the stores, the write-back changes the status of the originals while the rows of
+        # the sheet are being built
+        if export_sink == "file":
+            from utils.file_export_utils import export_stores_to_file
+
+            sheet_name, export_function = "File", export_stores_to_file
+        else:
+            from utils.google_sheet_utils import populate_google_sheet
+
+            sheet_name, export_function = "Sheet", populate_google_sheet
+        dispatcher.submit(
+            sheet_name,
+            SHEET_SINK_TIMEOUT_SECONDS,
+            export_function,
+            [store.model_copy() for store in stores],
+        )
+
+        sheet = dispatcher.result(sheet_name)
+        metrics.add_time(sheet_name, sheet.seconds)
+        sinks = [sheet]
+        if sheet.succeeded:
+            dispatcher.submit(
+                "Slack",
+                SLACK_SINK_TIMEOUT_SECONDS,
+                send_fetched_phone_numbers_to_slack_channel,
+                sheet.value,
+            )
+            slack = dispatcher.result("Slack")
+            metrics.add_time("Slack", slack.seconds)
+            sinks.append(slack)
+
+        write_back = dispatcher.result("WriteBack")
+        sinks.append(write_back)
+    finally:
+        dispatcher.shutdown()
+
+    # The write-back partially failed when some of the stores couldn't be marked processed: they were exported, but
+    # they're still fetched and leased by this run
+    not_written_back = []
+    if write_back.succeeded and write_back.value.failures:
+        not_written_back = [
+            store for store in stores if store.store_id in write_back.value.failures
+        ]
+        write_back.error = RuntimeError(
+            f"{len(not_written_back)} stores couldn't be marked processed"
+        )
+        metrics.increment("SinkFailures")
+        logger.error("The WriteBack sink partially failed: %r", write_back.error)
+
+    logger.info("Export sinks: %s", sinks)
+
+    failed_exports = [sink for sink in sinks[:-1] if not sink.succeeded]
+    if failed_exports:
+        # The stores the write-back didn't move to processed still hold the lease of this run. A write-back that timed
+        # out can still be running: the stores it marks processed after this point are neither exported nor moved
+        # back, which is why its timeout is kept well above its expected duration.
+        leased_stores = [store for store in stores if store.status != "processed"]
+        return_processed_stores_to_fetched(stores)
+        if lease_owner is not None:
+            release_leases(leased_stores, lease_owner)
+        raise failed_exports[0].error
+
+    if not_written_back and lease_owner is not None:
+        # the leads are delivered, the next run exports these stores again without looking them up
+        release_leases(not_written_back, lease_owner)
+
+    return ExportResult(sheet.value, sinks)
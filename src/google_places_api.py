@@ -1,47 +1,107 @@
 import asyncio
 
 import os
-from typing import List
 import time
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, AsyncIterator, Callable, List, Optional, Tuple
 import random
 
-import aiohttp
-import aiohttp.http_exceptions
-import aiohttp.web_exceptions
-from dotenv import load_dotenv
-
-from utils.logger import logger
+from utils.logger import hot_path_logger, logger
+from utils.rate_limiter import AsyncTokenBucket
+from utils.circuit_breaker import CircuitBreaker
+from utils.places_cache import (
+    NEGATIVE_RESULTS,
+    PlacesCache,
+    get_places_cache,
+    is_cacheable_result,
+    normalize_query,
+)
+from utils.places_budget import (
+    PlacesBudget,
+    RequestAllowance,
+    get_places_budget,
+    get_request_allowance,
+)
+from utils.metrics import get_metrics
+from utils.profiling import diagnose_event_loop
+from utils.env import load_env
 from models.store import Store
 
-load_dotenv()
+# aiohttp is imported when the HTTP session is created, it's one of the heaviest imports of the handler
+if TYPE_CHECKING:
+    import aiohttp
 
-GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
+load_env()
 
-MAX_REQUESTS_PER_MINUTE = (
-    600  # max requests per minute allowed for the Places API is 600
+GOOGLE_PLACES_API_KEY = os.getenv("GOOGLE_PLACES_API_KEY")
+# Can be pointed to a local stand-in of the API, like the one used by the benchmarks
+PLACES_SEARCH_TEXT_URL = os.getenv(
+    "PLACES_API_URL", "https://places.googleapis.com/v1/places:searchText"
 )
-REQUEST_INTERVAL = (
-    60 / MAX_REQUESTS_PER_MINUTE
-)  # minimum time gap b/w requests if to be equally separated. 0.1 second
-SEMAPHORE = asyncio.Semaphore(
-    50
-)  # This is basically a bucket defining the max current requests that are pending. When one request
-# is fulfilled, another one is initiated in its place, maintaining the max number of concurrent requests. It's not particularly needed
-# for this API because I couldn't find a limit on the concurrent calls for the Places API, I'm including it as a good practice.
+
+MAX_REQUESTS_PER_MINUTE = int(
+    os.getenv("PLACES_MAX_REQUESTS_PER_MINUTE", 600)
+)  # max requests per minute allowed for the Places API is 600
+# The max number of requests that can be sent back to back after an idle period. Keeping it small keeps us under
+# the per minute cap even in the first minute of a batch, where the bucket starts full.
+RATE_LIMIT_BURST = int(os.getenv("PLACES_RATE_LIMIT_BURST", 10))
+MAX_CONCURRENT_REQUESTS = 50
+# The above is the max number of requests that are pending at the same time. When one request is fulfilled, another one
+# is initiated in its place, maintaining the max number of concurrent requests. It's not particularly needed for this API
+# because I couldn't find a limit on the concurrent calls for the Places API, I'm including it as a good practice.
+# The semaphore enforcing it is created per batch (together with the rate limiter) so that it's bound to the event loop
+# of the current invocation, warm Lambda invocations each run their own event loop with asyncio.run().
 
 
-BACKOFF_FACTOR = 2  # binary exponential backoff
 MAX_RETRIES = 5
+# Backoff of the retries when the response has no Retry-After header: exponential with full jitter, capped
+RETRY_BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+RETRY_BACKOFF_MAX = 16  # seconds
+# A Retry-After longer than this isn't waited for, the store is left for the next run instead of stalling the batch
+RETRY_AFTER_MAX = float(os.getenv("PLACES_RETRY_AFTER_MAX_SECONDS", 30))
+# 429 is the rate limit (or the quota) of the project, the 5xx are transient errors of the API. The other 4xx (ex: 400
+# for a malformed query, 403 for a missing API key or an exhausted billing account) would fail the same way again.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _retry_after_seconds(retry_after: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header, given either in seconds or as an HTTP date"""
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def _backoff_seconds(retry_count: int) -> float:
+    return random.uniform(
+        0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2**retry_count)
+    )
 
 
 # Google offers $200 free credits per month then for each 1000 requests (of this kind) the cost will be $32
 async def get_phone_number_from_google_maps(
-    session: aiohttp.ClientSession, store_name: str, address: str
-):
+    session: "aiohttp.ClientSession",
+    store_name: str,
+    address: str,
+    rate_limiter: Optional[AsyncTokenBucket] = None,
+    circuit_breaker: Optional[CircuitBreaker] = None,
+    allowance: Optional[RequestAllowance] = None,
+    on_failure: Optional[Callable[[str, bool], None]] = None,
+    time_left: Optional[Callable[[], Optional[float]]] = None,
+) -> Optional[str]:
+    """Returns the phone number of the store, or None if the lookup failed and the store should be retried by a later run"""
+    import aiohttp
 
     query = f"{store_name}, {address}"
 
-    search_url = "https://places.googleapis.com/v1/places:searchText"
+    search_url = PLACES_SEARCH_TEXT_URL
     params = {"textQuery": query}
     headers = {
         "Content-Type": "application/json",
@@ -49,84 +109,401 @@ async def get_phone_number_from_google_maps(
         "X-Goog-FieldMask": "places.internationalPhoneNumber",
     }
 
-    async with SEMAPHORE:
-        # This time.sleep() is blocks the requests to stay within the rate limit. Using asyncio.sleep() doesn't work here
-        time.sleep(REQUEST_INTERVAL)
-        logger.info(f"Initiated a request")
-
-        retry_count = 0
+    metrics = get_metrics()
+
+    for retry_count in range(MAX_RETRIES + 1):
+        # Once the API keeps failing (ex: a revoked key or an exhausted quota), the lookups fail fast without a request
+        # and the store is left pending, instead of every store of the batch going through all its retries
+        if circuit_breaker is not None and not circuit_breaker.allow_request():
+            metrics.increment("PlacesShortCircuited")
+            return None
+        # Every attempt is billed, the retries included, so the run stops sending requests once the ones left under the
+        # monthly spend ceiling are used up, rather than trusting the size of the batch to stay under it
+        if allowance is not None and not allowance.take():
+            return None
+        if retry_count > 0:
+            metrics.increment("PlacesRetries")
+        # Every attempt (including the retries) counts towards the rate limit, so a token is taken before each one.
+        # Waiting for a token only suspends this task, the other in-flight requests keep running. Neither the request
+        # nor the wait for its token (long for a large batch) go past the time left before the export, the store is
+        # released for the next run rather than killed with the invocation by the Lambda timeout.
+        seconds_left = time_left() if time_left is not None else None
+        try:
+            if seconds_left is not None and seconds_left <= 0:
+                raise asyncio.TimeoutError
+            if rate_limiter is not None:
+                await asyncio.wait_for(rate_limiter.acquire(), seconds_left)
+        except asyncio.TimeoutError:
+            metrics.increment("PlacesOutOfTime")
+            return None
+        logger.debug("Initiated a request")
+        metrics.increment("PlacesRequests")
+        request_start_time = time.perf_counter()
+
+        retry_after = None
+        try:
+            async with session.post(
+                search_url, params=params, headers=headers
+            ) as response:
+                metrics.record_latency(
+                    "PlacesRequestLatency", time.perf_counter() - request_start_time
+                )
+                logger.debug(
+                    "Places API responded with status %s for query: %s",
+                    response.status,
+                    query,
+                )
 
-        while retry_count < MAX_RETRIES:
-            try:
-                async with session.post(
-                    search_url, params=params, headers=headers
-                ) as response:
-                    logger.info(
-                        f"This is the response from Places API for query: {query}: {response.text}"
+                if response.status == 200:
+                    if circuit_breaker is not None:
+                        circuit_breaker.record_success()
+                    response_json = await response.json()
+                    logger.debug(
+                        "This is the response from Places API for query: %s: %s",
+                        query,
+                        response_json,
                     )
-
-                    if response.status == 200:
-                        response_json = await response.json()
+                    if retry_count > 0:
+                        logger.debug("Request fulfilled on the %s retry", retry_count)
+
+                    places = response_json.get("places", [])
+                    if places:
+                        # Extract the formatted phone number from the first result
+                        phone_number = places[0].get(
+                            "internationalPhoneNumber", "Phone number not available"
+                        )
                         logger.debug(
-                            f"This is the response from Places API for query: {query}: {response_json}"
+                            "This is the fetched phone number: %s", phone_number
                         )
-
-                        places = response_json.get("places", [])
-                        if places:
-                            # Extract the formatted phone number from the first result
-                            phone_number = places[0].get(
-                                "internationalPhoneNumber", "Phone number not available"
-                            )
-                            logger.info(
-                                f"This is the fetched phone number: {phone_number}"
-                            )
-                            return phone_number
-                        else:
-                            return "No results found"
+                        return phone_number
                     else:
-                        return f"Error: {response.status} - {response.text}"
-
-                if retry_count == 0:
-                    logger.info(f"Request fulfilled on the first try")
-                else:
-                    logger.info(f"Request fulfilled on the {retry_count} try")
-                break
-
-            except Exception as e:
-                # retry request with exponential back off
-                logger.warning(f"This is the Too Many Requests error: {e}")
-
-                retry_count += 1
-                backoff_time = BACKOFF_FACTOR**retry_count
-                # 10% jitter. Although it's not that needed here, I'm including it as a good practice
-                jitter = random.uniform(0, 0.1 * backoff_time)
-                wait_time = backoff_time + jitter
-                logger.warning(
-                    f"429 Too Many Requests - Retrying in {wait_time:.2f} seconds..."
+                        return "No results found"
+
+                metrics.increment("PlacesErrors")
+                retry_after = _retry_after_seconds(response.headers.get("Retry-After"))
+                if response.status == 429:
+                    metrics.increment("PlacesRateLimited")
+                # A 429 that asks to retry shortly is the rate limit throttling a burst, the retry goes through. Only
+                # the other errors (including a 429 without a Retry-After, like an exhausted quota) open the breaker.
+                throttled = (
+                    response.status == 429
+                    and retry_after is not None
+                    and retry_after <= RETRY_AFTER_MAX
                 )
-                await asyncio.sleep(wait_time)
-
-
-# we have a max of 600 requests per minute per method per project for Places API (new)
-async def async_get_phone_numbers_for_batch_of_stores(stores: List[Store]):
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-
+                if circuit_breaker is not None:
+                    if throttled:
+                        # a throttled probe is retried like any throttled request, letting the next one probe
+                        circuit_breaker.release_probe()
+                    else:
+                        circuit_breaker.record_failure()
+                error_body = await response.text()
+                if response.status not in RETRYABLE_STATUS_CODES:
+                    # failing fast, retrying wouldn't change the answer
+                    hot_path_logger.error(
+                        "Places API error %s for query: %s, not retrying: %s",
+                        response.status,
+                        query,
+                        error_body,
+                    )
+                    if on_failure is not None:
+                        on_failure(
+                            f"Places API error {response.status}: {error_body}", False
+                        )
+                    return None
+                reason = f"Places API error {response.status}"
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # connection errors and timeouts are transient
+            metrics.increment("PlacesErrors")
+            if circuit_breaker is not None:
+                circuit_breaker.record_failure()
+            reason = f"{type(e).__name__}: {e}"
+
+        if retry_count == MAX_RETRIES:
+            break
+        if retry_after is not None and retry_after > RETRY_AFTER_MAX:
+            hot_path_logger.warning(
+                "%s for query: %s, asked to retry in %.0f seconds, leaving it for the next run",
+                reason,
+                query,
+                retry_after,
+            )
+            return None
+
+        # The server knows best when to retry, otherwise we back off exponentially
+        wait_time = (
+            retry_after if retry_after is not None else _backoff_seconds(retry_count)
+        )
+        seconds_left = time_left() if time_left is not None else None
+        if seconds_left is not None and wait_time >= seconds_left:
+            metrics.increment("PlacesOutOfTime")
+            hot_path_logger.warning(
+                "%s for query: %s, no time left in the invocation to retry in %.2f seconds, leaving it for the next run",
+                reason,
+                query,
+                wait_time,
+            )
+            return None
+        hot_path_logger.warning("%s - Retrying in %.2f seconds...", reason, wait_time)
+        await asyncio.sleep(wait_time)
+
+    hot_path_logger.error(
+        "%s for query: %s, giving up after %s retries", reason, query, MAX_RETRIES
+    )
+    # Only the lookups that went through all their retries count as a failure of the store. The ones cut short (by the
+    # circuit breaker, the budget or a long Retry-After) are the API or the run failing, not the store.
+    if on_failure is not None:
+        on_failure(f"{reason} after {MAX_RETRIES} retries", True)
+    return None
+
+
+class PlacesLookupSession:
+    """Looks up the phone numbers of stores, sharing the HTTP session, rate limit, cache and in-flight requests across calls"""
+
+    def __init__(
+        self,
+        cache: Optional[PlacesCache] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        budget: Optional[PlacesBudget] = None,
+        allowance: Optional[RequestAllowance] = None,
+        time_left: Optional[Callable[[], Optional[float]]] = None,
+    ):
+        self.cache = cache if cache is not None else get_places_cache()
+        self.budget = budget if budget is not None else get_places_budget()
+        # Both are shared across all the lookups of the session: the token bucket keeps all of them at the per minute
+        # cap, while the semaphore caps the number of in-flight requests.
+        self.rate_limiter = AsyncTokenBucket.from_requests_per_minute(
+            MAX_REQUESTS_PER_MINUTE, burst=RATE_LIMIT_BURST
+        )
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # Shared the same way, so that the failures of all the lookups add up. When it opens, the lookups waiting for
+        # their turn (on the semaphore, the rate limiter or a retry backoff) are cancelled rather than drained one by one.
+        self.circuit_breaker = (
+            circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        )
+        self.circuit_breaker.on_open(self._cancel_lookups_in_flight)
+        # The requests left under the monthly spend ceiling, read from the ledger when the session starts unless they're
+        # shared with the caller (ex: the streaming producer stops claiming stores once they're used up)
+        self.allowance = allowance
+        # Returns the seconds left for the lookups before the export has to start (see TimeBudget.lookup_seconds_left),
+        # None when the time isn't limited. No request or retry is started past it.
+        self.time_left = time_left
+        # Single-flight: maps a normalized query to the task of its in-flight request, so that a lookup for the same query
+        # made while the first one is still pending (ex: from another page of stores) waits for it instead of paying again
+        self._in_flight = {}
+        # The definitive answers of the session by their normalized query, so that a query answered for an earlier
+        # page isn't paid for again when the cache is disabled
+        self._results = {}
+        # The reason of the failed lookups of the session by their normalized query, and if a later run could succeed
+        self._failures = {}
+        self._requests_in_flight = 0
+        # the phone numbers found by the requests of the session, to report the cost per resolved phone number
+        self.resolved_count = 0
+        self.session = None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self._requests_at_start = get_metrics().counters.get("PlacesRequests", 0)
+        if self.allowance is None and self.budget is not None:
+            self.allowance = await asyncio.to_thread(get_request_allowance, self.budget)
+        self.session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.flush)
+            logger.info("Places cache stats: %s", self.cache.stats())
+
+        metrics = get_metrics()
+        if self.budget is not None:
+            # every request sent is counted, the ones that failed included, so the ledger never underestimates the bill
+            requests = (
+                metrics.counters.get("PlacesRequests", 0) - self._requests_at_start
+            )
+            await asyncio.to_thread(self.budget.record, requests, self.resolved_count)
+            budget_report = await asyncio.to_thread(self.budget.report)
+            logger.info(
+                "Places budget: this session sent %s requests for %s phone numbers, the month so far: %s",
+                requests,
+                self.resolved_count,
+                budget_report,
+            )
+            metrics.set_gauge("PlacesMonthlyRequests", budget_report["requests"])
+        logger.info(
+            "Places API latency (ms): p50=%s, p95=%s, p99=%s",
+            metrics.percentile("PlacesRequestLatency", 50),
+            metrics.percentile("PlacesRequestLatency", 95),
+            metrics.percentile("PlacesRequestLatency", 99),
+        )
+
+    async def _bounded_lookup(self, query: str, store: Store):
+        async with self.semaphore:
+            self._requests_in_flight += 1
+            get_metrics().set_gauge("PlacesConcurrency", self._requests_in_flight)
+            try:
+                return await get_phone_number_from_google_maps(
+                    self.session,
+                    store.name,
+                    store.address,
+                    rate_limiter=self.rate_limiter,
+                    circuit_breaker=self.circuit_breaker,
+                    allowance=self.allowance,
+                    on_failure=lambda reason, retryable: self._failures.__setitem__(
+                        query, (reason, retryable)
+                    ),
+                    time_left=self.time_left,
+                )
+            finally:
+                self._requests_in_flight -= 1
+
+    def _cancel_lookups_in_flight(self):
+        get_metrics().increment("PlacesCircuitBreakerTrips")
+        for task in self._in_flight.values():
+            task.cancel()
+
+    def _single_flight_lookup(self, query: str, store: Store) -> asyncio.Task:
+        task = self._in_flight.get(query)
+        if task is None:
+            task = asyncio.create_task(self._bounded_lookup(query, store))
+            self._in_flight[query] = task
+            task.add_done_callback(lambda _: self._finish_lookup(query, task))
+        return task
+
+    def _finish_lookup(self, query: str, task: asyncio.Task):
+        # The answer is kept as the request leaves the in-flight map, so that a page looking up the same query in between
+        # never sends it again. This runs once per request however many pages waited for it, so the phone numbers found
+        # are counted here rather than by every page.
+        if not task.cancelled() and task.exception() is None:
+            result = task.result()
+            if is_cacheable_result(result):
+                self._results[query] = result
+            if result is not None and result not in NEGATIVE_RESULTS:
+                self.resolved_count += 1
+        self._in_flight.pop(query, None)
+
+    async def lookup_stores_as_completed(
+        self, stores: List[Store]
+    ) -> AsyncIterator[Tuple[List[Store], Optional[str]]]:
+        """Yields the stores sharing a query with their phone number as soon as it's known. None for the failed lookups"""
+        if not stores:
+            return
+
+        # Index of the stores by their canonical query: chains and duplicate listings in the batch share a single
+        # request, whose result is then fanned back out to every store of the group.
+        stores_by_query = {}
         for store in stores:
-            task = asyncio.create_task(
-                get_phone_number_from_google_maps(session, store.name, store.address)
+            query = normalize_query(store.name, store.address)
+            stores_by_query.setdefault(query, []).append(store)
+
+        # Queries already answered in this session (ex: by another page of stores) cost nothing, even without a cache
+        results_by_query = {
+            query: self._results[query]
+            for query in stores_by_query
+            if query in self._results
+        }
+        metrics = get_metrics()
+        metrics.increment("PlacesCoalesced", len(results_by_query))
+
+        # Queries answered before (in this run or the previous ones) are taken from the cache, only the misses cost a
+        # Places API request. The cache backends are blocking (file and DynamoDB), so they're run in a thread.
+        queries_to_check = [
+            query for query in stores_by_query if query not in results_by_query
+        ]
+        if self.cache is not None and queries_to_check:
+            cached_results = await asyncio.to_thread(
+                self.cache.get_many, queries_to_check
             )
-            tasks.append(task)
+            metrics.increment("PlacesCacheHits", len(cached_results))
+            results_by_query.update(cached_results)
+
+        for query, result in results_by_query.items():
+            yield stores_by_query[query], result
+
+        # A query whose request is already in flight for another page waits for it, it's counted as coalesced rather
+        # than as a cache miss since it doesn't cost a request
+        tasks = {}
+        coalesced_count = 0
+        for query, group in stores_by_query.items():
+            if query in results_by_query:
+                continue
+            if query in self._in_flight:
+                coalesced_count += 1
+            tasks[self._single_flight_lookup(query, group[0])] = query
+        metrics.increment("PlacesCoalesced", coalesced_count)
+        metrics.increment("PlacesCacheMisses", len(tasks) - coalesced_count)
+
+        # Each result is handed over as soon as its own request completes, rather than once the slowest request of the
+        # stores is done, so that the caller (ex: the write-back of the streaming pipeline) can work on it right away
+        fetched_results = {}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    query = tasks[task]
+                    if task.cancelled():
+                        # cancelled by the circuit breaker, the store is left pending like the other failed lookups
+                        result = None
+                    elif task.exception() is not None:
+                        raise task.exception()
+                    else:
+                        result = task.result()
+                    fetched_results[query] = result
+                    if result is None and query in self._failures:
+                        # kept on the stores, so that the ones that keep failing stop being looked up
+                        reason, retryable = self._failures[query]
+                        for store in stores_by_query[query]:
+                            store.last_lookup_error = reason
+                            store.lookup_failure_retryable = retryable
+                    yield stores_by_query[query], result
+        finally:
+            if self.cache is not None and fetched_results:
+                await asyncio.to_thread(self.cache.set_many, fetched_results)
+
+        logger.info(
+            "Looked up %s stores with %s Places API queries (%s unique queries, %s shared with the lookups in flight)",
+            len(stores),
+            len(tasks) - coalesced_count,
+            len(stores_by_query),
+            coalesced_count,
+        )
+
+    async def lookup_stores(self, stores: List[Store]) -> List[Optional[str]]:
+        """Returns the phone numbers of the stores, in the same order as the stores. None for the failed lookups"""
+        results_by_store = {}
+        async for group, result in self.lookup_stores_as_completed(stores):
+            for store in group:
+                results_by_store[id(store)] = result
+        return [results_by_store[id(store)] for store in stores]
+
 
-        # A list of fetched phone numbers
-        phone_number_results = await asyncio.gather(*tasks)
+# we have a max of 600 requests per minute per method per project for Places API (new)
+async def async_get_phone_numbers_for_batch_of_stores(
+    stores: List[Store],
+    cache: Optional[PlacesCache] = None,
+    time_left: Optional[Callable[[], Optional[float]]] = None,
+):
+    async with PlacesLookupSession(cache=cache, time_left=time_left) as places:
+        # A list of fetched phone numbers, positionally matching the stores
+        phone_number_results = await places.lookup_stores(stores)
 
-        return phone_number_results
+    return phone_number_results
 
 
 # sync wrapper for the above async method, abstracting away the async functionality in the main.py
-def get_phone_numbers_for_batch_of_stores(stores: List[Store]):
-    results = asyncio.run(async_get_phone_numbers_for_batch_of_stores(stores))
+def get_phone_numbers_for_batch_of_stores(
+    stores: List[Store], time_left: Optional[Callable[[], Optional[float]]] = None
+):
+    results = asyncio.run(
+        diagnose_event_loop(
+            "lookup",
+            async_get_phone_numbers_for_batch_of_stores(stores, time_left=time_left),
+        )
+    )
     return results
 
 
@@ -139,6 +516,8 @@ if __name__ == "__main__":
     address = "195 Hollyhedge Rd, Manchester, England M22 8UE"
 
     async def run_example(store_name, address):
+        import aiohttp
+
         async with aiohttp.ClientSession() as session:
 
             phone_number = await get_phone_number_from_google_maps(
@@ -159,4 +538,7 @@ if __name__ == "__main__":
 # the time that it will take to process a batch. For larger batch sizes, this should be taken into consideration. Another thing to note
 # is that the max runtime for a Lambda function is 15 minutes, in which we are way below here.
 
-# The exponential back-off and jitter are not needed here because we have strict wait periods to ensure we stay within the rate limit.
+# The rate limiting used to be a blocking time.sleep() of 0.1 seconds before every request, which froze the event loop and
+# serialized the requests (together with the time it takes to get their responses). With the shared token bucket, the requests
+# are started at 10 per second while the earlier ones are still in flight, so a batch of 1000 stores takes close to the
+# theoretical 100 seconds dictated by the 600 requests per minute cap.
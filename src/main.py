@@ -1,54 +1,317 @@
+import os
 import time
+import uuid
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from slack_bot.bot import send_fetched_phone_numbers_to_slack_channel
-from utils.logger import logger
-from utils.google_sheet_utils import populate_google_sheet
-from utils.dynamodb_utils import (
-    get_batch_of_unprocessed_stores,
-    update_status_of_items_to_processed_in_DB,
-)
-from utils.common_utils import inject_phone_numbers_into_stores_list
-from google_places_api import get_phone_numbers_for_batch_of_stores
+from utils.logger import flush_logs, logger
+from utils.metrics import PipelineMetrics, reset_metrics
 
-ITEMS_PER_BATCH = 1000
+# The modules of the stages (and the heavy libraries they import: boto3, aiohttp, gspread, slack_sdk, pydantic) are
+# imported on first use in the functions below rather than here, which keeps the cold start of the Lambda short and
+# only loads what the selected pipeline mode needs. Run benchmarks/bench_cold_start.py to see the import times.
+if TYPE_CHECKING:
+    from models.checkpoint import RunCheckpoint
+    from models.store import Store
+    from utils.time_budget import TimeBudget
+
+# The initial size of the batch. In streaming mode on Lambda, the batch keeps growing past it page by page for as long
+# as the remaining time of the invocation allows (see utils/time_budget.py), up to MAX_ITEMS_PER_INVOCATION stores.
+ITEMS_PER_BATCH = int(os.getenv("ITEMS_PER_BATCH", 1000))
+
+# "streaming" runs the DynamoDB reads, the Places lookups and the write-back concurrently, connected by bounded queues.
+# "staged" runs them one after the other, each stage waiting for the previous one to finish for the entire batch.
+# Can be overridden per invocation with the "pipeline_mode" field of the event.
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "streaming")
+
+
+def _get_pipeline_mode(event) -> str:
+    pipeline_mode = PIPELINE_MODE
+    if isinstance(event, dict):
+        pipeline_mode = event.get("pipeline_mode", pipeline_mode)
+
+    if pipeline_mode not in ("streaming", "staged"):
+        raise ValueError(f"Unknown pipeline mode: {pipeline_mode}")
+    return pipeline_mode
+
+
+def _get_export_sink(event) -> str:
+    from export_sinks import EXPORT_SINK, EXPORT_SINKS
+
+    export_sink = EXPORT_SINK
+    if isinstance(event, dict):
+        export_sink = event.get("export_sink", export_sink)
+
+    # checked before the run starts, not after paying for the lookups of the batch
+    if export_sink not in EXPORT_SINKS:
+        raise ValueError(f"Unknown export sink: {export_sink}")
+    return export_sink
+
+
+def _profiling_requested(event) -> bool:
+    from utils.profiling import PROFILING_ENABLED
+
+    if isinstance(event, dict) and "profile" in event:
+        # parsed like PROFILING_ENABLED, bool("false") would turn the profiling on
+        profile = event["profile"]
+        if isinstance(profile, bool):
+            return profile
+        return str(profile).lower() == "true"
+    return PROFILING_ENABLED
+
+
+def _start_run_checkpoint() -> "RunCheckpoint":
+    from models.checkpoint import RunCheckpoint
+    from utils.dynamodb_utils import save_run_checkpoint
+
+    checkpoint = RunCheckpoint(run_id=str(uuid.uuid4()), started_at=str(datetime.now()))
+    save_run_checkpoint(checkpoint)
+    return checkpoint
+
+
+def _report_incomplete_runs(released_counts: Dict[Optional[str], int]):
+    from utils.dynamodb_utils import load_run_checkpoint
+
+    # The runs whose leases expired died before finishing their stores (ex: a Lambda timeout). The stores they fetched
+    # keep their phone numbers and are exported by whichever run claims them next.
+    for run_id, released_count in released_counts.items():
+        last_checkpoint = load_run_checkpoint(run_id) if run_id else None
+        if last_checkpoint is None:
+            logger.warning(
+                "The previous run %s did not complete, %s of its stores were released",
+                run_id,
+                released_count,
+            )
+            continue
+        logger.warning(
+            "The previous run %s did not complete: it stopped at the '%s' stage after fetching %s stores, %s of its stores were released",
+            run_id,
+            last_checkpoint.stage,
+            last_checkpoint.fetched_count,
+            released_count,
+        )
+
+
+def _advance_run_checkpoint(checkpoint: "RunCheckpoint", stage: str):
+    from utils.dynamodb_utils import save_run_checkpoint
+    from utils.profiling import mark_stage
+
+    checkpoint.stage = stage
+    save_run_checkpoint(checkpoint)
+    # the memory and the time of a profiled invocation are reported by stage of the checkpoint
+    mark_stage(stage)
 
 
 def lambda_handler(event, context):
-    curr_time = time.time()
-    initial_time = curr_time
+    initial_time = time.time()
+    # The durations of the stages, the Places API latencies and the counters of this invocation, emitted at the end
+    # as CloudWatch Embedded Metric Format on stdout
+    metrics = reset_metrics()
 
-    stores = get_batch_of_unprocessed_stores(limit=ITEMS_PER_BATCH)
+    pipeline_mode = _get_pipeline_mode(event)
+    export_sink = _get_export_sink(event)
     logger.info(
-        f"These are the fetched stores: {stores}, {len(stores)}, fetching them took {time.time()-curr_time:.2f} seconds"
+        "Running the pipeline in %s mode, exporting to a %s",
+        pipeline_mode,
+        export_sink,
     )
 
-    curr_time = time.time()
-    fetched_phone_numbers = get_phone_numbers_for_batch_of_stores(stores)
-    logger.info(
-        f"These are the fetched phone numbers using Places API: {fetched_phone_numbers}"
-    )
-    logger.info(f"Fetched the phone numbers in {time.time()-curr_time} seconds.")
+    # the profile is named after the id of the Lambda request, so that it can be matched with the logs of the run
+    from utils.profiling import profile_invocation
 
-    curr_time = time.time()
-    stores = inject_phone_numbers_into_stores_list(stores, fetched_phone_numbers)
-    google_sheet_url = populate_google_sheet(stores)
+    profile_name = getattr(context, "aws_request_id", None)
+    try:
+        with profile_invocation(_profiling_requested(event), profile_name):
+            stores = run_pipeline(pipeline_mode, export_sink, metrics, context)
+        metrics.increment("StoresProcessed", len(stores))
+    except Exception:
+        metrics.increment("PipelineFailures")
+        raise
+    finally:
+        total_time = time.time() - initial_time
+        metrics.add_time("Total", total_time)
+        metrics.set_gauge(
+            "Throughput",
+            round(metrics.counters.get("StoresProcessed", 0) / total_time, 2),
+        )
+        metrics.emit({"PipelineMode": pipeline_mode})
+        logger.info("The entire pipeline took %.2f seconds to complete", total_time)
+        # the records still queued would only be written when the next invocation thaws the container
+        flush_logs()
 
-    send_fetched_phone_numbers_to_slack_channel(google_sheet_url)
-    logger.info(
-        f"Created the Google Sheet and sent it to Slack in {time.time()-curr_time} seconds."
-    )
+    return None
 
-    curr_time = time.time()
-    update_status_of_items_to_processed_in_DB(stores)
-    logger.info(
-        f"Updated the status of the processed items in DynamoDB to 'processed' in {time.time()-curr_time} seconds"
-    )
 
+def run_pipeline(
+    pipeline_mode: str,
+    export_sink: str,
+    metrics: PipelineMetrics,
+    context=None,
+    time_budget: Optional["TimeBudget"] = None,
+) -> List["Store"]:
+    """Runs a batch through the pipeline, sized by the time budget of the invocation unless one is given (ex: backfill.py)"""
+    from utils.places_budget import get_places_budget
+    from utils.time_budget import TimeBudget
+
+    if time_budget is None:
+        time_budget = TimeBudget(context, initial_batch_size=ITEMS_PER_BATCH)
+
+    # The batch is capped by the Places API requests left under the monthly spend ceiling, and no run is started once
+    # the ceiling is reached. A store costs one request or none (a cache hit) when its lookup goes through the first
+    # time, and one more per retry, so the lookups also stop sending requests once the ones left are used up.
+    places_budget = get_places_budget()
+    if places_budget is not None:
+        remaining_requests = places_budget.remaining_requests()
+        if remaining_requests == 0:
+            logger.warning(
+                "The Places API spend ceiling of the month is reached, not starting a run: %s",
+                places_budget.report(),
+            )
+            metrics.increment("StoppedByPlacesBudget")
+            return []
+        if remaining_requests < time_budget.initial_batch_size:
+            logger.warning(
+                "Only %s Places API requests are left under the spend ceiling of the month, shrinking the batch",
+                remaining_requests,
+            )
+            metrics.increment("ShrunkByPlacesBudget")
+        time_budget.initial_batch_size = min(
+            time_budget.initial_batch_size, remaining_requests
+        )
+        time_budget.max_batch_size = min(time_budget.max_batch_size, remaining_requests)
+
+    checkpoint = _start_run_checkpoint()
+    _advance_run_checkpoint(checkpoint, "lookup")
+
+    # Every store is claimed by the run before it's looked up, so concurrent runs never pay for the same lookups. The
+    # run id is the owner of the leases, and the stores left in progress by a run that died are released first.
+    from utils.dynamodb_utils import release_expired_leases
+
+    lease_owner = checkpoint.run_id
+    _report_incomplete_runs(release_expired_leases())
+
+    # Either way, the looked up stores are persisted with the "fetched" status before the export, so that a timeout
+    # or a failure of Google Sheets or Slack doesn't throw away the phone numbers we already paid for.
+    if pipeline_mode == "streaming":
+        from streaming_pipeline import run_streaming_pipeline
+
+        # the stages overlap, their timers measure the time each of them was busy
+        curr_time = time.time()
+        stores = run_streaming_pipeline(
+            limit=time_budget.batch_size_limit,
+            checkpoint=checkpoint,
+            time_budget=time_budget,
+            lease_owner=lease_owner,
+        )
+        logger.info(
+            "Fetched, looked up and persisted %s stores in %.2f seconds",
+            len(stores),
+            time.time() - curr_time,
+        )
+        if time_budget.stopped_early:
+            metrics.increment("StoppedByTimeBudget")
+    else:
+        from utils.dynamodb_utils import (
+            drop_stores_not_written_back,
+            get_batch_of_stores_to_process,
+            return_failed_lookups_to_pending,
+            update_status_of_items_to_fetched_in_DB,
+        )
+        from utils.common_utils import inject_phone_numbers_into_stores_list
+        from google_places_api import get_phone_numbers_for_batch_of_stores
+
+        # the whole batch is pulled at once, so it's capped by the stores whose lookups fit in the time left
+        batch_limit = time_budget.initial_batch_limit()
+        if batch_limit < time_budget.initial_batch_size:
+            logger.warning(
+                "Only %s stores can be looked up in the time left in the invocation, shrinking the batch",
+                batch_limit,
+            )
+            metrics.increment("StoppedByTimeBudget")
+        with metrics.timer("Query"):
+            stores = (
+                get_batch_of_stores_to_process(
+                    limit=batch_limit, lease_owner=lease_owner
+                )
+                if batch_limit
+                else []
+            )
+        # the stores themselves are only in the debug logs, the repr of a batch is megabytes of log lines
+        logger.info(
+            "Fetched %s stores, fetching them took %.2f seconds",
+            len(stores),
+            metrics.timers["Query"],
+        )
+        logger.debug("These are the fetched stores: %s", stores)
+
+        # stores fetched by an earlier run already have their phone numbers
+        stores_to_look_up = [store for store in stores if store.status != "fetched"]
+        checkpoint.resumed_count = len(stores) - len(stores_to_look_up)
+
+        with metrics.timer("Lookup"):
+            # the lookups left once the time runs out are released for the next run, not killed with the invocation
+            fetched_phone_numbers = get_phone_numbers_for_batch_of_stores(
+                stores_to_look_up, time_left=time_budget.lookup_seconds_left
+            )
+        logger.debug(
+            "These are the fetched phone numbers using Places API: %s",
+            fetched_phone_numbers,
+        )
+        logger.info(
+            "Fetched the phone numbers in %.2f seconds.", metrics.timers["Lookup"]
+        )
+
+        inject_phone_numbers_into_stores_list(stores_to_look_up, fetched_phone_numbers)
+
+        # the stores whose lookup failed aren't exported, they go back to pending for the next run
+        failed_lookups = [
+            store for store in stores_to_look_up if store.phone_number is None
+        ]
+        if failed_lookups:
+            return_failed_lookups_to_pending(failed_lookups, lease_owner)
+            failed_store_ids = {store.store_id for store in failed_lookups}
+            stores = [
+                store for store in stores if store.store_id not in failed_store_ids
+            ]
+            stores_to_look_up = [
+                store
+                for store in stores_to_look_up
+                if store.store_id not in failed_store_ids
+            ]
+
+        result = update_status_of_items_to_fetched_in_DB(stores_to_look_up, lease_owner)
+        # only the stores whose phone number is persisted are exported
+        written_back = drop_stores_not_written_back(
+            stores_to_look_up, result, lease_owner
+        )
+        if result.failures:
+            stores = [
+                store for store in stores if store.store_id not in result.failures
+            ]
+        checkpoint.fetched_count = len(written_back)
+
+    _advance_run_checkpoint(checkpoint, "fetched")
+
+    # The Google Sheet or the file (then Slack, once its link exists) and the final write-back to processed run
+    # concurrently. If the sheet, the file or Slack fails, the stores are left fetched and released, they're exported
+    # by the next run (or the retry of this invocation) without waiting for the leases of this run to expire.
+    from export_sinks import export_stores
+
+    with metrics.timer("Export"):
+        export = export_stores(stores, lease_owner, export_sink)
+    if export_sink == "file":
+        checkpoint.export_file_url = export.url
+    else:
+        checkpoint.google_sheet_url = export.url
     logger.info(
-        f"The entire pipeline took {time.time()-initial_time} seconds to complete"
+        "Exported the stores to the %s and Slack and marked them processed in %.2f seconds (%s)",
+        export_sink,
+        metrics.timers["Export"],
+        ", ".join(f"{sink.name}: {sink.seconds:.2f}s" for sink in export.sinks),
     )
+    _advance_run_checkpoint(checkpoint, "completed")
 
-    return None
+    return stores
 
 
 # lambda_handler("hs", "sd")
@@ -0,0 +1,39 @@
+import os
+import time
+from typing import Optional
+from pydantic import BaseModel
+
+# Every run has its own checkpoint in the stores table, under a reserved store_id made of this prefix and the run id, so
+# that concurrent runs don't overwrite the progress of each other
+RUN_CHECKPOINT_ID_PREFIX = "__pipeline_run_checkpoint__#"
+# The checkpoints are removed by the TTL of the table once they're this old, there's one per run
+RUN_CHECKPOINT_TTL_DAYS = int(os.getenv("RUN_CHECKPOINT_TTL_DAYS", 30))
+
+
+def run_checkpoint_id(run_id: str) -> str:
+    return f"{RUN_CHECKPOINT_ID_PREFIX}{run_id}"
+
+
+class RunCheckpoint(BaseModel):
+    """Represents the progress of a run of the pipeline, so that a later run can report where it stopped"""
+
+    store_id: str = ""
+    run_id: str
+    # one of: "started", "lookup", "fetched", "completed"
+    stage: str = "started"
+    started_at: str
+    updated_at: Optional[str] = None
+    # number of stores whose phone numbers were looked up and persisted with the "fetched" status in this run
+    fetched_count: int = 0
+    # number of stores that were already fetched by an earlier run that stopped before exporting them
+    resumed_count: int = 0
+    google_sheet_url: Optional[str] = None
+    # the path or URL of the exported file, when the batch is exported to a file instead of a Google Sheet
+    export_file_url: Optional[str] = None
+    # the epoch time after which the TTL of the table deletes the checkpoint
+    expires_at: Optional[int] = None
+
+    def model_post_init(self, __context):
+        self.store_id = self.store_id or run_checkpoint_id(self.run_id)
+        if self.expires_at is None:
+            self.expires_at = int(time.time()) + RUN_CHECKPOINT_TTL_DAYS * 24 * 60 * 60
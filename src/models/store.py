@@ -1,5 +1,6 @@
+from functools import cached_property
 from typing import Optional, List
-from pydantic import BaseModel, Field, ConfigDict, computed_field
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter, computed_field
 
 
 class Store(BaseModel):
@@ -14,10 +15,19 @@ class Store(BaseModel):
     status: str
     rating: str
     last_processed_at: Optional[str] = None
+    # The number of runs whose lookup of the store failed, and the error of the last one. The store is moved to the
+    # "failed" status instead of pending once they add up (see return_failed_lookups_to_pending)
+    lookup_attempts: int = 0
+    last_lookup_error: Optional[str] = None
+    # Set by the lookup of this run when it failed for the store itself, to whether a later run could succeed. It stays
+    # None for the lookups that were skipped (ex: by the circuit breaker). Not stored in DynamoDB.
+    lookup_failure_retryable: Optional[bool] = Field(default=None, exclude=True)
 
     # This is an attribute of the class Store initialized on initialization of the class, can be accessed with self.google_maps_url
+    # It's built on the first access and memoized, since it's read more than once for every row of the Google Sheet. The
+    # name and address it's built from don't change after the store is read from DynamoDB.
     @computed_field
-    @property
+    @cached_property
     def google_maps_url(self) -> str:
         return self._construct_google_maps_url()
 
@@ -32,9 +42,17 @@ class Store(BaseModel):
         """Create a Store item from a DynamoDB item"""
         return cls.model_validate(item)  # built-in into Pydantic
 
-    def to_dynamodb_item(self) -> dict:
+    @classmethod
+    def from_dynamodb_items(cls, items: List[dict]) -> List["Store"]:
+        """Create the Store items of a page of DynamoDB items in a single validation call"""
+        # Validating the whole list at once runs the loop in pydantic-core instead of calling model_validate() from
+        # Python for every item. The items are still fully validated: skipping the validation with model_construct()
+        # was measured to be slower, it's implemented in Python while the validation runs in Rust.
+        return _STORES_ADAPTER.validate_python(items)
+
+    def to_dynamodb_item(self, status: str = "processed") -> dict:
         """Convert the Store item into a DynamoDB item"""
-        self.status = "processed"
+        self.status = status
         data = self.model_dump(by_alias=True, exclude={"google_maps_url"})
 
         return data  # could also here handle None values in the dictionary
@@ -58,3 +76,6 @@ class Store(BaseModel):
         google_maps_base_url = "https://www.google.com/maps/search/"
         url = google_maps_base_url + (self.name + ", " + self.address).replace(" ", "+")
         return url
+
+
+_STORES_ADAPTER = TypeAdapter(List[Store])
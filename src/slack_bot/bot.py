@@ -1,36 +1,44 @@
 import os
 import sys
 
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-import traceback
-
-from dotenv import load_dotenv
-
 # Get the parent directory of the current file and add it to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from utils.logger import logger
+from utils.env import load_env
+from utils.ttl_cache import CLIENT_CACHE_TTL_SECONDS, ttl_cache
+
+
+# The WebClient (and its HTTP connection settings) is reused across warm invocations
+@ttl_cache(CLIENT_CACHE_TTL_SECONDS)
+def _get_slack_client(token: str):
+    # slack_sdk is imported on first use, it's only needed at the end of the pipeline
+    from slack_sdk import WebClient
+
+    return WebClient(token=token)
 
 
 def send_fetched_phone_numbers_to_slack_channel(google_sheet_url: str):
-    load_dotenv()
+    from slack_sdk.errors import SlackApiError
+
+    load_env()
     SLACK_TOKEN = os.getenv("SLACK_TOKEN")
     SLACK_CHANNEL_ID = os.getenv("SLACK_CHANNEL_ID")
 
-    slack_client = WebClient(token=SLACK_TOKEN)
+    slack_client = _get_slack_client(SLACK_TOKEN)
 
     try:
         response = slack_client.chat_postMessage(
             channel=SLACK_CHANNEL_ID, text=f"Leads for this week: {google_sheet_url}"
         )
-        logger.info(f"This is the response from sending the slack message: {response}")
+        logger.info("This is the response from sending the slack message: %s", response)
     except SlackApiError as e:
-        logger.error(
-            f"Sending the slack message failed!: {e}\n{traceback.format_exc()}"
-        )
-        # You will get a SlackApiError if "ok" is False
-        assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
+        logger.error("Sending the slack message failed!: %s", e, exc_info=True)
+        # a new client is built for the next run in case the token is the problem
+        _get_slack_client.cache_clear()
+        # You will get a SlackApiError if "ok" is False, with an error like 'invalid_auth' or 'channel_not_found'. It's
+        # raised so that the export fails and the stores are exported again by the next run, the leads weren't delivered
+        raise
 
 
 # send_fetched_phone_numbers_to_slack_channel("https://dummy_url.com")
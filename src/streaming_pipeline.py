@@ -0,0 +1,279 @@
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+from utils.logger import logger
+from utils.metrics import get_metrics
+from utils.dynamodb_utils import (
+    iter_pages_of_stores_to_process,
+    update_status_of_items_to_fetched_in_DB,
+    drop_stores_not_written_back,
+    return_failed_lookups_to_pending,
+    save_run_checkpoint,
+)
+from google_places_api import PlacesLookupSession
+from utils.circuit_breaker import CircuitBreaker
+from utils.places_budget import RequestAllowance, get_request_allowance
+from models.store import Store
+from models.checkpoint import RunCheckpoint
+from utils.time_budget import STOP, TIME_BUDGET_PAGE_SIZE, WAIT, TimeBudget
+from utils.profiling import diagnose_event_loop
+
+# The queues between the stages are bounded so that the memory used stays flat: when a downstream stage falls behind,
+# the upstream one waits instead of piling up stores in memory.
+PAGES_QUEUE_SIZE = int(os.getenv("STREAMING_PAGES_QUEUE_SIZE", 4))
+MAX_PAGES_IN_FLIGHT = int(os.getenv("STREAMING_MAX_PAGES_IN_FLIGHT", 4))
+RESOLVED_STORES_QUEUE_SIZE = int(os.getenv("STREAMING_RESOLVED_QUEUE_SIZE", 500))
+# Small batches so that little paid for work is lost if the invocation times out
+WRITE_BACK_BATCH_SIZE = int(os.getenv("STREAMING_WRITE_BACK_BATCH_SIZE", 25))
+# The run checkpoint is only a progress report (the resume goes through the "fetched" status of the stores), so it's
+# saved every few seconds rather than after every write-back batch, and once more when the stream ends
+CHECKPOINT_SAVE_INTERVAL_SECONDS = float(
+    os.getenv("STREAMING_CHECKPOINT_SAVE_INTERVAL_SECONDS", 5)
+)
+
+# How often the producer checks again if the batch can grow, while the stores in flight take up the time left, or
+# while the circuit breaker of the Places API is open
+TIME_BUDGET_POLL_INTERVAL = 0.5  # seconds
+# The longest the producer waits for the circuit breaker of the Places API to close before closing the batch, on top of
+# the time budget, so that a breaker stuck open or probing can't hold the invocation until its timeout
+MAX_CIRCUIT_BREAKER_WAIT_SECONDS = float(
+    os.getenv("STREAMING_MAX_CIRCUIT_BREAKER_WAIT_SECONDS", 120)
+)
+
+_END_OF_STREAM = None  # sentinel put in a queue by a stage when it's done producing
+
+
+async def _read_pages_of_stores(
+    limit: int,
+    pages_queue: asyncio.Queue,
+    time_budget: Optional[TimeBudget],
+    lease_owner: Optional[str],
+    circuit_breaker: CircuitBreaker,
+    allowance: Optional[RequestAllowance],
+):
+    """Producer stage: reads (and claims) the stores to process from DynamoDB page by page"""
+    metrics = get_metrics()
+    # Always small pages, even when the batch isn't sized by the time budget: a page is only handed to the lookups once
+    # it's read and claimed, so a page as large as the whole batch would hold back the lookups and the write-back
+    pages = iter_pages_of_stores_to_process(
+        limit=limit, page_size=TIME_BUDGET_PAGE_SIZE, lease_owner=lease_owner
+    )
+    try:
+        while True:
+            # the batch keeps growing page by page for as long as the time left in the invocation allows
+            if time_budget is not None:
+                decision = time_budget.next_page_decision()
+                while decision == WAIT:
+                    await asyncio.sleep(TIME_BUDGET_POLL_INTERVAL)
+                    decision = time_budget.next_page_decision()
+                if decision == STOP:
+                    break
+            # the stores claimed once the Places API requests of the month are used up would only be released again
+            if allowance is not None and allowance.exhausted:
+                logger.warning(
+                    "The Places API requests left under the spend ceiling are used up, closing the batch"
+                )
+                break
+            # No new stores are claimed while the Places API is down, they'd only be released again. The next page is
+            # read once the breaker half-opens, to give it a probe request, and the batch ends if the probes keep failing.
+            waited_seconds = 0.0
+            while circuit_breaker.is_open or circuit_breaker.is_probing:
+                if circuit_breaker.gave_up:
+                    break
+                if waited_seconds >= MAX_CIRCUIT_BREAKER_WAIT_SECONDS or (
+                    time_budget is not None and time_budget.out_of_time()
+                ):
+                    break
+                await asyncio.sleep(TIME_BUDGET_POLL_INTERVAL)
+                waited_seconds += TIME_BUDGET_POLL_INTERVAL
+            if circuit_breaker.gave_up:
+                logger.error(
+                    "The Places API is still failing after probing it, closing the batch"
+                )
+                break
+            if circuit_breaker.is_open or circuit_breaker.is_probing:
+                logger.error(
+                    "The circuit breaker of the Places API is still %s after waiting %.0f seconds, closing the batch",
+                    circuit_breaker.state,
+                    waited_seconds,
+                )
+                break
+            # boto3 is blocking, so every page is fetched in a thread to keep the event loop serving the lookups
+            with metrics.timer("Query"):
+                page = await asyncio.to_thread(next, pages, _END_OF_STREAM)
+            if page is _END_OF_STREAM:
+                break
+            if time_budget is not None:
+                time_budget.record_read(len(page))
+            await pages_queue.put(page)
+            metrics.set_gauge("PagesQueueDepth", pages_queue.qsize())
+    finally:
+        await pages_queue.put(_END_OF_STREAM)
+
+
+async def _look_up_pages_of_stores(
+    pages_queue: asyncio.Queue,
+    resolved_stores_queue: asyncio.Queue,
+    circuit_breaker: CircuitBreaker,
+    allowance: Optional[RequestAllowance],
+    time_budget: Optional[TimeBudget],
+):
+    """Lookup stage: starts the Places lookups of every page as soon as it arrives"""
+    metrics = get_metrics()
+    pages_in_flight = asyncio.Semaphore(MAX_PAGES_IN_FLIGHT)
+
+    async def _look_up_page(page: List[Store]):
+        try:
+            stores_to_look_up = []
+            for store in page:
+                if store.status == "fetched":
+                    # fetched by an earlier run, the store already has its phone number and goes straight to the export
+                    await resolved_stores_queue.put(store)
+                else:
+                    stores_to_look_up.append(store)
+
+            # every store moves on to the write-back as soon as its own lookup completes, not once the whole page is done
+            async for stores, phone_number in places.lookup_stores_as_completed(
+                stores_to_look_up
+            ):
+                for store in stores:
+                    store.phone_number = phone_number
+                    await resolved_stores_queue.put(store)
+                metrics.set_gauge(
+                    "ResolvedStoresQueueDepth", resolved_stores_queue.qsize()
+                )
+        finally:
+            pages_in_flight.release()
+
+    # no lookup or retry is started once the time left is kept for the export, those stores are released instead
+    async with PlacesLookupSession(
+        circuit_breaker=circuit_breaker,
+        allowance=allowance,
+        time_left=time_budget.lookup_seconds_left if time_budget is not None else None,
+    ) as places:
+        tasks = []
+        lookup_start_time = time.perf_counter()
+        try:
+            while True:
+                page = await pages_queue.get()
+                if page is _END_OF_STREAM:
+                    break
+                await pages_in_flight.acquire()
+                tasks.append(asyncio.create_task(_look_up_page(page)))
+
+            await asyncio.gather(*tasks)
+        finally:
+            metrics.add_time("Lookup", time.perf_counter() - lookup_start_time)
+            await resolved_stores_queue.put(_END_OF_STREAM)
+
+
+async def _write_back_resolved_stores(
+    resolved_stores_queue: asyncio.Queue,
+    resolved_stores: List[Store],
+    checkpoint: Optional[RunCheckpoint],
+    time_budget: Optional[TimeBudget],
+    lease_owner: Optional[str],
+):
+    """Write-back stage: persists the resolved stores in small batches as their lookups complete"""
+    buffer = []
+    dead_letters = []
+    checkpoint_saved_at = time.monotonic()
+
+    while True:
+        store = await resolved_stores_queue.get()
+        if store is not _END_OF_STREAM:
+            if time_budget is not None:
+                time_budget.record_resolved(1)
+            if store.status == "fetched":
+                resolved_stores.append(store)
+                if checkpoint is not None:
+                    checkpoint.resumed_count += 1
+            elif store.phone_number is None:
+                # the lookup failed, the store isn't exported and goes back to pending for the next run
+                dead_letters.append(store)
+            else:
+                buffer.append(store)
+
+        if buffer and (len(buffer) >= WRITE_BACK_BATCH_SIZE or store is _END_OF_STREAM):
+            result = await asyncio.to_thread(
+                update_status_of_items_to_fetched_in_DB, buffer, lease_owner
+            )
+            # only the stores whose phone number is persisted are exported
+            written_back = await asyncio.to_thread(
+                drop_stores_not_written_back, buffer, result, lease_owner
+            )
+            resolved_stores.extend(written_back)
+
+            if checkpoint is not None:
+                checkpoint.fetched_count += len(written_back)
+
+            buffer = []
+
+        if checkpoint is not None and (
+            store is _END_OF_STREAM
+            or time.monotonic() - checkpoint_saved_at
+            >= CHECKPOINT_SAVE_INTERVAL_SECONDS
+        ):
+            await asyncio.to_thread(save_run_checkpoint, checkpoint)
+            checkpoint_saved_at = time.monotonic()
+
+        if store is _END_OF_STREAM:
+            break
+
+    if dead_letters:
+        await asyncio.to_thread(
+            return_failed_lookups_to_pending, dead_letters, lease_owner
+        )
+
+
+async def async_run_streaming_pipeline(
+    limit: int,
+    checkpoint: Optional[RunCheckpoint] = None,
+    time_budget: Optional[TimeBudget] = None,
+    lease_owner: Optional[str] = None,
+) -> List[Store]:
+    """Reads, looks up and writes back a batch of stores with the stages running concurrently, connected by bounded queues"""
+    pages_queue = asyncio.Queue(maxsize=PAGES_QUEUE_SIZE)
+    resolved_stores_queue = asyncio.Queue(maxsize=RESOLVED_STORES_QUEUE_SIZE)
+    resolved_stores = []
+    # shared by the producer, which stops claiming stores while it's open, and by the lookups
+    circuit_breaker = CircuitBreaker()
+    # shared the same way: the requests left under the monthly spend ceiling, None when the budget is disabled
+    allowance = await asyncio.to_thread(get_request_allowance)
+
+    await asyncio.gather(
+        _read_pages_of_stores(
+            limit, pages_queue, time_budget, lease_owner, circuit_breaker, allowance
+        ),
+        _look_up_pages_of_stores(
+            pages_queue, resolved_stores_queue, circuit_breaker, allowance, time_budget
+        ),
+        _write_back_resolved_stores(
+            resolved_stores_queue,
+            resolved_stores,
+            checkpoint,
+            time_budget,
+            lease_owner,
+        ),
+    )
+
+    logger.info("Streamed %s stores through the pipeline", len(resolved_stores))
+
+    return resolved_stores
+
+
+# sync wrapper for the above async method, same as for the Places API lookups
+def run_streaming_pipeline(
+    limit: int,
+    checkpoint: Optional[RunCheckpoint] = None,
+    time_budget: Optional[TimeBudget] = None,
+    lease_owner: Optional[str] = None,
+) -> List[Store]:
+    return asyncio.run(
+        diagnose_event_loop(
+            "streaming",
+            async_run_streaming_pipeline(limit, checkpoint, time_budget, lease_owner),
+        )
+    )
@@ -0,0 +1,133 @@
+import os
+import time
+from collections import deque
+from typing import Callable, List
+
+from utils.logger import logger
+
+# The breaker opens after this many failed requests in a row, or when the error rate of the last requests is too high
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(
+    os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", 10)
+)
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", 0.5))
+CIRCUIT_BREAKER_WINDOW_SIZE = int(os.getenv("CIRCUIT_BREAKER_WINDOW_SIZE", 100))
+# the error rate isn't looked at before the window has this many requests, a few errors at the start don't open it
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv("CIRCUIT_BREAKER_MIN_REQUESTS", 50))
+# How long the breaker stays open before letting a probe request through (half-open)
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", 10))
+# The breaker gives up after opening this many times in a row without the probes succeeding
+CIRCUIT_BREAKER_MAX_TRIPS = int(os.getenv("CIRCUIT_BREAKER_MAX_TRIPS", 3))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Stops sending requests to an API that keeps failing, shared by all the tasks of a batch of Places API requests"""
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+        error_rate_threshold: float = CIRCUIT_BREAKER_ERROR_RATE,
+        window_size: int = CIRCUIT_BREAKER_WINDOW_SIZE,
+        min_requests: int = CIRCUIT_BREAKER_MIN_REQUESTS,
+        reset_seconds: float = CIRCUIT_BREAKER_RESET_SECONDS,
+        max_trips: int = CIRCUIT_BREAKER_MAX_TRIPS,
+    ):
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.reset_seconds = reset_seconds
+        self.max_trips = max_trips
+
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        self.consecutive_trips = 0
+        # the outcomes of the last requests, True for a failure
+        self._outcomes = deque(maxlen=window_size)
+        # called when the breaker opens, ex: to cancel the lookups waiting for their turn
+        self._on_open_callbacks: List[Callable[[], None]] = []
+
+    @property
+    def state(self) -> str:
+        # an open breaker lets a probe through once the reset time is over
+        if (
+            self._state == OPEN
+            and time.monotonic() - self._opened_at >= self.reset_seconds
+        ):
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == OPEN
+
+    @property
+    def is_probing(self) -> bool:
+        """True while the probe request of a half-open breaker hasn't answered yet"""
+        return self.state == HALF_OPEN and self._probe_in_flight
+
+    @property
+    def gave_up(self) -> bool:
+        """True when the probes kept failing, the API isn't coming back any time soon"""
+        return self.consecutive_trips >= self.max_trips
+
+    def on_open(self, callback: Callable[[], None]):
+        self._on_open_callbacks.append(callback)
+
+    def allow_request(self) -> bool:
+        """Returns if a request can be sent now. In half-open, a single probe request is let through at a time"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._outcomes.append(False)
+        self.consecutive_failures = 0
+        if self._state == HALF_OPEN:
+            logger.info("The probe request succeeded, closing the circuit breaker")
+            self._state = CLOSED
+            self._outcomes.clear()
+            self.consecutive_trips = 0
+
+    def release_probe(self):
+        """Frees the probe slot without an outcome, ex: the probe was throttled, which says nothing about the API"""
+        if self._state == HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        self._outcomes.append(True)
+        self.consecutive_failures += 1
+
+        if self._state == HALF_OPEN:
+            self._trip("the probe request failed")
+        elif self._state == CLOSED:
+            if self.consecutive_failures >= self.failure_threshold:
+                self._trip(f"{self.consecutive_failures} requests failed in a row")
+            elif len(self._outcomes) >= self.min_requests:
+                error_rate = sum(self._outcomes) / len(self._outcomes)
+                if error_rate >= self.error_rate_threshold:
+                    self._trip(
+                        f"{error_rate:.0%} of the last {len(self._outcomes)} requests failed"
+                    )
+
+    def _trip(self, reason: str):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self.consecutive_trips += 1
+        logger.error(
+            "Opening the circuit breaker of the Places API: %s. Probing again in %s seconds",
+            reason,
+            self.reset_seconds,
+        )
+        for callback in self._on_open_callbacks:
+            callback()
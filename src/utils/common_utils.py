@@ -29,5 +29,7 @@ def transform_stores_list_to_sheet_row_format(stores: List[Store]) -> List[List]
     for store in stores:
         values.append(store.to_sheet_row())
 
-    logger.debug(f"These are the values to be sent to Google Sheets: {values}")
+    # Lazily formatted: an f-string would build the repr of every row even when the debug logs are off, which
+    # cost more CPU than building the rows themselves on large batches
+    logger.debug("These are the values to be sent to Google Sheets: %s", values)
     return values
@@ -1,74 +1,310 @@
-import boto3
-from typing import List
+import logging
+import os
+import random
+import time
+
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event, Lock
 
-# for type hinting, using the boto3 stubs library. See this for more info:
-# https://stackoverflow.com/questions/49563445/type-annotation-for-boto3-resources-like-dynamodb-table
-from mypy_boto3_dynamodb import ServiceResource
+from utils.logger import hot_path_logger, logger
+from utils.metrics import get_metrics
+from models.store import Store
+from models.checkpoint import RunCheckpoint, run_checkpoint_id
 
-dynamodb_client: ServiceResource = boto3.resource("dynamodb")
-table = dynamodb_client.Table("UberEats_scraped_stores_data")
+if TYPE_CHECKING:
+    # for type hinting, using the boto3 stubs library. See this for more info:
+    # https://stackoverflow.com/questions/49563445/type-annotation-for-boto3-resources-like-dynamodb-table
+    from mypy_boto3_dynamodb.service_resource import Table
 
-from utils.logger import logger
-from models.store import Store
+TABLE_NAME = "UberEats_scraped_stores_data"
 
+# Built on first use rather than at import: importing boto3 and creating the resource is the most expensive part of
+# importing this module, and it used to land on the cold start of the Lambda (and of every script importing the module)
+table: Optional["Table"] = None
+# the default boto3 session isn't thread-safe, the first use can come from the workers of the parallel scan
+_table_lock = Lock()
 
-def get_batch_of_unprocessed_stores(limit=1000) -> List[Store]:
-    stores = []
-    last_evaluated_key = None
-    call_count = 0
 
-    # .query() can return up to 100 items at a time, so we have to do multiple requests to get our desired batch size
-    # it will return "LastEvaluatedKey" if there are more items obtained from the query but were not sent. If so,
+def get_table() -> "Table":
+    global table
+    if table is None:
+        with _table_lock:
+            if table is None:
+                import boto3
+
+                table = boto3.resource("dynamodb").Table(TABLE_NAME)
+    return table
+
+
+# Only the attributes of the Store model are read from the table (by their names in DynamoDB, ex: "area/city"), which
+# keeps the responses small and leaves out any other attribute that's set on the items
+STORE_ATTRIBUTES = [
+    field.alias or name
+    for name, field in Store.model_fields.items()
+    if not field.exclude
+]
+
+
+def _store_attributes_projection() -> dict:
+    # Attribute names like 'name' and 'status' are reserved keywords by DynamoDB, and 'area/city' has a special
+    # character, so all of them are referenced through aliases
+    attribute_names = {
+        f"#a{i}": attribute for i, attribute in enumerate(STORE_ATTRIBUTES)
+    }
+    return {
+        "ProjectionExpression": ", ".join(attribute_names),
+        "ExpressionAttributeNames": attribute_names,
+    }
+
+
+def _iter_query_responses(
+    params: dict, limit: int, page_size: Optional[int] = None
+) -> Iterator[dict]:
+    """Yields the responses of a paginated query, requesting the next page in the background while the caller processes the current one"""
+    # Without a page size, the pages are as large as the 1MB cap allows
+    page_size = page_size or limit
+    fetched_count = 0
+
+    # A single worker is enough: the pages of a query have to be requested in order, the gain is in overlapping the
+    # network round-trip of the next page with the validation of the current one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_response = executor.submit(
+            get_table().query, **params, Limit=min(limit, page_size)
+        )
+
+        while next_response is not None:
+            response = next_response.result()
+            fetched_count += len(response.get("Items", []))
+
+            next_response = None
+            last_evaluated_key = response.get("LastEvaluatedKey")
+            if last_evaluated_key and fetched_count < limit:
+                next_response = executor.submit(
+                    get_table().query,
+                    **params,
+                    Limit=min(limit - fetched_count, page_size),
+                    ExclusiveStartKey=last_evaluated_key,
+                )
+
+            yield response
+
+
+def _validate_page_of_stores(items: List[dict]) -> List[Store]:
+    # Pydantic will validate every item as it's converted
+    try:
+        return Store.from_dynamodb_items(items)
+    except Exception as e:
+        logger.error("Error parsing stores: %s", e)
+        return []
+
+
+def iter_pages_of_unprocessed_stores(
+    limit=1000, status="pending", page_size: Optional[int] = None
+) -> Iterator[List[Store]]:
+    """Yields the stores with the given status page by page, as they're returned by the query, up to `limit` stores"""
+    # .query() returns up to 1MB of data (or `Limit` items) at a time, so we have to do multiple requests to get our desired
+    # batch size. It will return "LastEvaluatedKey" if there are more items matched by the query but were not sent. If so,
     # we keep querying starting from this "LastEvaluatedKey" till it's not returned anymore or we reach our batch limit.
-    # The max is 1MB of data but I'm setting it to 100 items here for simplicity and to fetch only the number of items needed.
-    # Using a larger limit doesn't guarantee that we'll get the full number of items, due to the pagination in the query process.
-    # using .query() with the GSI is much faster than using .scan().
-    while len(stores) < limit:
-
-        # This is analogous to SQL SELECT * FROM UberEatsStores WHERE status = 'pending' LIMIT limit;
-        scan_params = {
-            "IndexName": "status-index",  # This is defined as a Global Secondary Index (GSI) when creating the table
-            "Limit": min(
-                limit - len(stores), 100
-            ),  # 100 because is the maximum, and the substraction is to not fetch
-            # more data that we need to.
-            "KeyConditionExpression": "#s = :s",
-            "ExpressionAttributeNames": {
-                "#s": "status"
-            },  # defines '#s' as an alias for 'status'. Not mandatory to define aliases for Names but we can't use
-            #'status' here directly in the KeyConditionExpression because it's a reserved keyword by Dynamodb
-            "ExpressionAttributeValues": {
-                ":s": "pending"
-            },  # defines ':s' as an alias for 'pending', it's mandatory to define aliases for values because Dynamodb
-            # doesn't allow direct strings in the query
-        }
-
-        if last_evaluated_key:
-            scan_params["ExclusiveStartKey"] = last_evaluated_key
-
-        response = table.query(**scan_params)
-
-        call_count += 1
-
-        # Pydantic will validate every item as it's converted
-        try:
-            stores.extend(
-                [Store.from_dynamodb_item(store) for store in response.get("Items", [])]
-            )
-        except Exception as e:
-            logger.error(f"Error parsing stores: {e}")
+    # The Limit is set to the number of stores still needed, so that the pages are as large as the 1MB cap allows while
+    # never fetching more data than we need to. Using .query() with the GSI is much faster than using .scan().
+
+    if limit <= 0:
+        return
 
+    # This is analogous to SQL SELECT <store attributes> FROM UberEatsStores WHERE status = 'pending' LIMIT limit;
+    projection = _store_attributes_projection()
+    query_params = {
+        "IndexName": "status-index",  # This is defined as a Global Secondary Index (GSI) when creating the table
+        "KeyConditionExpression": "#s = :s",
+        "ProjectionExpression": projection["ProjectionExpression"],
+        "ExpressionAttributeNames": {
+            "#s": "status",
+            **projection["ExpressionAttributeNames"],
+        },  # defines '#s' as an alias for 'status'. We can't use 'status' here directly in the KeyConditionExpression
+        # because it's a reserved keyword by Dynamodb
+        "ExpressionAttributeValues": {
+            ":s": status
+        },  # defines ':s' as an alias for the status, it's mandatory to define aliases for values because Dynamodb
+        # doesn't allow direct strings in the query
+    }
+
+    fetched_count = 0
+    for call_count, response in enumerate(
+        _iter_query_responses(query_params, limit, page_size), start=1
+    ):
+        stores = _validate_page_of_stores(response.get("Items", []))
+
+        fetched_count += len(stores)
         logger.debug(
-            f"Called the Query method {call_count} times, this is the length of the stores so far: {len(stores)}"
+            "Called the Query method %s times, this is the length of the stores so far: %s",
+            call_count,
+            fetched_count,
         )
 
-        last_evaluated_key = response.get("LastEvaluatedKey")
+        if stores:
+            yield stores
 
-        if not last_evaluated_key:
-            break  # Stop if there are no more items
 
-    logger.info(f"Fetched {len(stores)} stores")
+def iter_pages_of_stores_parallel_scan(
+    limit=None, status="pending", total_segments=8
+) -> Iterator[List[Store]]:
+    """Yields the stores with the given status by scanning the table in parallel segments, a read-only export of the table"""
+    # The query on the GSI can only be paginated serially. For reads that cover a large part of the table (ex: an
+    # export or an audit of the stores), a parallel scan splits the table into segments that are read concurrently,
+    # each one by its own worker. The order of the yielded pages is the order in which the segments return them.
+    # It's read-only: the stores aren't claimed (see claim_stores), so it's not safe to look up or write back the stores
+    # it returns while the pipeline runs, two runs would pay for the same lookups. The pipeline and backfill.py read
+    # through iter_pages_of_stores_to_process instead, and the role of the Lambda isn't granted dynamodb:Scan.
+    projection = _store_attributes_projection()
+    scan_params = {
+        "FilterExpression": "#s = :s",
+        "ProjectionExpression": projection["ProjectionExpression"],
+        "ExpressionAttributeNames": {
+            "#s": "status",
+            **projection["ExpressionAttributeNames"],
+        },
+        "ExpressionAttributeValues": {":s": status},
+        "TotalSegments": total_segments,
+    }
+
+    def _scan_segment(segment: int, pages: Queue):
+        try:
+            last_evaluated_key = None
+            while True:
+                params = {**scan_params, "Segment": segment}
+                if last_evaluated_key:
+                    params["ExclusiveStartKey"] = last_evaluated_key
+                response = get_table().scan(**params)
+                pages.put(response.get("Items", []))
+
+                last_evaluated_key = response.get("LastEvaluatedKey")
+                if not last_evaluated_key or stop_scanning.is_set():
+                    break
+        finally:
+            pages.put(None)  # marks the end of this segment
+
+    # bounded so that the memory stays flat when the consumer is slower than the scan
+    pages = Queue(maxsize=2 * total_segments)
+    stop_scanning = Event()
+    fetched_count = 0
+    finished_segments = 0
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(_scan_segment, segment, pages)
+
+        try:
+            while finished_segments < total_segments:
+                items = pages.get()
+                if items is None:
+                    finished_segments += 1
+                    continue
+
+                stores = _validate_page_of_stores(items)
+                if limit is not None:
+                    stores = stores[: limit - fetched_count]
+                fetched_count += len(stores)
+
+                if stores:
+                    yield stores
+
+                if limit is not None and fetched_count >= limit:
+                    break
+        finally:
+            # let the workers finish their current page and drain what they put, so none of them blocks on the queue
+            stop_scanning.set()
+            while finished_segments < total_segments:
+                if pages.get() is None:
+                    finished_segments += 1
+
+
+def count_stores_with_status(status: str) -> int:
+    """Counts the stores with the given status, ex: to know how much of the backlog is left"""
+    # Select=COUNT returns the number of matching items without the items themselves, the query is still paginated
+    # by the 1MB of the index read per request
+    query_params = {
+        "IndexName": "status-index",
+        "KeyConditionExpression": "#s = :s",
+        "ExpressionAttributeNames": {"#s": "status"},
+        "ExpressionAttributeValues": {":s": status},
+        "Select": "COUNT",
+    }
+    count = 0
+    while True:
+        response = get_table().query(**query_params)
+        count += response["Count"]
+        if "LastEvaluatedKey" not in response:
+            return count
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def get_batch_of_unprocessed_stores(limit=1000, status="pending") -> List[Store]:
+    stores = []
+    for page in iter_pages_of_unprocessed_stores(limit=limit, status=status):
+        stores.extend(page)
+
+    logger.info("Fetched %s stores with status '%s'", len(stores), status)
+
+    return stores
+
+
+def _iter_pages_of_claimed_stores(
+    limit: int, status: str, lease_owner: str, page_size: Optional[int] = None
+) -> Iterator[List[Store]]:
+    """Yields the stores with the given status that were claimed by `lease_owner`, page by page, up to `limit` stores"""
+    claimed_count = 0
+    for _ in range(CLAIM_MAX_ROUNDS):
+        # The stores claimed by the other workers leave the pending stores, so the query is run again to fill the
+        # batch when claims were lost. A round that claims nothing means the rest is held by the other workers.
+        claimed_in_round = 0
+        lost_in_round = 0
+        for page in iter_pages_of_unprocessed_stores(
+            limit=limit - claimed_count, status=status, page_size=page_size
+        ):
+            stores = claim_stores(page, lease_owner)
+            claimed_in_round += len(stores)
+            lost_in_round += len(page) - len(stores)
+            if stores:
+                yield stores
+
+        claimed_count += claimed_in_round
+        if not lost_in_round or not claimed_in_round or claimed_count >= limit:
+            break
+
+
+def iter_pages_of_stores_to_process(
+    limit=1000, page_size: Optional[int] = None, lease_owner: Optional[str] = None
+) -> Iterator[List[Store]]:
+    """Yields the stores fetched by earlier runs but not exported yet first, then the pending ones, up to `limit` stores"""
+    # With a lease owner, only the stores claimed by it are yielded, so that concurrent runs split the stores between
+    # them instead of looking up the same ones
+    remaining_count = limit
+    # The "fetched" stores already have their (paid for) phone numbers, an earlier run stopped before exporting them
+    for status in ("fetched", "pending"):
+        if lease_owner is None:
+            pages = iter_pages_of_unprocessed_stores(
+                limit=remaining_count, status=status, page_size=page_size
+            )
+        else:
+            pages = _iter_pages_of_claimed_stores(
+                remaining_count, status, lease_owner, page_size
+            )
+        for page in pages:
+            remaining_count -= len(page)
+            yield page
+
+
+def get_batch_of_stores_to_process(
+    limit=1000, lease_owner: Optional[str] = None
+) -> List[Store]:
+    stores = []
+    for page in iter_pages_of_stores_to_process(limit=limit, lease_owner=lease_owner):
+        stores.extend(page)
+
+    logger.info("Fetched %s stores to process", len(stores))
 
     return stores
 
@@ -78,28 +314,576 @@ def get_batch_of_unprocessed_stores(limit=1000) -> List[Store]:
 # print(f"These are the fetched stores: {stores}, with length: {len(stores)}")
 
 
-def update_status_of_items_to_processed_in_DB(stores: List[Store]):
+# The write-back is done by a bounded pool of concurrent writers, each one sending a single partial update per store
+WRITE_BACK_CONCURRENCY = int(os.getenv("WRITE_BACK_CONCURRENCY", 16))
+WRITE_BACK_MAX_RETRIES = 5
+WRITE_BACK_BACKOFF_BASE = 0.1  # seconds, doubled on every retry
+# Errors returned by DynamoDB when it's throttling the requests or has a transient failure, the update is retried
+RETRYABLE_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+    "ServiceUnavailable",
+}
+
+
+class WriteBackResult:
+    """The outcome of writing back a batch of stores, with the reason of the failure of every store that wasn't updated"""
+
+    def __init__(self, status: str):
+        self.status = status
+        self.updated_count = 0
+        self.failures = {}  # store_id -> reason
+
+    def __repr__(self):
+        return f"WriteBackResult(status={self.status!r}, updated_count={self.updated_count}, failures={len(self.failures)})"
+
+
+def _lease_owner_condition(lease_owner: Optional[str]) -> Tuple[str, dict]:
+    # A run only moves forward the stores it claimed, or stores that were never claimed. If its lease expired and the
+    # store was claimed by another run in the meantime, the update fails as stale.
+    if lease_owner is None:
+        return "", {}
+    return (
+        " AND (attribute_not_exists(lease_owner) OR lease_owner = :lease_owner)",
+        {":lease_owner": lease_owner},
+    )
+
+
+def _update_store_status(
+    store: Store,
+    status: str,
+    expected_statuses: List[str],
+    last_processed_at: str,
+    lease_owner: Optional[str] = None,
+):
+    # Only the attributes changed by the pipeline are sent, the rest of the item is left untouched. The condition makes
+    # a stale overwrite impossible: the update only goes through if the store is still in one of the expected statuses
+    # (ex: a store that's already processed is never moved back to fetched), and never creates a new item.
+    expected_values = {
+        f":expected{i}": value for i, value in enumerate(expected_statuses)
+    }
+    lease_condition, lease_values = _lease_owner_condition(lease_owner)
+    update_expression = "SET #s = :status, phone_number = :phone_number, last_processed_at = :last_processed_at"
+    if status == "processed":
+        # the lease is only needed until the store is exported
+        update_expression += " REMOVE lease_owner, lease_expires_at"
+
+    stores_table = get_table()
+    stores_table.meta.client.update_item(
+        TableName=stores_table.name,
+        Key={"store_id": store.store_id},
+        UpdateExpression=update_expression,
+        ConditionExpression=f"attribute_exists(store_id) AND #s IN ({', '.join(expected_values)})"
+        + lease_condition,
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={
+            ":status": status,
+            ":phone_number": store.phone_number,
+            ":last_processed_at": last_processed_at,
+            **expected_values,
+            **lease_values,
+        },
+    )
+
+
+def _call_with_retries(update: Callable[[], None], stale_reason: str) -> Optional[str]:
+    """Sends a conditional update, retrying the throttled ones. Returns the reason of the failure, None on success"""
+    # imported on first use like boto3 in get_table(), so that importing this module stays cheap (see bench_cold_start.py)
+    from botocore.exceptions import ClientError
+
+    for retry_count in range(WRITE_BACK_MAX_RETRIES + 1):
+        try:
+            update()
+            return None
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code == "ConditionalCheckFailedException":
+                return stale_reason
+            if error_code not in RETRYABLE_ERROR_CODES:
+                return f"{error_code}: {e}"
+            reason = error_code
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+
+        if retry_count < WRITE_BACK_MAX_RETRIES:
+            get_metrics().increment("WriteBackRetries")
+            # exponential back off with full jitter, to spread out the retries of the concurrent writers
+            time.sleep(random.uniform(0, WRITE_BACK_BACKOFF_BASE * 2**retry_count))
+
+    return f"{reason} after {WRITE_BACK_MAX_RETRIES} retries"
+
+
+def _update_store_status_with_retries(
+    store: Store,
+    status: str,
+    expected_statuses: List[str],
+    lease_owner: Optional[str] = None,
+) -> Optional[str]:
+    """Returns the reason of the failure, None if the store was updated"""
+    last_processed_at = str(datetime.now())
 
-    with table.batch_writer() as batch:
-        for store in stores:
-            store.last_processed_at = str(datetime.now())
+    failure_reason = _call_with_retries(
+        lambda: _update_store_status(
+            store, status, expected_statuses, last_processed_at, lease_owner
+        ),
+        stale_reason=f"stale: the store is no longer in the {expected_statuses} statuses"
+        + (f" or claimed by {lease_owner}" if lease_owner else ""),
+    )
+    if failure_reason is None:
+        store.status = status
+        store.last_processed_at = last_processed_at
+    return failure_reason
 
-            batch.put_item(store.to_dynamodb_item())
 
-    logger.info(f"Updated {len(stores)} stores' status to processed in DynamoDB")
+def update_status_of_items_in_DB(
+    stores: List[Store],
+    status: str,
+    expected_statuses: List[str],
+    lease_owner: Optional[str] = None,
+) -> WriteBackResult:
+    result = WriteBackResult(status)
+    if not stores:
+        return result
+
+    metrics = get_metrics()
+    with metrics.timer("WriteBack"), ThreadPoolExecutor(
+        max_workers=min(WRITE_BACK_CONCURRENCY, len(stores))
+    ) as executor:
+        failure_reasons = executor.map(
+            lambda store: _update_store_status_with_retries(
+                store, status, expected_statuses, lease_owner
+            ),
+            stores,
+        )
+
+        for store, failure_reason in zip(stores, failure_reasons):
+            if failure_reason is None:
+                result.updated_count += 1
+            else:
+                result.failures[store.store_id] = failure_reason
+
+    metrics.increment("WriteBackFailures", len(result.failures))
+    logger.info(
+        "Updated %s stores' status to %s in DynamoDB", result.updated_count, status
+    )
+    for store_id, failure_reason in result.failures.items():
+        hot_path_logger.error(
+            "Couldn't update the status of store %s to %s: %s",
+            store_id,
+            status,
+            failure_reason,
+        )
+
+    return result
+
+
+def drop_stores_not_written_back(
+    stores: List[Store], result: WriteBackResult, lease_owner: Optional[str] = None
+) -> List[Store]:
+    """Returns the stores that were written back, the others are left out of the batch and their leases released"""
+    if not result.failures:
+        return stores
+
+    # A store whose fetched update failed is still in_progress (or claimed by another run), exporting it would leave it
+    # unprocessed, and looked up and exported again once its lease expires
+    failed_stores = [store for store in stores if store.store_id in result.failures]
+    logger.warning(
+        "%s stores couldn't be marked %s, they're left out of the batch for the next run",
+        len(failed_stores),
+        result.status,
+    )
+    if lease_owner is not None:
+        release_leases(failed_stores, lease_owner)
+    return [store for store in stores if store.store_id not in result.failures]
+
+
+def update_status_of_items_to_processed_in_DB(
+    stores: List[Store], lease_owner: Optional[str] = None
+) -> WriteBackResult:
+    return update_status_of_items_in_DB(
+        stores,
+        status="processed",
+        expected_statuses=["pending", "fetched"],
+        lease_owner=lease_owner,
+    )
+
+
+def update_status_of_items_to_fetched_in_DB(
+    stores: List[Store], lease_owner: Optional[str] = None
+) -> WriteBackResult:
+    """Persists the paid for phone numbers of stores that are not yet exported to the Google Sheet and Slack"""
+    return update_status_of_items_in_DB(
+        stores,
+        status="fetched",
+        expected_statuses=["pending", "in_progress"],
+        lease_owner=lease_owner,
+    )
 
 
 # To update the status of the processed items in DynamoDB, we can consider 2 main ways: updating each item one by one
-# using a for loop (because there's no straight-forward batch update functionality for DynamoDB) OR Overwriting all the
-# attributes of the items to be updated by using the batch_writer() context manager. The latter is much faster.
-# We mentioned why batch_writer() is superior in deployment/scripts/upload_dataset_to_dynamodb.py. But we have to keep in mind not
-# to erase any attributes by not including them in the attributes to be overriden. Since this table has a fixed schema
-# and we know we won't be missing any attributes, we can use this method, otherwise update using a for loop.
-# There's no update method for batch_writer(), only put or delete.
+# (because there's no straight-forward batch update functionality for DynamoDB) OR Overwriting all the attributes of the
+# items to be updated by using the batch_writer() context manager. There's no update method for batch_writer(), only put
+# or delete, and the overwrite has to include every attribute not to erase any of them, so it can silently revert a
+# concurrent change of the item. Sending the updates one by one in a for loop was much slower than the batch_writer():
 
 # For a batch of 1000 items:
 # Updating using a for loop with table.update_item() took 215.99836349487305 seconds
 # Updating by overwriting the items using table.batch_writer() took 46.77561330795288 seconds
 
+# Both were bound by the round-trips of a single thread (and the 5 WCU provisioned for the table at the time). The updates
+# are now sent by a pool of concurrent writers, which makes the partial conditional updates faster than the overwrites
+# while only touching the changed attributes. Run benchmarks/bench_dynamodb_write_back.py to compare them.
+
 # Example Usage:
 # update_status_of_items_to_processed_in_DB(get_batch_of_unprocessed_stores())
+
+
+# Concurrent runs (ex: overlapping invocations of the Lambda, or several workers splitting a large backlog) would all
+# read the same pending stores from the status-index GSI and pay for the same lookups. Every run claims the stores it
+# reads with a conditional update first: a pending store moves to "in_progress" with the run as its lease owner and a
+# lease expiry, and a fetched store (already looked up by a run that stopped before exporting it) gets a lease without
+# changing its status. Only one run can win the claim of a store, the others skip it. A store whose run died keeps its
+# lease until it expires, then release_expired_leases() moves it back to pending for the next runs.
+# The lease has to outlive a run: the default is a bit longer than the 15 minutes max duration of a Lambda invocation.
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", 960))
+# How many times the pending stores are queried again to fill the batch when claims were lost to the other runs
+CLAIM_MAX_ROUNDS = 3
+
+
+def _claim_store(store: Store, lease_owner: str, lease_expires_at: int, now: int):
+    if store.status == "pending":
+        update_expression = "SET #s = :in_progress, lease_owner = :lease_owner, lease_expires_at = :lease_expires_at"
+        condition_expression = "#s = :pending"
+        values = {":in_progress": "in_progress", ":pending": "pending"}
+    else:
+        update_expression = (
+            "SET lease_owner = :lease_owner, lease_expires_at = :lease_expires_at"
+        )
+        # a store can't be claimed while the lease of another run on it is still running
+        condition_expression = "#s = :status AND (attribute_not_exists(lease_expires_at) OR lease_expires_at < :now)"
+        values = {":status": store.status, ":now": now}
+
+    stores_table = get_table()
+    stores_table.meta.client.update_item(
+        TableName=stores_table.name,
+        Key={"store_id": store.store_id},
+        UpdateExpression=update_expression,
+        ConditionExpression=condition_expression,
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={
+            ":lease_owner": lease_owner,
+            ":lease_expires_at": lease_expires_at,
+            **values,
+        },
+    )
+
+
+def claim_stores(
+    stores: List[Store], lease_owner: str, lease_seconds: int = LEASE_SECONDS
+) -> List[Store]:
+    """Claims the stores for `lease_owner` and returns the ones it won, the others are claimed by other runs"""
+    if not stores:
+        return []
+
+    now = int(time.time())
+    lease_expires_at = now + lease_seconds
+
+    # the claims are sent by a bounded pool of concurrent writers, same as the write-back
+    with ThreadPoolExecutor(
+        max_workers=min(WRITE_BACK_CONCURRENCY, len(stores))
+    ) as executor:
+        failure_reasons = list(
+            executor.map(
+                lambda store: _call_with_retries(
+                    lambda: _claim_store(store, lease_owner, lease_expires_at, now),
+                    stale_reason="claimed by another run",
+                ),
+                stores,
+            )
+        )
+
+    claimed_stores = []
+    for store, failure_reason in zip(stores, failure_reasons):
+        if failure_reason is None:
+            if store.status == "pending":
+                store.status = "in_progress"
+            claimed_stores.append(store)
+        elif failure_reason != "claimed by another run":
+            hot_path_logger.error(
+                "Couldn't claim store %s: %s", store.store_id, failure_reason
+            )
+
+    lost_count = len(stores) - len(claimed_stores)
+    get_metrics().increment("ClaimsLost", lost_count)
+    logger.debug(
+        "Claimed %s stores for %s, %s were claimed by other runs",
+        len(claimed_stores),
+        lease_owner,
+        lost_count,
+    )
+    return claimed_stores
+
+
+def _release_lease(store: Store, lease_owner: str):
+    params = {
+        "UpdateExpression": "REMOVE lease_owner, lease_expires_at",
+        "ConditionExpression": "lease_owner = :lease_owner",
+        "ExpressionAttributeValues": {":lease_owner": lease_owner},
+    }
+    if store.status == "in_progress":
+        # not looked up yet, it goes back to the pending stores. DynamoDB rejects the attribute names that aren't used
+        # by the expressions, so the alias of status is only passed here.
+        params["UpdateExpression"] = "SET #s = :pending " + params["UpdateExpression"]
+        params["ExpressionAttributeNames"] = {"#s": "status"}
+        params["ExpressionAttributeValues"][":pending"] = "pending"
+
+    stores_table = get_table()
+    stores_table.meta.client.update_item(
+        TableName=stores_table.name, Key={"store_id": store.store_id}, **params
+    )
+
+
+def release_leases(stores: List[Store], lease_owner: str) -> int:
+    """Releases the leases of a run that failed, so the next run can pick up its stores without waiting for them to expire"""
+    if not stores:
+        return 0
+
+    with ThreadPoolExecutor(
+        max_workers=min(WRITE_BACK_CONCURRENCY, len(stores))
+    ) as executor:
+        failure_reasons = list(
+            executor.map(
+                lambda store: _call_with_retries(
+                    lambda: _release_lease(store, lease_owner),
+                    stale_reason="not leased by this run",
+                ),
+                stores,
+            )
+        )
+
+    released_count = failure_reasons.count(None)
+    logger.info("Released the leases of %s stores of %s", released_count, lease_owner)
+    return released_count
+
+
+def _return_store_to_fetched(store: Store):
+    # Only the write of this run is undone: the condition on last_processed_at fails if another run updated the store
+    stores_table = get_table()
+    stores_table.meta.client.update_item(
+        TableName=stores_table.name,
+        Key={"store_id": store.store_id},
+        UpdateExpression="SET #s = :fetched",
+        ConditionExpression="#s = :processed AND last_processed_at = :last_processed_at",
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={
+            ":fetched": "fetched",
+            ":processed": "processed",
+            ":last_processed_at": store.last_processed_at,
+        },
+    )
+
+
+def return_processed_stores_to_fetched(stores: List[Store]) -> int:
+    """Moves back the stores this run marked as processed when their export failed, so the next run exports them"""
+    stores = [store for store in stores if store.status == "processed"]
+    if not stores:
+        return 0
+
+    with ThreadPoolExecutor(
+        max_workers=min(WRITE_BACK_CONCURRENCY, len(stores))
+    ) as executor:
+        failure_reasons = list(
+            executor.map(
+                lambda store: _call_with_retries(
+                    lambda: _return_store_to_fetched(store),
+                    stale_reason="updated by another run",
+                ),
+                stores,
+            )
+        )
+
+    returned_count = 0
+    for store, failure_reason in zip(stores, failure_reasons):
+        if failure_reason is None:
+            store.status = "fetched"
+            returned_count += 1
+        else:
+            hot_path_logger.error(
+                "Couldn't return store %s to fetched: %s",
+                store.store_id,
+                failure_reason,
+            )
+    logger.warning(
+        "The export failed, returned %s processed stores to fetched for the next run",
+        returned_count,
+    )
+    return returned_count
+
+
+# The stores whose lookup keeps failing (ex: a query the Places API rejects with a 400) would otherwise go back to
+# pending and be paid for again by every run. They're moved to the "failed" status after this many failed lookups, or
+# right away when the Places API answered with an error that won't change on a retry.
+MAX_LOOKUP_ATTEMPTS = int(os.getenv("MAX_LOOKUP_ATTEMPTS", 3))
+
+
+def _return_failed_lookup(store: Store, lease_owner: Optional[str]):
+    lookup_attempts = store.lookup_attempts + 1
+    status = (
+        "failed"
+        if not store.lookup_failure_retryable or lookup_attempts >= MAX_LOOKUP_ATTEMPTS
+        else "pending"
+    )
+    lease_condition, lease_values = _lease_owner_condition(lease_owner)
+
+    stores_table = get_table()
+    stores_table.meta.client.update_item(
+        TableName=stores_table.name,
+        Key={"store_id": store.store_id},
+        UpdateExpression="SET #s = :status, lookup_attempts = :lookup_attempts, last_lookup_error = :last_lookup_error "
+        "REMOVE lease_owner, lease_expires_at",
+        ConditionExpression="attribute_exists(store_id) AND #s IN (:pending, :in_progress)"
+        + lease_condition,
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={
+            ":status": status,
+            ":lookup_attempts": lookup_attempts,
+            ":last_lookup_error": store.last_lookup_error,
+            ":pending": "pending",
+            ":in_progress": "in_progress",
+            **lease_values,
+        },
+    )
+    store.status = status
+    store.lookup_attempts = lookup_attempts
+
+
+def return_failed_lookups_to_pending(
+    stores: List[Store], lease_owner: Optional[str] = None
+):
+    """Leaves the stores whose lookup failed for the next run, or marks them failed once their lookups keep failing"""
+    metrics = get_metrics()
+    metrics.increment("PlacesDeadLetters", len(stores))
+
+    # The lookups that were skipped (ex: by the circuit breaker or the Places API budget) don't count against the store,
+    # it's only released for the next run
+    failed_stores = [
+        store for store in stores if store.lookup_failure_retryable is not None
+    ]
+    skipped_stores = [
+        store for store in stores if store.lookup_failure_retryable is None
+    ]
+
+    failed_count = 0
+    if failed_stores:
+        with ThreadPoolExecutor(
+            max_workers=min(WRITE_BACK_CONCURRENCY, len(failed_stores))
+        ) as executor:
+            failure_reasons = executor.map(
+                lambda store: _call_with_retries(
+                    lambda: _return_failed_lookup(store, lease_owner),
+                    stale_reason="claimed by another run",
+                ),
+                failed_stores,
+            )
+            for store, failure_reason in zip(failed_stores, failure_reasons):
+                if failure_reason is not None:
+                    hot_path_logger.error(
+                        "Couldn't record the failed lookup of store %s: %s",
+                        store.store_id,
+                        failure_reason,
+                    )
+                elif store.status == "failed":
+                    failed_count += 1
+                    hot_path_logger.error(
+                        "Giving up on the lookup of store %s after %s attempts: %s",
+                        store.store_id,
+                        store.lookup_attempts,
+                        store.last_lookup_error,
+                    )
+        metrics.increment("StoresFailed", failed_count)
+
+    logger.warning(
+        "The lookups of %s stores failed: %s are left pending for the next run, %s are marked failed",
+        len(stores),
+        len(stores) - failed_count,
+        failed_count,
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "The stores whose lookup failed: %s", [store.store_id for store in stores]
+        )
+    # They were never written back, so they're still pending in the table unless they were claimed by this run
+    if skipped_stores and lease_owner is not None:
+        release_leases(skipped_stores, lease_owner)
+
+
+def release_expired_leases() -> Dict[str, int]:
+    """Moves the in_progress stores whose lease expired back to pending, returns how many were released by run"""
+    now = int(time.time())
+    query_params = {
+        "IndexName": "status-index",
+        "KeyConditionExpression": "#s = :in_progress",
+        "FilterExpression": "lease_expires_at < :now",
+        "ProjectionExpression": "store_id, lease_owner",
+        "ExpressionAttributeNames": {"#s": "status"},
+        "ExpressionAttributeValues": {":in_progress": "in_progress", ":now": now},
+    }
+
+    expired_items = []
+    while True:
+        response = get_table().query(**query_params)
+        expired_items.extend(response.get("Items", []))
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            break
+        query_params["ExclusiveStartKey"] = last_evaluated_key
+
+    def _release(store_id: str):
+        stores_table = get_table()
+        stores_table.meta.client.update_item(
+            TableName=stores_table.name,
+            Key={"store_id": store_id},
+            UpdateExpression="SET #s = :pending REMOVE lease_owner, lease_expires_at",
+            # the store may have been released and claimed again by another run since the query
+            ConditionExpression="#s = :in_progress AND lease_expires_at < :now",
+            ExpressionAttributeNames={"#s": "status"},
+            ExpressionAttributeValues={
+                ":pending": "pending",
+                ":in_progress": "in_progress",
+                ":now": now,
+            },
+        )
+
+    # the runs the stores were leased to didn't finish them, they're reported by the caller
+    released_counts = {}
+    for item in expired_items:
+        failure_reason = _call_with_retries(
+            lambda: _release(item["store_id"]), stale_reason="released by another run"
+        )
+        if failure_reason is None:
+            lease_owner = item.get("lease_owner")
+            released_counts[lease_owner] = released_counts.get(lease_owner, 0) + 1
+
+    released_count = sum(released_counts.values())
+    if released_count:
+        get_metrics().increment("LeasesReleased", released_count)
+        logger.warning(
+            "Released %s stores whose lease expired back to pending, their run didn't finish them",
+            released_count,
+        )
+    return released_counts
+
+
+# The checkpoint of every run of the pipeline is kept in the stores table as well, as an item with a reserved store_id.
+# It doesn't have a status attribute, so it never shows up in the queries of the status-index GSI.
+def load_run_checkpoint(run_id: str) -> Optional[RunCheckpoint]:
+    response = get_table().get_item(Key={"store_id": run_checkpoint_id(run_id)})
+    item = response.get("Item")
+    return RunCheckpoint.model_validate(item) if item else None
+
+
+def save_run_checkpoint(checkpoint: RunCheckpoint):
+    checkpoint.updated_at = str(datetime.now())
+    get_table().put_item(Item=checkpoint.model_dump())
@@ -0,0 +1,14 @@
+import os
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_env():
+    """Loads the variables of the .env file for the local runs, only once per process"""
+    # In Lambda the variables are set on the function itself, there's no .env file to look for
+    if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+        return
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
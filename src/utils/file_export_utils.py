@@ -0,0 +1,146 @@
+from typing import Iterable, Iterator, List
+import csv
+import datetime
+import gzip
+import os
+import tempfile
+import uuid
+from itertools import islice
+
+from utils.logger import logger
+from utils.common_utils import transform_stores_list_to_sheet_row_format
+from models.store import Store
+
+# The file export is the alternative to the Google Sheet for the large batches (ex: backfills): a sheet is capped at
+# 10M cells and every row is sent as JSON cells with two hyperlink formulas, while a compressed file of 50k stores is
+# written in a couple of seconds. The columns are the same as the ones of the sheet.
+
+# "csv" writes a gzip compressed CSV file, readable by any spreadsheet or script. "parquet" writes a columnar Parquet
+# file compressed with EXPORT_PARQUET_COMPRESSION, it needs pyarrow which isn't part of the Lambda layer.
+EXPORT_FILE_FORMAT = os.getenv("EXPORT_FILE_FORMAT", "csv").lower()
+EXPORT_PARQUET_COMPRESSION = os.getenv("EXPORT_PARQUET_COMPRESSION", "zstd")
+# A local directory, or an s3://bucket/prefix URL. The files are named after the time of the export.
+# In Lambda, /tmp is the only writable directory, so a local destination is only useful for the local runs.
+EXPORT_FILE_DESTINATION = os.getenv("EXPORT_FILE_DESTINATION", "exports")
+# The endpoint of an S3 compatible object store (ex: MinIO, Cloudflare R2), the default is AWS S3
+EXPORT_S3_ENDPOINT_URL = os.getenv("EXPORT_S3_ENDPOINT_URL")
+# The file is shared in Slack with a presigned URL, 7 days is the longest a SigV4 presigned URL can last. A URL signed
+# with temporary credentials (ex: the role of the Lambda) stops working when they expire, which can be sooner.
+EXPORT_LINK_EXPIRES_SECONDS = int(os.getenv("EXPORT_LINK_EXPIRES_SECONDS", 604800))
+# The rows are built and written this many stores at a time, so the rows of the whole batch are never in memory at once
+EXPORT_FILE_ROWS_PER_CHUNK = int(os.getenv("EXPORT_FILE_ROWS_PER_CHUNK", 10000))
+
+FILE_EXTENSIONS = {"csv": ".csv.gz", "parquet": ".parquet"}
+
+
+def _chunks_of_rows(stores: Iterable[Store]) -> Iterator[List[List[str]]]:
+    stores = iter(stores)
+    while True:
+        chunk = list(islice(stores, EXPORT_FILE_ROWS_PER_CHUNK))
+        if not chunk:
+            return
+        yield [store.to_sheet_row() for store in chunk]
+
+
+def _write_csv(file_path: str, header: List[str], stores: Iterable[Store]) -> int:
+    num_of_rows = 0
+    # compresslevel 6 is most of the compression of the default 9 for a fraction of its CPU time
+    with gzip.open(
+        file_path, mode="wt", encoding="utf-8", newline="", compresslevel=6
+    ) as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for rows in _chunks_of_rows(stores):
+            writer.writerows(rows)
+            num_of_rows += len(rows)
+    return num_of_rows
+
+
+def _write_parquet(file_path: str, header: List[str], stores: Iterable[Store]) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "The parquet export format needs pyarrow, install it with `pip install pyarrow` or use EXPORT_FILE_FORMAT=csv"
+        ) from e
+
+    schema = pa.schema([(column_name, pa.string()) for column_name in header])
+    num_of_rows = 0
+    # every chunk is written as a row group, the file is never held in memory as a whole
+    with pq.ParquetWriter(
+        file_path, schema, compression=EXPORT_PARQUET_COMPRESSION
+    ) as writer:
+        for rows in _chunks_of_rows(stores):
+            columns = [list(column) for column in zip(*rows)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            num_of_rows += len(rows)
+    return num_of_rows
+
+
+def _split_s3_url(url: str):
+    bucket, _, prefix = url[len("s3://") :].partition("/")
+    return bucket, prefix.strip("/")
+
+
+def _upload_to_s3(file_path: str, destination: str, file_name: str) -> str:
+    import boto3
+    from botocore.config import Config
+
+    bucket, prefix = _split_s3_url(destination)
+    key = f"{prefix}/{file_name}" if prefix else file_name
+    # the S3 compatible stores only accept SigV4 presigned URLs
+    s3 = boto3.client(
+        "s3",
+        endpoint_url=EXPORT_S3_ENDPOINT_URL,
+        config=Config(signature_version="s3v4"),
+    )
+
+    # upload_file streams the file from the disk, in concurrent multipart uploads for the large ones
+    s3.upload_file(file_path, bucket, key)
+    logger.info("Uploaded the export file to s3://%s/%s", bucket, key)
+
+    # the bucket stays private, the presigned URL is what makes the file downloadable from the Slack message
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=EXPORT_LINK_EXPIRES_SECONDS,
+    )
+
+
+def export_stores_to_file(
+    stores: Iterable[Store],
+    file_format: str = EXPORT_FILE_FORMAT,
+    destination: str = EXPORT_FILE_DESTINATION,
+) -> str:
+    """Writes the stores to a compressed CSV or Parquet file in a local directory or on S3, returns its path or URL"""
+    if file_format not in FILE_EXTENSIONS:
+        raise ValueError(f"Unknown export file format: {file_format}")
+
+    header = transform_stores_list_to_sheet_row_format([])[0]
+    # named after the date like the Google Sheets, with a random suffix so that the files of concurrent runs don't
+    # overwrite each other, ex: "store_leads_2025-02-02_101530_1f0c9a2e.csv.gz"
+    date = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    file_name = (
+        f"store_leads_{date}_{uuid.uuid4().hex[:8]}{FILE_EXTENSIONS[file_format]}"
+    )
+    write_file = _write_csv if file_format == "csv" else _write_parquet
+
+    if not destination.startswith("s3://"):
+        os.makedirs(destination, exist_ok=True)
+        file_path = os.path.join(destination, file_name)
+        num_of_rows = write_file(file_path, header, stores)
+        logger.info("Exported %s stores to %s", num_of_rows, file_path)
+        return os.path.abspath(file_path)
+
+    # the file is written to the disk first (/tmp in Lambda) and uploaded from there, keeping the memory used flat
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, file_name)
+        num_of_rows = write_file(file_path, header, stores)
+        logger.info(
+            "Exported %s stores to a %s file of %s bytes",
+            num_of_rows,
+            file_format,
+            os.path.getsize(file_path),
+        )
+        return _upload_to_s3(file_path, destination, file_name)
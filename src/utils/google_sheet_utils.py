@@ -3,20 +3,31 @@ import datetime
 import ast
 import json
 import os
-
-import gspread
-from google.oauth2.service_account import Credentials
-import boto3
-from dotenv import load_dotenv
+import random
+import time
 
 from utils.logger import logger
 from utils.common_utils import transform_stores_list_to_sheet_row_format
+from utils.env import load_env
+from utils.ttl_cache import CLIENT_CACHE_TTL_SECONDS, ttl_cache
 from models.store import Store
 
-load_dotenv()
+# gspread, google.oauth2 and boto3 are imported on first use, they're only needed at the end of the pipeline and take
+# a large part of the import time of the handler
+
+load_env()
+
+
+# A new access token is requested this long before the current one expires, so that it doesn't expire mid-batch
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
 
 
+# The credentials and the authorized client are kept across warm invocations, skipping the SSM round-trip, the parsing
+# of the credentials and the OAuth token exchange on every run
+@ttl_cache(CLIENT_CACHE_TTL_SECONDS)
 def _fetch_credentials_from_ssm():
+    import boto3
+
     ssm = boto3.client("ssm", region_name="us-east-1")
     response = ssm.get_parameter(
         Name="/UberEatsProject/google_credentials", WithDecryption=False
@@ -35,10 +46,21 @@ def _fetch_credentials_from_ssm():
     return json.loads(transform_s)
 
 
-def _create_google_sheet():
+def _access_token_is_fresh(client) -> bool:
+    creds = client.http_client.auth
+    if creds.token is None or creds.expiry is None:
+        return True  # the first token is fetched with the first request
+    # google-auth keeps the expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - TOKEN_EXPIRY_MARGIN > now
+
+
+@ttl_cache(CLIENT_CACHE_TTL_SECONDS, is_valid=_access_token_is_fresh)
+def _get_gspread_client():
+    import gspread
+    from google.oauth2.service_account import Credentials
 
     # credentials_file_path = "./google_credentials.json"
-    google_drive_folderID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
@@ -46,7 +68,26 @@ def _create_google_sheet():
     credentials_json = _fetch_credentials_from_ssm()
     creds = Credentials.from_service_account_info(credentials_json, scopes=scopes)
     # creds = Credentials.from_service_account_file(credentials_file_path, scopes=scopes)
-    client = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+
+# The ID of a spreadsheet formatted once by hand like the sheets of the batches: the header row, the column widths and
+# the format of the phone number column. When it's set, the sheet of every batch is a copy of it in the Drive folder,
+# and only the rows of the stores are written to it, instead of creating a blank sheet, sharing it and sending its
+# layout. The copy inherits the sharing of the folder (GOOGLE_DRIVE_FOLDER_ID), which has to be shared as "anyone with
+# the link can view" for the link sent to Slack to open. Without a folder, the copy is shared like a blank sheet.
+GOOGLE_SHEET_TEMPLATE_ID = os.getenv("GOOGLE_SHEET_TEMPLATE_ID")
+
+
+# The copies keep the IDs of the sheets of the template, so the ID of its first sheet is looked up once per container
+@ttl_cache(CLIENT_CACHE_TTL_SECONDS)
+def _get_template_sheet_id(template_id: str) -> int:
+    return _get_gspread_client().open_by_key(template_id).sheet1.id
+
+
+def _create_google_sheet():
+    google_drive_folderID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
+    client = _get_gspread_client()
 
     # Get current day of creation and add it to the name
     date = datetime.datetime.now()
@@ -54,96 +95,184 @@ def _create_google_sheet():
         "%B %d, %Y"
     )  # Formatting the datetime string to be "month_name, day, year", ex: "February 02, 2025"
 
-    logger.info(f"This is the current date: {date}")
+    logger.info("This is the current date: %s", date)
 
     spreadsheet_title = f"Store Leads - {date}"
-    workbook = client.create(spreadsheet_title, folder_id=google_drive_folderID)
+    try:
+        if GOOGLE_SHEET_TEMPLATE_ID:
+            # the template has no comments worth copying, and copying them is one more round-trip
+            workbook = client.copy(
+                GOOGLE_SHEET_TEMPLATE_ID,
+                title=spreadsheet_title,
+                folder_id=google_drive_folderID,
+                copy_comments=False,
+            )
+        else:
+            workbook = client.create(spreadsheet_title, folder_id=google_drive_folderID)
+    except Exception as e:
+        # The cached credentials may have been revoked or rotated since they were cached: they're fetched again for
+        # the next run, rather than failing every warm invocation until the TTL runs out
+        _fetch_credentials_from_ssm.cache_clear()
+        _get_gspread_client.cache_clear()
+        raise e
+
+    if not GOOGLE_SHEET_TEMPLATE_ID or not google_drive_folderID:
+        # Set sharing permission to allow anyone with the link to view, this is needed for it to be accessed in the slack channel
+        workbook.share(None, perm_type="anyone", role="reader")
 
-    # Set sharing permission to allow anyone with the link to view, this is needed for it to be accessed in the slack channel
-    workbook.share(None, perm_type="anyone", role="reader")
+    # using the first sheet only
+    if GOOGLE_SHEET_TEMPLATE_ID:
+        sheet_id = _get_template_sheet_id(GOOGLE_SHEET_TEMPLATE_ID)
+    else:
+        sheet_id = workbook.worksheet("Sheet1").id
 
     # we get the url of the Google Sheet and send it in the message for the slack channel
     workbook_url = workbook.url
-    logger.debug(f"This is the workbook url: {workbook_url}")
+    logger.debug("This is the workbook url: %s", workbook_url)
 
-    # using the first sheet only
-    sheet = workbook.worksheet("Sheet1")
+    logger.info("Finished creating the Google Sheet with name: %s", spreadsheet_title)
 
-    logger.info(f"Finished creating the Google Sheet with name: {spreadsheet_title}")
+    return workbook, sheet_id, workbook_url
 
-    return workbook, sheet, workbook_url
 
+# The values, formulas, formats and column widths are all sent with the spreadsheets.batchUpdate method, so a sheet of
+# up to SHEET_ROWS_PER_REQUEST rows is populated in a single round-trip. Larger batches are split into chunks of rows,
+# one request per chunk, to stay well under the 10MB max payload size of a request.
+SHEET_ROWS_PER_REQUEST = int(os.getenv("SHEET_ROWS_PER_REQUEST", 5000))
+SHEET_MAX_RETRIES = 5
+SHEET_BACKOFF_BASE = 2  # seconds, doubled on every retry
+# Sheets answers with a 429 when the per minute quota of write requests is exceeded, the 5xx are transient errors
+RETRYABLE_SHEET_ERROR_CODES = {429, 500, 502, 503, 504}
 
-def populate_google_sheet(stores: List[Store]):
-    """Creates and Populates a Google Sheet with processed stores data to be sent to the Slack channel"""
-    workbook, sheet, sheet_url = _create_google_sheet()
+# For columns:    A ,  B ,  C ,  D ,  E ,  F,   G
+COLUMN_WIDTHS = [250, 200, 400, 180, 350, 140, 200]  # in pixels
+PHONE_NUMBER_COLUMN_INDEX = 3  # D
+GOOGLE_MAPS_URL_COLUMN_INDEX = 6  # G
 
-    num_of_stores = len(stores)
 
-    # Adding the phone numbers found using Google Places API to the data to be put in the Google Sheet
-    clickable_phone_numbers = []
-    for store in stores:
-        num = store.phone_number
-        hyperlink_formula = f'=HYPERLINK("https://call.ctrlq.org/{num}", "{num}")'  # using tel: or telprompt: doesn't work here
-        clickable_phone_numbers.append([hyperlink_formula])
+def _string_cell(value) -> dict:
+    return {"userEnteredValue": {"stringValue": str(value)}}
 
-    # Adding a column to the data for the manually constructed URL for each store on Google Maps for better UX
-    hyperlinked_urls = []
-    for store in stores:
-        url = store.google_maps_url
-        hyperlink_formula = f'=HYPERLINK("{url}", "Open in Maps")'
-        hyperlinked_urls.append([hyperlink_formula])
 
-    values = transform_stores_list_to_sheet_row_format(stores)
+def _formula_cell(formula: str) -> dict:
+    return {"userEnteredValue": {"formulaValue": formula}}
 
-    # From A to G because we have 7 features for each store
-    sheet.update(values, range_name=f"A1:G{num_of_stores+1}")
 
-    # Formatting the values for better UX
-    white_smoke_rgb = (
-        230 / 255
-    )  # normalizing the rgb values of white smoke to between 0 and 1 because that's how the format method accepts them
+def _store_to_row_data(store: Store) -> dict:
+    """Converts a store to the cells of its row, with the phone number and the Google Maps URL as hyperlink formulas"""
+    cells = [_string_cell(value) for value in store.to_sheet_row()]
 
-    formats = [
-        {
-            "range": "A1:G1",
-            "format": {
-                "textFormat": {
-                    "bold": True,
-                },
-                "backgroundColor": {
-                    "red": white_smoke_rgb,
-                    "green": white_smoke_rgb,
-                    "blue": white_smoke_rgb,
-                },
+    # Adding the phone numbers found using Google Places API as clickable links
+    num = store.phone_number
+    cells[PHONE_NUMBER_COLUMN_INDEX] = _formula_cell(
+        f'=HYPERLINK("https://call.ctrlq.org/{num}", "{num}")'  # using tel: or telprompt: doesn't work here
+    )
+    # The manually constructed URL for each store on Google Maps for better UX
+    cells[GOOGLE_MAPS_URL_COLUMN_INDEX] = _formula_cell(
+        f'=HYPERLINK("{store.google_maps_url}", "Open in Maps")'
+    )
+    return {"values": cells}
+
+
+def _update_cells_request(
+    sheet_id: int, start_row_index: int, rows: List[dict]
+) -> dict:
+    return {
+        "updateCells": {
+            "start": {
+                "sheetId": sheet_id,
+                "rowIndex": start_row_index,
+                "columnIndex": 0,
             },
-        },
+            "rows": rows,
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def _sheet_layout_requests(
+    sheet_id: int, num_of_stores: int, from_template: bool = False
+) -> List[dict]:
+    """The requests sizing the sheet, writing the header and formatting the columns"""
+    # normalizing the rgb values of white smoke to between 0 and 1 because that's how the API accepts them
+    white_smoke_rgb = 230 / 255
+    header = transform_stores_list_to_sheet_row_format([])[0]
+
+    requests = [
+        # A new sheet has 1000 rows, it's resized to fit the batch since cells can't be written outside of the grid
         {
-            "range": f"D2:D{num_of_stores+1}",
-            "format": {
-                "textFormat": {
-                    "bold": False,
+            "updateSheetProperties": {
+                "properties": {
+                    "sheetId": sheet_id,
+                    "gridProperties": {
+                        "rowCount": num_of_stores + 1,
+                        "columnCount": len(header),
+                    },
                 },
-            },
-            "hyperlinkDisplayType": "LINKED",
+                "fields": "gridProperties(rowCount,columnCount)",
+            }
         },
     ]
-    # batch_format is for the formatting
-    sheet.batch_format(formats)
-
-    # Update hyperlinks with raw=False to ensure formula evaluation instead of rendering as text
-    sheet.update(hyperlinked_urls, range_name=f"G2:G{num_of_stores+1}", raw=False)
-    sheet.update(
-        clickable_phone_numbers, range_name=f"D2:D{num_of_stores+1}", raw=False
+    # a copy of the template has its header and its formats already, it only needs to be sized
+    if from_template:
+        return requests
+
+    requests.extend(
+        [
+            {
+                "updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                    "rows": [
+                        {
+                            "values": [
+                                {
+                                    **_string_cell(column_name),
+                                    "userEnteredFormat": {
+                                        "textFormat": {"bold": True},
+                                        "backgroundColor": {
+                                            "red": white_smoke_rgb,
+                                            "green": white_smoke_rgb,
+                                            "blue": white_smoke_rgb,
+                                        },
+                                    },
+                                }
+                                for column_name in header
+                            ]
+                        }
+                    ],
+                    "fields": "userEnteredValue,userEnteredFormat(textFormat,backgroundColor)",
+                }
+            },
+        ]
     )
 
-    # For columns:    A ,  B ,  C ,  D ,  E ,  F,   G
-    column_widths = [250, 200, 400, 180, 350, 140, 200]  # in pixels
-    requests = [
+    if num_of_stores:
+        requests.append(
+            {
+                "repeatCell": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "startRowIndex": 1,
+                        "endRowIndex": num_of_stores + 1,
+                        "startColumnIndex": PHONE_NUMBER_COLUMN_INDEX,
+                        "endColumnIndex": PHONE_NUMBER_COLUMN_INDEX + 1,
+                    },
+                    "cell": {
+                        "userEnteredFormat": {
+                            "textFormat": {"bold": False},
+                            "hyperlinkDisplayType": "LINKED",
+                        }
+                    },
+                    "fields": "userEnteredFormat(textFormat,hyperlinkDisplayType)",
+                }
+            }
+        )
+
+    requests.extend(
         {
             "updateDimensionProperties": {
                 "range": {
-                    "sheetId": sheet.id,  # Get sheet ID dynamically
+                    "sheetId": sheet_id,
                     "dimension": "COLUMNS",
                     "startIndex": i,  # Column index (0-based)
                     "endIndex": i + 1,
@@ -152,13 +281,60 @@ def populate_google_sheet(stores: List[Store]):
                 "fields": "pixelSize",
             }
         }
-        for i, col_width in enumerate(column_widths)
-    ]
-    # using batch_update for column width adjustments, see this for more info on the specific requests:
-    # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/batchUpdate
-    workbook.batch_update(body={"requests": requests})
+        for i, col_width in enumerate(COLUMN_WIDTHS)
+    )
+    return requests
+
+
+def _batch_update_with_retries(workbook, requests: List[dict]):
+    from gspread.exceptions import APIError
+
+    for retry_count in range(SHEET_MAX_RETRIES + 1):
+        try:
+            return workbook.batch_update(body={"requests": requests})
+        except APIError as e:
+            if (
+                e.code not in RETRYABLE_SHEET_ERROR_CODES
+                or retry_count == SHEET_MAX_RETRIES
+            ):
+                raise
+            # exponential back off with jitter, the write quota is refilled every minute
+            wait_time = SHEET_BACKOFF_BASE**retry_count + random.uniform(0, 1)
+            logger.warning(
+                "Google Sheets error %s - Retrying in %.2f seconds...",
+                e.code,
+                wait_time,
+            )
+            time.sleep(wait_time)
 
-    logger.info("Google Sheet updated successfully")
+
+def populate_google_sheet(stores: List[Store]):
+    """Creates and Populates a Google Sheet with processed stores data to be sent to the Slack channel"""
+    workbook, sheet_id, sheet_url = _create_google_sheet()
+
+    num_of_stores = len(stores)
+    rows = [_store_to_row_data(store) for store in stores]
+
+    # The first chunk of rows is sent together with the layout of the sheet, see this for more info on the requests:
+    # https://developers.google.com/sheets/api/reference/rest/v4/spreadsheets/batchUpdate
+    requests = _sheet_layout_requests(
+        sheet_id, num_of_stores, from_template=bool(GOOGLE_SHEET_TEMPLATE_ID)
+    )
+    num_of_requests = 0
+    for chunk_start in range(0, max(num_of_stores, 1), SHEET_ROWS_PER_REQUEST):
+        chunk = rows[chunk_start : chunk_start + SHEET_ROWS_PER_REQUEST]
+        if chunk:
+            # + 1 for the header row
+            requests.append(_update_cells_request(sheet_id, chunk_start + 1, chunk))
+        _batch_update_with_retries(workbook, requests)
+        num_of_requests += 1
+        requests = []
+
+    logger.info(
+        "Google Sheet updated successfully with %s rows in %s requests",
+        num_of_stores,
+        num_of_requests,
+    )
 
     return sheet_url
 
@@ -1,17 +1,149 @@
+import atexit
+import json
 import logging
-import sys
+import logging.handlers
 import os
+import queue
+import sys
+import threading
+import time
+
+# "json" writes every record as one compact JSON line, which CloudWatch Logs Insights parses into fields without any
+# parse pattern. "text" is the plain message, easier to read in a terminal.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# The records are handed to a background thread that writes them to stdout, so the event loop of the lookups and
+# the threads of the write-back never wait on the write of a log line
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "true").lower() == "true"
+# The hot path (one log per request or per store) logs at most this many records of the same message per minute,
+# the records over it are only counted and the count is attached to the next record that gets through
+HOT_PATH_LOGS_PER_MINUTE = int(os.getenv("HOT_PATH_LOGS_PER_MINUTE", 20))
+
+# The attributes every LogRecord has, anything else on a record was passed with extra={...} and goes in the JSON line
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a compact JSON line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.name != "root":
+            entry["logger"] = record.name
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `max_per_interval` records of the same message (its unformatted template) per interval"""
+
+    def __init__(self, max_per_interval: int, interval_seconds: float = 60):
+        super().__init__()
+        self.max_per_interval = max_per_interval
+        self.interval_seconds = interval_seconds
+        # message template -> [start of the interval, records let through, records suppressed]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval_seconds:
+                suppressed = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+            else:
+                suppressed = 0
+            if window[1] >= self.max_per_interval:
+                window[2] += 1
+                return False
+            window[1] += 1
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def pop_suppressed_count(self) -> int:
+        """Returns the records suppressed in the current intervals, which no later record reported yet"""
+        with self._lock:
+            suppressed = sum(window[2] for window in self._windows.values())
+            self._windows.clear()
+        return suppressed
+
+
+def _make_stream_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    return handler
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message is built here, in the thread that logs, so that it shows the objects as they were when logging
+        # (ex: stores the sink threads are still updating), it's still lazy since the filtered records never get here.
+        # Only the JSON encoding and the write are left to the thread of the listener.
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def _configure_logging() -> logging.Logger:
+    global _listener
+
+    root_logger = logging.getLogger()
+    # The Lambda runtime installs its own handler on the root logger, which would write every record a second time
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    if LOG_QUEUE_ENABLED:
+        log_queue = queue.SimpleQueue()
+        root_logger.addHandler(_QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(
+            log_queue, _make_stream_handler(), respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
+    else:
+        root_logger.addHandler(_make_stream_handler())
+
+    root_logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    return root_logger
+
+
+def flush_logs():
+    """Writes out the records still in the queue, called at the end of an invocation before Lambda freezes the process"""
+    suppressed = _hot_path_filter.pop_suppressed_count()
+    if suppressed:
+        logger.info("%s similar hot path log records were suppressed", suppressed)
+    if _listener is not None:
+        # stop() waits for the thread of the listener to write every queued record
+        _listener.stop()
+        _listener.start()
 
-logging.basicConfig(
-    level=logging.INFO,
-    # format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        # logging.FileHandler("./logs/log_file1.log"),
-        logging.StreamHandler(sys.stdout),
-    ],
-)
 
-logger = logging.getLogger()
+logger = _configure_logging()
 
-log_level = os.getenv("LOG_LEVEL", "INFO")
-logger.setLevel(log_level.upper())  # overrides the above level setting
+# For the logs of the hot path, the ones written per request or per store, rate limited per message so that a batch
+# where every request fails doesn't write thousands of lines. Their messages have to be formatted lazily
+# (logger.warning("... %s", value)) for the records of the same message to be grouped together.
+hot_path_logger = logging.getLogger("hot_path")
+_hot_path_filter = RateLimitFilter(HOT_PATH_LOGS_PER_MINUTE)
+hot_path_logger.addFilter(_hot_path_filter)
@@ -0,0 +1,146 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Metrics of a single invocation of the pipeline, emitted at its end as one CloudWatch Embedded Metric Format (EMF) line
+# on stdout. The Lambda log agent turns the EMF lines into CloudWatch metrics without any API call from our side, so
+# dashboards and alarms can track the duration of every stage, the Places API latency and the throughput across runs.
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "UberEatsStoresPhoneNumbers")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# The latencies are kept as counts of log-spaced buckets (20 per decade, so within ~6% of the real value) instead of
+# the raw values, so the memory used doesn't grow with the batch size. 20 buckets per decade from 1ms to 100s is at most
+# 100 distinct values, which is the max number of values per metric allowed in an EMF line.
+HISTOGRAM_BUCKETS_PER_DECADE = 20
+
+# The unit of the metrics, by the suffix of their names
+_UNITS_BY_SUFFIX = {
+    "Duration": "Seconds",
+    "Latency": "Milliseconds",
+    "Throughput": "Count/Second",
+}
+
+
+def _unit_of(metric_name: str) -> str:
+    for suffix, unit in _UNITS_BY_SUFFIX.items():
+        if metric_name.endswith(suffix):
+            return unit
+    return "Count"
+
+
+def _histogram_bucket(value: float) -> float:
+    if value <= 0:
+        return 0.0
+    exponent = round(math.log10(value) * HISTOGRAM_BUCKETS_PER_DECADE)
+    return round(10 ** (exponent / HISTOGRAM_BUCKETS_PER_DECADE), 3)
+
+
+class PipelineMetrics:
+    """Collects the stage timers, counters, latency histograms and gauges of an invocation"""
+
+    def __init__(self):
+        # The counters are incremented from the threads of the write-back and the event loop of the lookups
+        self._lock = threading.Lock()
+        self.timers: Dict[str, float] = {}  # name -> seconds
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Dict[float, int]] = {}  # name -> {bucket: count}
+        self.gauges: Dict[str, float] = {}  # name -> max value seen
+
+    @contextmanager
+    def timer(self, name: str):
+        """Adds the time spent in the block to the timer, a stage that runs in several steps accumulates all of them"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_latency(self, name: str, seconds: float):
+        bucket = _histogram_bucket(seconds * 1000)
+        with self._lock:
+            histogram = self.histograms.setdefault(name, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def set_gauge(self, name: str, value: float):
+        """Keeps the max value of the gauge, ex: the deepest a queue got during the run"""
+        with self._lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def percentile(self, name: str, percentile: float) -> Optional[float]:
+        """Approximate percentile of a latency histogram, in milliseconds"""
+        histogram = self.histograms.get(name)
+        if not histogram:
+            return None
+        rank = percentile / 100 * sum(histogram.values())
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= rank:
+                return bucket
+        return max(histogram)
+
+    def to_emf(self, dimensions: Optional[Dict[str, str]] = None) -> dict:
+        dimensions = dimensions or {}
+        with self._lock:
+            values = {
+                f"{name}Duration": round(seconds, 4)
+                for name, seconds in self.timers.items()
+            }
+            values.update(self.counters)
+            values.update(self.gauges)
+            for name, histogram in self.histograms.items():
+                buckets = sorted(histogram)
+                values[name] = {
+                    "Values": buckets,
+                    "Counts": [histogram[bucket] for bucket in buckets],
+                }
+
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": _unit_of(name)} for name in values
+                        ],
+                    }
+                ],
+            },
+            **dimensions,
+            **values,
+        }
+
+    def emit(self, dimensions: Optional[Dict[str, str]] = None):
+        """Prints the metrics as an EMF line, it's printed as is (not through the logger) so the line is pure JSON"""
+        if METRICS_ENABLED:
+            print(json.dumps(self.to_emf(dimensions)), flush=True)
+
+
+_metrics = PipelineMetrics()
+
+
+def get_metrics() -> PipelineMetrics:
+    return _metrics
+
+
+def reset_metrics() -> PipelineMetrics:
+    """Starts a fresh set of metrics, called at the start of every invocation since warm Lambdas reuse the module"""
+    global _metrics
+    _metrics = PipelineMetrics()
+    return _metrics
@@ -0,0 +1,179 @@
+import json
+import os
+from datetime import datetime, timezone
+from typing import Optional
+
+from utils.logger import logger
+from utils.metrics import get_metrics
+from utils.places_cache import COST_PER_REQUEST
+
+# Google gives $200 of free credits per month, the Text Search requests are billed past them
+PLACES_MONTHLY_FREE_CREDIT_USD = float(os.getenv("PLACES_MONTHLY_FREE_CREDIT_USD", 200))
+# The most we're willing to be billed in a month on top of the free credits. 0 keeps the pipeline within the free
+# credits, the batches shrink and then stop once the requests of the month get close to them.
+PLACES_MONTHLY_SPEND_CEILING_USD = float(
+    os.getenv("PLACES_MONTHLY_SPEND_CEILING_USD", 0)
+)
+
+# The ledger of a month is kept in the stores table (like the run checkpoint), as an item with a reserved store_id
+PLACES_BUDGET_ID_PREFIX = "__places_budget__#"
+
+
+def current_month() -> str:
+    # the billing months of Google Cloud follow the Pacific time, UTC is close enough for a budget with a margin
+    return datetime.now(timezone.utc).strftime("%Y-%m")
+
+
+class FileBudgetBackend:
+    """Keeps the ledger in a local JSON file, for the runs outside of Lambda"""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def _load_all(self) -> dict:
+        if not os.path.exists(self.file_path):
+            return {}
+        try:
+            with open(self.file_path, mode="r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "Couldn't load the Places budget from %s: %s", self.file_path, e
+            )
+            return {}
+
+    def load(self, month: str) -> dict:
+        return self._load_all().get(month, {})
+
+    def add(self, month: str, requests: int, resolved: int):
+        ledger = self._load_all()
+        usage = ledger.setdefault(month, {"requests": 0, "resolved": 0})
+        usage["requests"] += requests
+        usage["resolved"] += resolved
+
+        # write to a temporary file first so that a crash mid-write doesn't lose the counts of the month
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, mode="w", encoding="utf-8") as file:
+            json.dump(ledger, file)
+        os.replace(tmp_file_path, self.file_path)
+
+
+class DynamoDBBudgetBackend:
+    """Keeps the ledger in the stores table, shared by all the runs and Lambda containers"""
+
+    def load(self, month: str) -> dict:
+        from utils.dynamodb_utils import get_table
+
+        response = get_table().get_item(
+            Key={"store_id": f"{PLACES_BUDGET_ID_PREFIX}{month}"}
+        )
+        item = response.get("Item") or {}
+        return {
+            "requests": int(item.get("requests", 0)),
+            "resolved": int(item.get("resolved", 0)),
+        }
+
+    def add(self, month: str, requests: int, resolved: int):
+        from utils.dynamodb_utils import get_table
+
+        # ADD is atomic, the concurrent runs can't lose each other's counts
+        get_table().update_item(
+            Key={"store_id": f"{PLACES_BUDGET_ID_PREFIX}{month}"},
+            UpdateExpression="ADD requests :requests, resolved :resolved",
+            ExpressionAttributeValues={":requests": requests, ":resolved": resolved},
+        )
+
+
+class PlacesBudget:
+    """Counts the Places API requests of the month, and how many more fit under the spend ceiling"""
+
+    def __init__(
+        self,
+        backend,
+        spend_ceiling_usd: float = PLACES_MONTHLY_SPEND_CEILING_USD,
+        free_credit_usd: float = PLACES_MONTHLY_FREE_CREDIT_USD,
+    ):
+        self.backend = backend
+        self.spend_ceiling_usd = spend_ceiling_usd
+        self.free_credit_usd = free_credit_usd
+
+    def usage(self) -> dict:
+        usage = self.backend.load(current_month())
+        return {
+            "requests": int(usage.get("requests", 0)),
+            "resolved": int(usage.get("resolved", 0)),
+        }
+
+    def remaining_requests(self) -> int:
+        """The number of requests that can still be sent this month without going over the spend ceiling"""
+        allowance_usd = self.free_credit_usd + self.spend_ceiling_usd
+        spent_usd = self.usage()["requests"] * COST_PER_REQUEST
+        return max(0, int((allowance_usd - spent_usd) / COST_PER_REQUEST))
+
+    def record(self, requests: int, resolved: int):
+        if requests or resolved:
+            self.backend.add(current_month(), requests, resolved)
+
+    def report(self) -> dict:
+        usage = self.usage()
+        spend_usd = usage["requests"] * COST_PER_REQUEST
+        return {
+            "month": current_month(),
+            "requests": usage["requests"],
+            "resolved": usage["resolved"],
+            "spend_usd": round(spend_usd, 2),
+            "billed_usd": round(max(0.0, spend_usd - self.free_credit_usd), 2),
+            # the failed lookups and the stores without a phone number are paid for too
+            "cost_per_resolved_usd": (
+                round(spend_usd / usage["resolved"], 4) if usage["resolved"] else None
+            ),
+            "remaining_requests": self.remaining_requests(),
+        }
+
+
+class RequestAllowance:
+    """The Places API requests a run can still send under the spend ceiling, taken one by one before every attempt"""
+
+    def __init__(self, requests: int):
+        self.remaining = requests
+        self.exhausted = requests <= 0
+
+    def take(self) -> bool:
+        """Returns if a request can be sent, the retries of a lookup take one each like its first attempt"""
+        if self.remaining <= 0:
+            if not self.exhausted:
+                self.exhausted = True
+                logger.warning(
+                    "The Places API requests left under the spend ceiling of the month are used up, the remaining "
+                    "lookups of the run are left for next month"
+                )
+                get_metrics().increment("StoppedByPlacesBudget")
+            return False
+        self.remaining -= 1
+        return True
+
+
+def get_places_budget() -> Optional[PlacesBudget]:
+    """Returns the Places budget configured with the environment variables, None if it's disabled"""
+    backend_name = os.getenv("PLACES_BUDGET_BACKEND", "dynamodb").lower()
+    if backend_name == "none":
+        return None
+    if backend_name == "dynamodb":
+        backend = DynamoDBBudgetBackend()
+    elif backend_name == "file":
+        file_path = os.getenv("PLACES_BUDGET_FILE_PATH", "places_budget.json")
+        backend = FileBudgetBackend(file_path)
+    else:
+        raise ValueError(f"Unknown Places budget backend: {backend_name}")
+    return PlacesBudget(backend)
+
+
+def get_request_allowance(
+    budget: Optional[PlacesBudget] = None,
+) -> Optional[RequestAllowance]:
+    """Returns the allowance of the requests left this month, None if the Places budget is disabled"""
+    if budget is None:
+        budget = get_places_budget()
+    if budget is None:
+        return None
+    return RequestAllowance(budget.remaining_requests())
@@ -0,0 +1,243 @@
+import json
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+from utils.logger import logger
+
+# Cost of a Text Search request after the $200 monthly credit, used to report the spend saved by the cache
+COST_PER_REQUEST = 32 / 1000
+
+# Results that are a definitive answer from the Places API, including the negative ones. Anything else
+# (ex: "Error: 500 - ...") is a transient failure that has to be retried on the next run, so it's never cached.
+NEGATIVE_RESULTS = {"No results found", "Phone number not available"}
+
+
+def normalize_query(store_name: str, address: str) -> str:
+    """Returns the canonical form of the text query of a store, used as the cache key"""
+    # Chains and duplicate listings often only differ by casing and whitespace
+    query = " ".join(f"{store_name}, {address}".lower().split())
+    return re.sub(r"\s*,\s*", ", ", query)
+
+
+def is_cacheable_result(result: Optional[str]) -> bool:
+    if not result:
+        return False
+    return result in NEGATIVE_RESULTS or not result.startswith("Error")
+
+
+class InMemoryCacheBackend:
+    """Keeps the cache entries in memory for the lifetime of the process (a run, or a warm Lambda container)"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries
+        # ordered from the least to the most recently used entry, to evict the least recently used ones first
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, dict]:
+        found = {}
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                found[key] = entry
+        return found
+
+    def set_many(self, entries: Dict[str, dict]):
+        for key, entry in entries.items():
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class FileCacheBackend(InMemoryCacheBackend):
+    """In-memory cache that's loaded from and saved to a local JSON file, so it survives across runs"""
+
+    def __init__(self, file_path: str, max_entries: Optional[int] = None):
+        super().__init__(max_entries=max_entries)
+        self.file_path = file_path
+
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, mode="r", encoding="utf-8") as file:
+                    self.set_many(json.load(file))
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    "Couldn't load the Places cache from %s: %s", file_path, e
+                )
+
+    def flush(self):
+        # write to a temporary file first so that a crash mid-write doesn't corrupt the existing cache
+        tmp_file_path = f"{self.file_path}.tmp"
+        with open(tmp_file_path, mode="w", encoding="utf-8") as file:
+            json.dump(self._entries, file)
+        os.replace(tmp_file_path, self.file_path)
+
+
+class DynamoDBCacheBackend:
+    """Stores the cache entries in a DynamoDB table, shared by all the runs and Lambda containers"""
+
+    # DynamoDB limits BatchGetItem to 100 keys per request
+    MAX_KEYS_PER_BATCH_GET = 100
+    # The keys DynamoDB leaves unprocessed when it throttles are requested again after a back-off, a few times at most
+    MAX_BATCH_GET_RETRIES = 5
+    BATCH_GET_BACKOFF_BASE = 0.05  # seconds, doubled on every retry
+
+    def __init__(self, table_name: str):
+        import boto3
+
+        self.dynamodb = boto3.resource("dynamodb")
+        self.table = self.dynamodb.Table(table_name)
+        self.table_name = table_name
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, dict]:
+        keys = list(dict.fromkeys(keys))  # BatchGetItem rejects duplicate keys
+        found = {}
+
+        for i in range(0, len(keys), self.MAX_KEYS_PER_BATCH_GET):
+            request_items = {
+                self.table_name: {
+                    "Keys": [
+                        {"query_key": key}
+                        for key in keys[i : i + self.MAX_KEYS_PER_BATCH_GET]
+                    ]
+                }
+            }
+            # the unprocessed keys (returned when throttled) are requested again, with an exponential back off with full
+            # jitter so that the concurrent runs don't retry in lockstep
+            for retry_count in range(self.MAX_BATCH_GET_RETRIES + 1):
+                response = self.dynamodb.batch_get_item(RequestItems=request_items)
+                for item in response["Responses"].get(self.table_name, []):
+                    found[item["query_key"]] = {
+                        "result": item["result"],
+                        "expires_at": int(item["expires_at"]),
+                    }
+                request_items = response.get("UnprocessedKeys")
+                if not request_items or retry_count == self.MAX_BATCH_GET_RETRIES:
+                    break
+                time.sleep(
+                    random.uniform(0, self.BATCH_GET_BACKOFF_BASE * 2**retry_count)
+                )
+
+            if request_items:
+                # a cache that can't be read is only a cost: the keys left are counted as misses and looked up
+                logger.warning(
+                    "Couldn't read %s keys of the Places cache after %s retries, they're looked up instead",
+                    len(request_items[self.table_name]["Keys"]),
+                    self.MAX_BATCH_GET_RETRIES,
+                )
+
+        return found
+
+    def set_many(self, entries: Dict[str, dict]):
+        # The size of this table is bounded by the TTL of DynamoDB on the expires_at attribute rather than a max number of entries
+        with self.table.batch_writer(overwrite_by_pkeys=["query_key"]) as batch:
+            for key, entry in entries.items():
+                batch.put_item(
+                    Item={
+                        "query_key": key,
+                        "result": entry["result"],
+                        "expires_at": entry["expires_at"],
+                    }
+                )
+
+    def delete(self, key: str):
+        self.table.delete_item(Key={"query_key": key})
+
+    def flush(self):
+        pass
+
+
+class PlacesCache:
+    """Caches the results of the Places API lookups, keyed by the normalized text query of the stores"""
+
+    def __init__(self, backend, ttl_seconds: int):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, queries: Iterable[str]) -> Dict[str, str]:
+        """Returns the cached results of the queries that are found and not expired"""
+        queries = list(queries)
+        now = time.time()
+        results = {}
+
+        for query, entry in self.backend.get_many(queries).items():
+            if entry["expires_at"] > now:
+                results[query] = entry["result"]
+
+        self.hits += sum(1 for query in queries if query in results)
+        self.misses += sum(1 for query in queries if query not in results)
+
+        return results
+
+    def set_many(self, results: Dict[str, Optional[str]]):
+        """Caches the results that are a definitive answer from the Places API, including the negative ones"""
+        expires_at = int(time.time() + self.ttl_seconds)
+        entries = {
+            query: {"result": result, "expires_at": expires_at}
+            for query, result in results.items()
+            if is_cacheable_result(result)
+        }
+        if entries:
+            self.backend.set_many(entries)
+
+    def flush(self):
+        self.backend.flush()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_spend_usd": round(self.hits * COST_PER_REQUEST, 2),
+        }
+
+
+_places_cache: Optional[PlacesCache] = None
+
+
+def get_places_cache() -> Optional[PlacesCache]:
+    """Returns the process wide Places cache configured with the environment variables, None if it's disabled"""
+    global _places_cache
+
+    backend_name = os.getenv("PLACES_CACHE_BACKEND", "memory").lower()
+    if backend_name == "none":
+        return None
+
+    if _places_cache is None:
+        ttl_seconds = int(os.getenv("PLACES_CACHE_TTL_DAYS", 30)) * 24 * 60 * 60
+        max_entries = int(os.getenv("PLACES_CACHE_MAX_ENTRIES", 200_000))
+
+        if backend_name == "memory":
+            backend = InMemoryCacheBackend(max_entries=max_entries)
+        elif backend_name == "file":
+            # /tmp is the only writable directory in Lambda
+            file_path = os.getenv("PLACES_CACHE_FILE_PATH", "/tmp/places_cache.json")
+            backend = FileCacheBackend(file_path, max_entries=max_entries)
+        elif backend_name == "dynamodb":
+            table_name = os.getenv("PLACES_CACHE_TABLE", "UberEats_places_cache")
+            backend = DynamoDBCacheBackend(table_name)
+        else:
+            raise ValueError(f"Unknown Places cache backend: {backend_name}")
+
+        _places_cache = PlacesCache(backend, ttl_seconds=ttl_seconds)
+
+    return _places_cache
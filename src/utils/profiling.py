@@ -0,0 +1,280 @@
+import asyncio
+import cProfile
+import datetime
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+from utils.logger import logger
+
+# An opt-in profiling mode for finding the hot spots of a slow run, switched on with PROFILING_ENABLED=true or the
+# "profile" field of the invocation event, without deploying instrumented code. It records, for the whole invocation:
+#   - a cProfile CPU profile of the main thread, which runs the event loops and the export (cpu.prof and cpu.txt).
+#     The threads of the write-back and of the sinks aren't profiled, their time shows up in the metrics.
+#   - the peak memory allocated by every stage of the run, with its largest allocations (tracemalloc)
+#   - for every event loop: the number of tasks, the lag of the loop and the callbacks that blocked it too long
+# The profiling slows the run down (tracemalloc the most), it's not meant to be left on.
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# A local directory, or an s3://bucket/prefix URL since /tmp is gone with the Lambda container. Every invocation writes
+# its artifacts to a directory of its own.
+PROFILING_OUTPUT_DIR = os.getenv("PROFILING_OUTPUT_DIR", "profiles")
+# The callbacks of the event loop that run longer than this without awaiting are reported, they hold up every lookup
+PROFILING_SLOW_CALLBACK_SECONDS = float(
+    os.getenv("PROFILING_SLOW_CALLBACK_SECONDS", 0.1)
+)
+# How often the tasks and the lag of the event loop are sampled
+PROFILING_LOOP_SAMPLE_SECONDS = float(os.getenv("PROFILING_LOOP_SAMPLE_SECONDS", 0.5))
+# The number of functions and allocations kept in the reports
+PROFILING_TOP_ENTRIES = int(os.getenv("PROFILING_TOP_ENTRIES", 30))
+
+# The profiler of the running invocation, None when it isn't profiled
+_active_profiler = None
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """Collects the warnings of the asyncio debug mode, ex: "Executing <Handle ...> took 0.215 seconds" """
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord):
+        # the repr of a handle includes the repr of its arguments, which can be a whole page of stores
+        message = record.getMessage()
+        if len(message) > 1000:
+            message = f"{message[:500]} ... {message[-100:]}"
+        self.messages.append(message)
+
+
+class InvocationProfiler:
+    """Records the CPU profile, the memory of every stage and the event loop diagnostics of an invocation"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._cpu_profile = cProfile.Profile()
+        self._started_at = 0.0
+        self._stage = None
+        self._stage_started_at = 0.0
+        self.stages = []
+        self.event_loops = []
+        self._was_tracing_memory = False
+
+    def start(self):
+        # ex: the benchmarks trace the memory of the whole scenario already
+        self._was_tracing_memory = tracemalloc.is_tracing()
+        if not self._was_tracing_memory:
+            tracemalloc.start()
+        self._started_at = time.perf_counter()
+        self._begin_stage("started")
+        self._cpu_profile.enable()
+
+    def stop(self):
+        self._cpu_profile.disable()
+        self._end_stage()
+        if not self._was_tracing_memory:
+            tracemalloc.stop()
+
+    def _begin_stage(self, stage: str):
+        self._stage = stage
+        self._stage_started_at = time.perf_counter()
+        tracemalloc.reset_peak()
+
+    def _end_stage(self):
+        seconds = time.perf_counter() - self._stage_started_at
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        # grouped by line first, filtering the traces themselves is done in Python and takes seconds on a large batch
+        statistics = [
+            statistic
+            for statistic in tracemalloc.take_snapshot().statistics("lineno")
+            if not _is_import_or_profiling(statistic.traceback[0].filename)
+        ]
+        self.stages.append(
+            {
+                "stage": self._stage,
+                "seconds": round(seconds, 3),
+                "peak_bytes": peak_bytes,
+                # what's still allocated at the end of the stage, by the line that allocated it
+                "top_allocations": [
+                    str(statistic) for statistic in statistics[:PROFILING_TOP_ENTRIES]
+                ],
+            }
+        )
+
+    def mark_stage(self, stage: str):
+        """Closes the current stage and starts the next one, called when the run checkpoint moves to a new stage"""
+        # the snapshot of the memory is left out of the CPU profile and of the time of the stages
+        self._cpu_profile.disable()
+        self._end_stage()
+        self._begin_stage(stage)
+        self._cpu_profile.enable()
+
+    async def diagnose_event_loop(self, name: str, coroutine):
+        loop = asyncio.get_running_loop()
+        # The debug mode of asyncio times every callback and logs the slow ones. It also records where every task and
+        # callback was created, which shows up in the CPU profile under traceback.extract.
+        loop.set_debug(True)
+        loop.slow_callback_duration = PROFILING_SLOW_CALLBACK_SECONDS
+        asyncio_logger = logging.getLogger("asyncio")
+        slow_callbacks = _SlowCallbackHandler()
+        asyncio_logger.addHandler(slow_callbacks)
+        # they're in the report, not in the logs of the run
+        asyncio_logger.propagate = False
+
+        samples = []
+        max_tasks = 0
+        tasks_at_peak = Counter()
+
+        async def _sample_event_loop():
+            nonlocal max_tasks, tasks_at_peak
+            while True:
+                scheduled_at = time.perf_counter()
+                await asyncio.sleep(PROFILING_LOOP_SAMPLE_SECONDS)
+                # the time the loop took to get back to this task past the sleep, the time every ready task waits
+                lag = time.perf_counter() - scheduled_at - PROFILING_LOOP_SAMPLE_SECONDS
+                tasks = asyncio.all_tasks()
+                if len(tasks) > max_tasks:
+                    max_tasks = len(tasks)
+                    tasks_at_peak = Counter(
+                        task.get_coro().__qualname__ for task in tasks
+                    )
+                samples.append((round(lag, 4), len(tasks)))
+
+        started_at = time.perf_counter()
+        sampler = asyncio.create_task(_sample_event_loop())
+        try:
+            return await coroutine
+        finally:
+            sampler.cancel()
+            asyncio_logger.removeHandler(slow_callbacks)
+            asyncio_logger.propagate = True
+            lags = sorted(sample[0] for sample in samples)
+            self.event_loops.append(
+                {
+                    "name": name,
+                    "seconds": round(time.perf_counter() - started_at, 3),
+                    "max_tasks": max_tasks,
+                    "tasks_at_peak": dict(tasks_at_peak.most_common()),
+                    "p50_lag_seconds": lags[len(lags) // 2] if lags else None,
+                    "max_lag_seconds": lags[-1] if lags else None,
+                    "slow_callbacks": len(slow_callbacks.messages),
+                    "slowest_callbacks": sorted(
+                        slow_callbacks.messages,
+                        key=_callback_seconds,
+                        reverse=True,
+                    )[:PROFILING_TOP_ENTRIES],
+                    # (lag of the loop, number of tasks), every PROFILING_LOOP_SAMPLE_SECONDS
+                    "samples": samples,
+                }
+            )
+
+    def _cpu_report(self) -> str:
+        report = io.StringIO()
+        stats = pstats.Stats(self._cpu_profile, stream=report)
+        stats.sort_stats("cumulative").print_stats(PROFILING_TOP_ENTRIES)
+        stats.sort_stats("tottime").print_stats(PROFILING_TOP_ENTRIES)
+        return report.getvalue()
+
+    def write_artifacts(self, output_dir: str = PROFILING_OUTPUT_DIR) -> str:
+        """Writes the profile, the stages and the event loop diagnostics to their own directory, returns its path"""
+        summary = {
+            "name": self.name,
+            "seconds": round(time.perf_counter() - self._started_at, 3),
+            "stages": self.stages,
+            "event_loops": self.event_loops,
+        }
+
+        if not output_dir.startswith("s3://"):
+            artifacts_dir = os.path.join(output_dir, self.name)
+            self._write_files(artifacts_dir, summary)
+            return os.path.abspath(artifacts_dir)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self._write_files(tmp_dir, summary)
+            return _upload_directory_to_s3(tmp_dir, f"{output_dir}/{self.name}")
+
+    def _write_files(self, artifacts_dir: str, summary: dict):
+        os.makedirs(artifacts_dir, exist_ok=True)
+        # readable with pstats or snakeviz: python -m snakeviz cpu.prof
+        self._cpu_profile.dump_stats(os.path.join(artifacts_dir, "cpu.prof"))
+        with open(
+            os.path.join(artifacts_dir, "cpu.txt"), mode="w", encoding="utf-8"
+        ) as file:
+            file.write(self._cpu_report())
+        with open(
+            os.path.join(artifacts_dir, "summary.json"), mode="w", encoding="utf-8"
+        ) as file:
+            json.dump(summary, file, indent=2)
+
+
+def _is_import_or_profiling(filename: str) -> bool:
+    # the code of the modules imported during the run, and the traces of tracemalloc itself
+    return filename.startswith("<frozen ") or filename == tracemalloc.__file__
+
+
+def _callback_seconds(message: str) -> float:
+    # "Executing <Task ...> took 0.215 seconds"
+    try:
+        return float(message.rsplit(" took ", 1)[1].split()[0])
+    except (IndexError, ValueError):
+        return 0.0
+
+
+def _upload_directory_to_s3(local_dir: str, s3_url: str) -> str:
+    import boto3
+
+    bucket, _, prefix = s3_url[len("s3://") :].partition("/")
+    prefix = prefix.strip("/")
+    s3 = boto3.client("s3")
+    for file_name in os.listdir(local_dir):
+        s3.upload_file(
+            os.path.join(local_dir, file_name), bucket, f"{prefix}/{file_name}"
+        )
+    return f"s3://{bucket}/{prefix}"
+
+
+def mark_stage(stage: str):
+    """Starts a new stage of the profile, if the invocation is profiled"""
+    if _active_profiler is not None:
+        _active_profiler.mark_stage(stage)
+
+
+async def diagnose_event_loop(name: str, coroutine):
+    """Runs the coroutine, with the diagnostics of its event loop if the invocation is profiled"""
+    if _active_profiler is None:
+        return await coroutine
+    return await _active_profiler.diagnose_event_loop(name, coroutine)
+
+
+@contextmanager
+def profile_invocation(enabled: bool, name: Optional[str] = None):
+    """Profiles the block when enabled, then writes the artifacts to PROFILING_OUTPUT_DIR"""
+    global _active_profiler
+
+    if not enabled:
+        yield None
+        return
+
+    if name is None:
+        name = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+    profiler = InvocationProfiler(name)
+    _active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profiler = None
+        # a failure to write the profile doesn't fail the run
+        try:
+            artifacts_location = profiler.write_artifacts()
+            logger.info("Wrote the profile of the invocation to %s", artifacts_location)
+        except Exception as e:
+            logger.error("Couldn't write the profile of the invocation: %r", e)
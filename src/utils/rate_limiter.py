@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Non-blocking token bucket rate limiter, shared by all the tasks of a batch of Places API requests"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        # rate is the number of tokens added per second, burst is the max number of tokens the bucket can hold.
+        # A request consumes one token, so on average we never exceed `rate` requests per second, while still
+        # allowing up to `burst` requests to be sent back to back after an idle period.
+        if rate <= 0:
+            raise ValueError("The rate of the token bucket must be positive")
+        if burst < 1:
+            raise ValueError("The burst of the token bucket must be at least 1")
+
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        # The lock makes the waiting tasks take the tokens in FIFO order. Only the acquisition of a token is
+        # serialized, the requests themselves still run concurrently once they get their token.
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_requests_per_minute(
+        cls, requests_per_minute: int, burst: int = 1
+    ) -> "AsyncTokenBucket":
+        return cls(rate=requests_per_minute / 60, burst=burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    async def acquire(self):
+        """Waits (without blocking the event loop) until a token is available and consumes it"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                # sleep just long enough for the next token to be added to the bucket
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
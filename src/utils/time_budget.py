@@ -0,0 +1,165 @@
+import os
+import time
+from typing import Callable, Optional
+
+from utils.logger import logger
+
+# Time kept free at the end of the invocation for the export (Google Sheet, Slack), the final write-back and the
+# checkpoint, on top of an estimate that grows with the number of stores to export
+TIME_BUDGET_SAFETY_MARGIN_SECONDS = float(
+    os.getenv("TIME_BUDGET_SAFETY_MARGIN_SECONDS", 60)
+)
+EXPORT_SECONDS_PER_STORE = float(os.getenv("EXPORT_SECONDS_PER_STORE", 0.002))
+# Cap on the stores of a single invocation, so the Google Sheet stays a workable size for the sales team
+MAX_ITEMS_PER_INVOCATION = int(os.getenv("MAX_ITEMS_PER_INVOCATION", 20000))
+# The stores are pulled in small pages when the batch is sized by the time budget, a page of the 1MB max size holds
+# thousands of stores, which would take minutes to look up at the Places API rate limit
+TIME_BUDGET_PAGE_SIZE = int(os.getenv("TIME_BUDGET_PAGE_SIZE", 100))
+# Until the throughput of the batch is measured, the lookups are assumed to run at the rate limit of the Places API, so
+# that even the initial batch isn't pulled when the time left couldn't cover its lookups (ex: a retried invocation)
+ESTIMATED_STORES_PER_SECOND = int(os.getenv("PLACES_MAX_REQUESTS_PER_MINUTE", 600)) / 60
+
+# The decisions on the next page of the batch
+PULL = "pull"
+WAIT = "wait"
+STOP = "stop"
+
+
+class TimeBudget:
+    """Decides if there's enough time left in the invocation to pull and process another page of stores"""
+
+    def __init__(
+        self,
+        context=None,
+        initial_batch_size: int = 1000,
+        max_batch_size: int = MAX_ITEMS_PER_INVOCATION,
+        safety_margin_seconds: float = TIME_BUDGET_SAFETY_MARGIN_SECONDS,
+        export_seconds_per_store: float = EXPORT_SECONDS_PER_STORE,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        # Outside of Lambda (ex: local runs and the benchmarks) there's no context, and the batch has the initial size
+        self.context = (
+            context if hasattr(context, "get_remaining_time_in_millis") else None
+        )
+        self.initial_batch_size = initial_batch_size
+        self.max_batch_size = max_batch_size
+        self.safety_margin_seconds = safety_margin_seconds
+        self.export_seconds_per_store = export_seconds_per_store
+        # Closes the batch before its size is reached when it returns True, ex: the backfill on Ctrl+C
+        self.should_stop = should_stop
+
+        self.first_read_at = None
+        self.read_count = 0
+        self.resolved_count = 0
+        self.stopped_early = False
+
+    @property
+    def batch_size_limit(self) -> int:
+        return self.max_batch_size if self.context else self.initial_batch_size
+
+    @property
+    def page_size(self) -> Optional[int]:
+        # small pages when the batch can be closed early, so that it doesn't wait on the lookups of a large page
+        return TIME_BUDGET_PAGE_SIZE if self.context or self.should_stop else None
+
+    def remaining_seconds(self) -> Optional[float]:
+        if self.context is None:
+            return None
+        return self.context.get_remaining_time_in_millis() / 1000
+
+    def lookup_seconds_left(self) -> Optional[float]:
+        """The time left for the lookups and their retries before the export of the stores read has to start"""
+        remaining = self.remaining_seconds()
+        if remaining is None:
+            return None
+        export_seconds = self.read_count * self.export_seconds_per_store
+        return remaining - self.safety_margin_seconds - export_seconds
+
+    def initial_batch_limit(self) -> int:
+        """The size of a batch pulled at once (ex: by the staged mode), capped by the stores whose lookups fit in the time left"""
+        remaining = self.remaining_seconds()
+        if remaining is None:
+            return self.initial_batch_size
+        seconds_per_store = (
+            1 / ESTIMATED_STORES_PER_SECOND + self.export_seconds_per_store
+        )
+        fitting_count = int(
+            (remaining - self.safety_margin_seconds) / seconds_per_store
+        )
+        return max(0, min(self.initial_batch_size, fitting_count))
+
+    def record_read(self, count: int):
+        if self.first_read_at is None:
+            self.first_read_at = time.monotonic()
+        self.read_count += count
+
+    def record_resolved(self, count: int):
+        self.resolved_count += count
+
+    def throughput(self) -> Optional[float]:
+        """The live rate of the stores going through the lookups and the write-back, in stores per second"""
+        if self.resolved_count == 0 or self.first_read_at is None:
+            return None
+        elapsed = time.monotonic() - self.first_read_at
+        return self.resolved_count / elapsed if elapsed > 0 else None
+
+    def out_of_time(self) -> bool:
+        """True when the time left only covers the export of the stores read so far, or the batch was asked to stop"""
+        if self.should_stop is not None and self.should_stop():
+            return True
+        seconds_left = self.lookup_seconds_left()
+        return seconds_left is not None and seconds_left <= 0
+
+    def next_page_decision(self) -> str:
+        """Returns PULL if the next page can be pulled now, WAIT to decide again later or STOP to close the batch"""
+        if self.read_count >= self.batch_size_limit:
+            return STOP
+        if self.should_stop is not None and self.should_stop():
+            self.stopped_early = True
+            logger.info(
+                "Closing the batch on request: read %s stores, resolved %s",
+                self.read_count,
+                self.resolved_count,
+            )
+            return STOP
+
+        remaining = self.remaining_seconds()
+        if remaining is None:
+            return PULL  # limited by the initial batch size only
+
+        page_size = self.page_size
+        time_left = (
+            remaining
+            - self.safety_margin_seconds
+            - (self.read_count + page_size) * self.export_seconds_per_store
+        )
+
+        if time_left <= 0:
+            decision = STOP
+        else:
+            throughput = self.throughput()
+            if throughput is None:
+                if self.read_count >= self.initial_batch_size:
+                    return WAIT  # the first stores of the batch aren't resolved yet
+                # the initial batch is pulled right away, as long as its lookups can fit in the time left
+                throughput = ESTIMATED_STORES_PER_SECOND
+            in_flight = self.read_count - self.resolved_count
+            if page_size / throughput >= time_left:
+                # not even a page would fit in the time left once the stores in flight are done
+                decision = STOP
+            elif (in_flight + page_size) / throughput < time_left:
+                decision = PULL
+            else:
+                # the stores in flight take up the time left for now, waiting also refines the throughput estimate
+                return WAIT
+
+        if decision == STOP:
+            self.stopped_early = self.read_count < self.batch_size_limit
+            logger.info(
+                "Closing the batch with %.0fs left in the invocation: read %s stores, resolved %s at %.2f stores per second",
+                remaining,
+                self.read_count,
+                self.resolved_count,
+                self.throughput() or 0,
+            )
+        return decision
@@ -0,0 +1,48 @@
+import functools
+import os
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from utils.logger import logger
+
+# How long the credentials and the authorized API clients are reused across the warm invocations of a Lambda container,
+# a rotated secret is picked up after at most this long
+CLIENT_CACHE_TTL_SECONDS = float(os.getenv("CLIENT_CACHE_TTL_SECONDS", 3600))
+
+
+def ttl_cache(
+    ttl_seconds: float, is_valid: Optional[Callable[[Any], bool]] = None
+) -> Callable:
+    """Caches the results of a function by its arguments for ttl_seconds, for the lifetime of the process"""
+    # The module level state of a Lambda container survives between its invocations, so a value cached here is reused by
+    # every warm invocation. is_valid() can end the life of a value before its TTL, ex: an access token about to expire.
+
+    def decorator(function: Callable) -> Callable:
+        entries = {}  # args -> (expires_at, value)
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                entry = entries.get(args)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now and (is_valid is None or is_valid(value)):
+                    logger.debug("Reusing the cached result of %s", function.__name__)
+                    return value
+
+            value = function(*args)
+            with lock:
+                entries[args] = (now + ttl_seconds, value)
+            return value
+
+        def cache_clear():
+            with lock:
+                entries.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator